@@ -0,0 +1,258 @@
+# Single command line entry point for the toolset, for batch jobs that would otherwise start python once per
+# file.  Every command accepts any number of files, which are all processed in the same process.
+#
+# Unlike the individual scripts, this tool never changes the working directory and never waits for input:
+# paths are used as given, existing output is skipped unless --overwrite is set, and --skeleton must be used
+# when more than one skeleton could match.  A file that fails is reported and the remaining files are still
+# processed; the exit code is 1 if anything failed.  Each command only imports the modules it needs.
+#
+# With --jobs, the export and import commands process several files at once in separate processes, starting
+# with the files estimated to take the longest (see lib_scheduler.py).  With --combine, --jobs also decodes the
+# models of the combined glTF in separate processes.  With --source, the export commands read their files straight
+# from a folder or a .zip / .tar bundle (see lib_filesource.py), and the file names and patterns are inside it.
+# With --archive, they write their output into archives instead of plain files (see lib_filesink.py), which
+# import-model can read back.
+#
+# Usage:
+# /path/to/python3 berseria.py export-model [-h] [-t] [-s] [-o] [-n] [-c] [-f] [-q] [-k SKELETON] [-j JOBS] [--costlog COSTLOG] [--source SOURCE] [--archive ARCHIVE] dlb_files ...
+# /path/to/python3 berseria.py export-animation [-h] [-o] [-t] [-d] [--dumpformat {json,npz}] [-k SKELETON] [-c] [-r] [--tolerance TOLERANCE] [-q] [-j JOBS] [--costlog COSTLOG] [--source SOURCE] [--archive ARCHIVE] animbin_files ...
+# /path/to/python3 berseria.py import-model [-h] [-s] [-w] [--archive ARCHIVE] [-j JOBS] [--costlog COSTLOG] tomdlb_files ...
+# /path/to/python3 berseria.py convert-endian [-h] tomdlb_files ...
+# /path/to/python3 berseria.py meshpack [-h] [-u] targets ...
+# /path/to/python3 berseria.py run [-h] [-w WORKERS] [-r REPORT] manifest_file
+# /path/to/python3 berseria.py catalog [-h] [-d DATABASE] [-u FOLDER] [query] [value]
+#
+# The run command executes a build manifest, see lib_manifest.py for the format.  The catalog command builds and
+# searches an SQLite catalog of the models, scenes and animations in a folder, see lib_catalog.py.
+#
+# GitHub eArmada8/berseria_model_tool
+
+import argparse, traceback, functools, json, os, sys
+
+def run_each (files, function):
+    failed = 0
+    for file in files:
+        try:
+            function(file)
+        except Exception:
+            print("Error processing {}!".format(file))
+            traceback.print_exc()
+            failed += 1
+    return(failed)
+
+# Runs the jobs in parallel if --jobs or --costlog is used.  function must be picklable, and estimate returns the
+# estimated cost of a file.  initializer(*initargs) is called before the first file of each process.
+def run_jobs (files, function, args, estimate, initializer = None, initargs = ()):
+    if args.jobs == 1 and args.costlog == '':
+        if initializer != None:
+            initializer(*initargs)
+        return(run_each(files, function))
+    import lib_scheduler
+    jobs = []
+    for file in files:
+        try:
+            cost = estimate(file)
+        except Exception: # The job itself will report the problem
+            cost = 0
+        jobs.append({'name': file, 'function': function, 'args': (file,), 'cost': cost})
+    return(lib_scheduler.run_longest_first(jobs, args.jobs, args.costlog, args.command, initializer, initargs))
+
+# Returns the file source of --source and the files in it, with patterns expanded (the shell cannot look inside a bundle)
+def open_source (args, files):
+    import lib_filesource
+    if args.source == '':
+        return(lib_filesource.local_files, files)
+    source = lib_filesource.open_source(args.source)
+    return(source, [y for x in files for y in (source.glob(x) if any([z in x for z in '*?[']) else [x])])
+
+# Returns the sink of --archive when it names one archive for everything (None otherwise), or False if it cannot
+# be used.  Only one process can write to an archive.
+def open_sink (args):
+    import lib_filesink
+    if args.archive in ['', 'zip', 'tar']:
+        return(None)
+    if args.jobs != 1:
+        print("--archive {} cannot be used with --jobs, use zip or tar for one archive per model instead!".format(args.archive))
+        return False
+    if os.path.exists(args.archive) and args.overwrite == False:
+        print("{} already exists, use --overwrite to replace it!".format(args.archive))
+        return False
+    return(lib_filesink.open_archive_sink(args.archive))
+
+def export_model (args):
+    import berseria_export_model
+    source, dlb_files = open_source(args, args.dlb_files)
+    sink = open_sink(args)
+    if sink == False:
+        return(1)
+    failed = run_jobs(dlb_files, functools.partial(berseria_export_model.process_dlb, overwrite = args.overwrite,
+        write_raw_buffers = args.skiprawbuffers, write_binary_gltf = args.textformat, use_meshpack = args.meshpack,
+        skeleton_file = args.skeleton, interactive = False, separate_gltf = not args.combine, force = args.force,
+        source = source, sink = sink, archive_format = args.archive if sink == None else '', quantize = args.quantize), args,
+        functools.partial(berseria_export_model.estimate_dlb_cost, source = source))
+    if args.combine == True:
+        failed += run_each([dlb_files], lambda x: berseria_export_model.process_dlbs_combined(x,
+            overwrite = args.overwrite, write_binary_gltf = args.textformat, skeleton_file = args.skeleton,
+            interactive = False, force = args.force, workers = args.jobs, source = source, sink = sink,
+            quantize = args.quantize))
+    if sink != None:
+        sink.close()
+    return(failed)
+
+def export_animation (args):
+    import berseria_export_animation, lib_filesink, lib_keyframes
+    source, animbin_files = open_source(args, args.animbin_files)
+    if args.archive in ['zip', 'tar']:
+        print("Animations are written to one file each, --archive needs an archive name!")
+        return(1)
+    sink = open_sink(args)
+    if sink == False:
+        return(1)
+    tolerances = lib_keyframes.parse_tolerances(args.tolerance) if args.reduce == True else None
+    if args.combine == True:
+        if args.dumpanidata == True:
+            print("--dumpanidata is not used with --combine, run without --combine to dump the animation data.")
+        failed = run_each([animbin_files], lambda x: berseria_export_animation.process_tosamsbs_combined(x,
+            overwrite = args.overwrite, write_glb = args.textformat, skeleton_file = args.skeleton,
+            interactive = False, workers = args.jobs, source = source,
+            sink = sink if sink != None else lib_filesink.local_output, tolerances = tolerances,
+            quantize = args.quantize))
+        if sink != None:
+            sink.close()
+        return(failed)
+    # The skeletons are read once here, and handed to each process before its first file
+    skeletons = berseria_export_animation.resolve_batch_skeletons(animbin_files, args.skeleton, False, source)
+    failed = run_jobs(animbin_files, functools.partial(berseria_export_animation.process_batch_tosamsb,
+        overwrite = args.overwrite, write_glb = args.textformat, dump_extra_animation_data = args.dumpanidata,
+        skeleton_file = args.skeleton, interactive = False, source = source,
+        sink = sink if sink != None else lib_filesink.local_output, tolerances = tolerances,
+        quantize = args.quantize, decode_workers = 0 if args.jobs == 1 else 1, dump_format = args.dumpformat), args,
+        functools.partial(berseria_export_animation.estimate_tosamsb_cost, source = source),
+        berseria_export_animation.set_batch_skeletons, (skeletons,))
+    berseria_export_animation.set_batch_skeletons({})
+    if sink != None:
+        sink.close()
+    return(failed)
+
+def import_one (tomdlb_file, swap_endian = False, archive_file = ''):
+    import berseria_import_model
+    if berseria_import_model.process_tomdlb(tomdlb_file, swap_endian = swap_endian, interactive = False,
+            archive_file = archive_file) == False:
+        raise ValueError("{} was not rebuilt.".format(tomdlb_file))
+
+def import_model (args):
+    import berseria_import_model
+    if args.watch == True:
+        berseria_import_model.watch_tomdlbs(args.tomdlb_files, swap_endian = args.swap_endian)
+        return(0)
+    return(run_jobs(args.tomdlb_files, functools.partial(import_one, swap_endian = args.swap_endian,
+        archive_file = args.archive), args, berseria_import_model.estimate_dlb_cost))
+
+def convert_one (tomdlb_file):
+    import lib_endian
+    if lib_endian.convert_tomdlb(tomdlb_file) == False:
+        raise ValueError("{} was not converted.".format(tomdlb_file))
+
+def convert_endian (args):
+    return(run_each(args.tomdlb_files, convert_one))
+
+def meshpack (args):
+    import lib_meshpack
+    def process (target):
+        if args.unpack == True:
+            print("Unpacked {0} submeshes from {1}.".format(lib_meshpack.meshpack_to_folder(target), target))
+        else:
+            print("Packed {0} submeshes from {1}.".format(lib_meshpack.folder_to_meshpack(target), target))
+    return(run_each(args.targets, process))
+
+def run_manifest (args):
+    import lib_manifest
+    report = lib_manifest.run_manifest(args.manifest_file, workers = args.workers)
+    lib_manifest.print_report(report)
+    if args.report != '':
+        with open(args.report, 'wb') as f:
+            f.write(json.dumps(report, indent=4).encode())
+    return(len([x for x in report['tasks'] if x['status'] != 'ok']))
+
+def catalog (args):
+    import lib_catalog
+    for folder in args.update:
+        stats = lib_catalog.refresh_catalog(args.database, folder)
+        print("Catalog of {0}: {1} files scanned, {2} unchanged, {3} removed, {4} failed, in {5:.3f} seconds.".format(
+            folder, stats['scanned'], stats['unchanged'], stats['removed'], stats['failed'], stats['seconds']))
+    if args.query != '':
+        for row in lib_catalog.query_catalog(args.database, args.query, args.value):
+            print('\t'.join([str(x) for x in row]))
+    return(0)
+
+def add_job_arguments (sub):
+    sub.add_argument('-j', '--jobs', help="Number of files to process at once, longest first (0 for one per CPU)", type=int, default=1)
+    sub.add_argument('--costlog', help="Append the estimated and actual time of each file to this JSON lines file", default='')
+    return
+
+def add_source_argument (sub):
+    sub.add_argument('--source', help="Read the files from this folder or .zip / .tar bundle instead of the current folder", default='')
+    sub.add_argument('--archive', help="Write everything into this .zip / .tar file, or zip / tar for one archive per model", default='')
+    return
+
+def main (argv = None):
+    parser = argparse.ArgumentParser(prog = 'berseria')
+    subparsers = parser.add_subparsers(dest = 'command', required = True)
+    sub = subparsers.add_parser('export-model', help="Export TOMDLB_D/TOMDLP_P models to raw buffers and glTF")
+    sub.add_argument('-t', '--textformat', help="Write gltf instead of glb", action="store_false")
+    sub.add_argument('-s', '--skiprawbuffers', help="Skip writing fmt/ib/vb/vgmap files in addition to glb", action="store_false")
+    sub.add_argument('-o', '--overwrite', help="Overwrite existing files", action="store_true")
+    sub.add_argument('-n', '--meshpack', help="Write raw buffers into a single meshes.npz instead of fmt/ib/vb/vgmap files", action="store_true")
+    sub.add_argument('-c', '--combine', help="Write one glTF with all the models instead of one per model", action="store_true")
+    sub.add_argument('-f', '--force', help="Export even if the model is unchanged since the last export", action="store_true")
+    sub.add_argument('-q', '--quantize', help="Write the glTF with KHR_mesh_quantization (smaller, slightly less precise)", action="store_true")
+    sub.add_argument('-k', '--skeleton', help="TOMDLB_D file to use as the primary skeleton", default='')
+    add_job_arguments(sub)
+    add_source_argument(sub)
+    sub.add_argument('dlb_files', nargs='+', help="Names of dlb files to process.")
+    sub.set_defaults(function = export_model)
+    sub = subparsers.add_parser('export-animation', help="Export TOANMB/TOANMSB animations to glTF")
+    sub.add_argument('-o', '--overwrite', help="Overwrite existing files", action="store_true")
+    sub.add_argument('-t', '--textformat', help="Write gltf instead of glb", action="store_false")
+    sub.add_argument('-d', '--dumpanidata', help="Write extra animation data to json", action="store_true")
+    sub.add_argument('--dumpformat', help="Format of --dumpanidata, json or npz (binary, much smaller)",
+        choices=['json', 'npz'], default='json')
+    sub.add_argument('-k', '--skeleton', help="Skeleton json or TOMDLB_D file to use", default='')
+    sub.add_argument('-c', '--combine', help="Write one glTF with all the animations of each folder instead of one per file", action="store_true")
+    sub.add_argument('-r', '--reduce', help="Remove keys that interpolation can rebuild", action="store_true")
+    sub.add_argument('--tolerance', help="Largest error of --reduce, e.g. translation=0.001,rotation=0.0005,scale=0.001 (radians for rotation)", default='')
+    sub.add_argument('-q', '--quantize', help="Store rotations as normalized shorts (smaller, slightly less precise)", action="store_true")
+    add_job_arguments(sub)
+    add_source_argument(sub)
+    sub.add_argument('animbin_files', nargs='+', help="Names of binary animation files to parse.")
+    sub.set_defaults(function = export_animation)
+    sub = subparsers.add_parser('import-model', help="Rebuild TOMDLB_D/TOMDLP_P models from exported folders")
+    sub.add_argument('-s', '--swap_endian', help="Change endianness", action="store_true")
+    sub.add_argument('-w', '--watch', help="Keep running and rebuild whenever a model folder changes", action="store_true")
+    sub.add_argument('--archive', help="Read the model folders from this .zip / .tar written by export-model --archive", default='')
+    add_job_arguments(sub)
+    sub.add_argument('tomdlb_files', nargs='+', help="Names of tomdlb_d files to import into.")
+    sub.set_defaults(function = import_model)
+    sub = subparsers.add_parser('convert-endian', help="Byteswap TOMDLB_D/TOMDLP_P models between PS3 and PC")
+    sub.add_argument('tomdlb_files', nargs='+', help="Names of tomdlb_d files to convert.")
+    sub.set_defaults(function = convert_endian)
+    sub = subparsers.add_parser('meshpack', help="Pack model folders into meshes.npz, or unpack them")
+    sub.add_argument('-u', '--unpack', help="Unpack meshes.npz into .fmt/.ib/.vb/.vgmap files", action="store_true")
+    sub.add_argument('targets', nargs='+', help="Model folders to pack, or .npz files to unpack.")
+    sub.set_defaults(function = meshpack)
+    sub = subparsers.add_parser('run', help="Run the tasks in a build manifest (.json or .toml)")
+    sub.add_argument('-w', '--workers', help="Number of files to process at once, across tasks (default from manifest, or CPU count)", type=int, default=0)
+    sub.add_argument('-r', '--report', help="Also write the timing report to this JSON file", default='')
+    sub.add_argument('manifest_file', help="Name of manifest file to run.")
+    sub.set_defaults(function = run_manifest)
+    sub = subparsers.add_parser('catalog', help="Build or search a catalog of the models, scenes and animations in a folder")
+    sub.add_argument('-d', '--database', help="Catalog file (default asset_catalog.sqlite)", default='asset_catalog.sqlite')
+    sub.add_argument('-u', '--update', help="Scan this folder into the catalog first (can be repeated)", action='append', default=[])
+    sub.add_argument('query', nargs='?', default='', help="texture, mesh_type, mesh_flags, target, references, errors, or an SQL query")
+    sub.add_argument('value', nargs='?', default='', help="Texture or file name (* is a wildcard), or number")
+    sub.set_defaults(function = catalog)
+    args = parser.parse_args(argv)
+    return(1 if args.function(args) > 0 else 0)
+
+if __name__ == "__main__":
+    sys.exit(main())
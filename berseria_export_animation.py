@@ -8,50 +8,48 @@
 # For command line options, run:
 # /path/to/python3 berseria_export_animation.py --help
 #
-# Requires pyquaternion, which can be installed by:
-# /path/to/python3 -m pip install pyquaternion
+# Requires numpy, which can be installed by:
+# /path/to/python3 -m pip install numpy
 #
-# Requires berseria_export_model.py and lib_fmtibvb.py, place in the same directory
+# Requires berseria_export_model.py, lib_fmtibvb.py, lib_schema.py, lib_prompt.py, lib_filesource.py,
+# lib_filesink.py, lib_scheduler.py, lib_keyframes.py, lib_pose.py, lib_exportcache.py, lib_animcache.py and
+# lib_channelstore.py, place in the same directory
 #
 # GitHub eArmada8/berseria_model_tool
 
 try:
-    import math, struct, json, glob, os, sys
-    from pyquaternion import Quaternion
-    from berseria_export_model import *
+    import math, struct, json, functools, glob, io, os, sys, numpy
+    from concurrent.futures import ProcessPoolExecutor
+    from multiprocessing import shared_memory, resource_tracker
+    from berseria_export_model import find_primary_skeleton, combine_skeletons
+    from lib_fmtibvb import read_struct_from_json
+    from lib_schema import FormatContext
+    from lib_prompt import confirm_overwrite, choose_from_list, pause_on_error
+    from lib_filesource import local_files
+    from lib_filesink import local_output
+    from lib_pose import quaternion_multiply
+    from lib_keyframes import reduce_keyframes, parse_tolerances
+    from lib_animcache import animation_cache_file, read_cached_entries, write_cached_entries
+    from lib_channelstore import animation_channel, target_view, animation_data_json, write_animation_dump
 except ModuleNotFoundError as e:
     print("Python module missing! {}".format(e.msg))
     input("Press Enter to abort.")
     raise
 
+# Configuration variable
+# True to keep the decoded animation data next to the animations, so that exporting them again skips the decoding
+use_animation_cache = True
+# Animation files at least this large have their DCT channels decoded by several processes (if there is more
+# than one CPU), see decode_dct_entries_parallel()
+parallel_decode_min_size = 256 * 1024 # In bytes
+
 # Global variables, do not edit
-addr_size = 8
-e = '<'
-file_version = 1
 dct_max = 33 # This is hard-coded
 ani_fps = 30
 
-def set_address_size (size):
-    global addr_size
-    if size in [4,8]:
-        addr_size = size
-    return
-
-def set_endianness (endianness):
-    global e
-    if endianness in ['<', '>']:
-        e = endianness
-    return
-
-def set_file_version (version):
-    global file_version
-    if version in [0,1]:
-        file_version = version
-    return
-
-def read_offset (f):
+def read_offset (f, ctx):
     start_offset = f.tell()
-    diff_offset, = struct.unpack("{}{}".format(e, {4: "I", 8: "Q"}[addr_size]), f.read(addr_size))
+    diff_offset, = ctx.read(f, 'address')
     return(start_offset + diff_offset)
 
 def convert_matrix_to_trs (matrix):
@@ -86,8 +84,8 @@ def convert_matrix_to_trs (matrix):
 def decode_target_flag (flag):
     return({'type': flag & 0xFFFFFFFF, 'target': flag >> 32 & 0xFFFF, 'unknown': flag >> 48})
 
-def read_vals (f, e, vec_len, val_sz):
-    vals = list(struct.unpack("{}{}{}".format(e, vec_len, val_sz[0]), f.read(val_sz[1] * vec_len)))
+def read_vals (f, ctx, vec_len, val_sz):
+    vals = list(struct.unpack("{}{}{}".format(ctx.e, vec_len, val_sz[0]), f.read(val_sz[1] * vec_len)))
     if val_sz[0] == 'h':
         norm_range = (2**15-1)
         vals = [x / norm_range for x in vals]
@@ -123,21 +121,21 @@ class base_list:
     def next_ (self):
         self.index += 1
 
-def read_dct_segment (f, base_all, vec_len, segment_len):
+def read_dct_segment (f, base_all, vec_len, segment_len, ctx):
     s16_max, s8_max, s4_max = (2**15-1), (2**7-1), (2**3-1)
     dct_table = make_dct_table()
     dct_data = []
     for _ in range(vec_len):
-        dct_header = list(struct.unpack("{}2H4B".format(e), f.read(8)))
+        dct_header = list(ctx.read(f, 'dct_header'))
         n_s16, n_s8, n_s4, n_0 = dct_header[3] >> 4, dct_header[3] & 0xF, dct_header[4] >> 4, dct_header[4] & 0xF
         dct_index = n_s16 + n_s8 + n_s4 + n_0
         s16, s8, s4 = [], [], []
         for _ in range(n_s16):
-            s16.append([x/s16_max for x in list(struct.unpack("{}4h".format(e), f.read(8)))])
+            s16.append([x/s16_max for x in list(ctx.read(f, 'dct_s16'))])
         for _ in range(n_s8):
-            s8.append([x/s8_max for x in list(struct.unpack("{}4b".format(e), f.read(4)))])
+            s8.append([x/s8_max for x in list(struct.unpack("{}4b".format(ctx.e), f.read(4)))])
         for _ in range(n_s4 // 2):  # These are split into 2x vec4
-            vals = list(struct.unpack("{}4B".format(e), f.read(4)))
+            vals = list(struct.unpack("{}4B".format(ctx.e), f.read(4)))
             s4.append([((x >> 4) - 8) / s4_max for x in vals])
             s4.append([((x & 0xF) - 8) / s4_max for x in vals])
         dct_data.append({'header': dct_header, 'index': dct_index, 'vecs': [s16, s8, s4]})
@@ -159,13 +157,15 @@ def read_dct_segment (f, base_all, vec_len, segment_len):
     vectors.append([0.0 for _ in range(vec_len)])
     return(vectors)
 
-def decompress_dct (f, flag, num_indices):
+# Where the segments of a DCT compressed entry are, and the vectors that are added to them (float_table).
+# f must be at the values of the entry (see read_entry_header()).  Each segment can then be decoded on its own.
+def read_dct_layout (f, flag, num_indices, ctx):
     type_, val_sz, vec_len = flag & 0xF, {0:('f',4),1:('h',2)}[flag >> 4 & 0x3], flag >> 12 & 0xF
-    base_all, = struct.unpack("{}f".format(e), f.read(4))
+    base_all, = struct.unpack("{}f".format(ctx.e), f.read(4))
     dct_toc = [0]
     if type_ == 9: # Values are segmented as stream is too long to fit into single segment
-        segments, = struct.unpack("{}H".format(e), f.read(2))
-        dct_toc.extend(list(struct.unpack("{}{}H".format(e, segments - 1), f.read(2 * (segments - 1)))))
+        segments, = struct.unpack("{}H".format(ctx.e), f.read(2))
+        dct_toc.extend(list(struct.unpack("{}{}H".format(ctx.e, segments - 1), f.read(2 * (segments - 1)))))
     else:
         segments = 1
     if val_sz[1] == 4:
@@ -173,13 +173,21 @@ def decompress_dct (f, flag, num_indices):
             f.seek(1,1)
     float_table = [] # vector bases
     for _ in range(segments+1):
-        float_table.extend(read_vals (f, e, vec_len, val_sz))
+        float_table.extend(read_vals (f, ctx, vec_len, val_sz))
     dct_offsets = [(x*4) + f.tell() for x in dct_toc]
-    dct_segments = []
-    for i in range(segments):
-        f.seek(dct_offsets[i])
-        segment_len = (num_indices - (dct_max * i) - 1) if (i == segments - 1) else dct_max
-        dct_segments.append(read_dct_segment(f, base_all, vec_len, segment_len))
+    segment_lens = [(num_indices - (dct_max * i) - 1) if (i == segments - 1) else dct_max for i in range(segments)]
+    return({'base_all': base_all, 'vec_len': vec_len, 'float_table': float_table, 'offsets': dct_offsets,
+        'segment_lens': segment_lens})
+
+# dct_segments can be given if the segments have already been decoded (see decode_dct_entries_parallel())
+def decompress_dct (f, flag, num_indices, ctx, dct_segments = None):
+    layout = read_dct_layout(f, flag, num_indices, ctx)
+    vec_len, float_table, segments = layout['vec_len'], layout['float_table'], len(layout['offsets'])
+    if dct_segments == None:
+        dct_segments = []
+        for i in range(segments):
+            f.seek(layout['offsets'][i])
+            dct_segments.append(read_dct_segment(f, layout['base_all'], vec_len, layout['segment_lens'][i], ctx))
     vecs = []
     for i in range(num_indices):
         seg_i, ii = i // dct_max, i % dct_max
@@ -188,149 +196,324 @@ def decompress_dct (f, flag, num_indices):
         vecs.append([result_vec[i]+static_vec[i] for i in range(vec_len)])
     return(vecs)
     
-def read_vector_stream (f, num_blocks): 
-    # Table of contents for animation data (offset, size)
+# Table of contents for animation data (offset, size)
+def read_data_toc (f, num_blocks, ctx):
     data_toc = []
     for _ in range(num_blocks):
-        dat_offset = read_offset(f)
-        dat_size, = struct.unpack("{}{}".format(e, {4: "I", 8: "Q"}[addr_size]), f.read(addr_size))
+        dat_offset = read_offset(f, ctx)
+        dat_size, = ctx.read(f, 'address')
         data_toc.append([dat_offset, dat_size])
-    stream_data = []
-    for i in range(len(data_toc)):
-        start_loc = f.tell()
-        flag, = struct.unpack("{}I".format(e), f.read(4))
-        # Not sure if val_sz should be f/e or f/h but f/e results in some NaN so will use f/h for now -> h might be SNORM (h / (2^15-1))
-        type_, val_sz, header_type, vec_len = flag & 0xF, {0:('f',4),1:('h',2)}[flag >> 4 & 0x3], flag >> 8 & 0xF, flag >> 12 & 0xF
-        header = []
-        if header_type > 0:
-            count, = struct.unpack("{}I".format(e), f.read(4))
-            unk_float, = struct.unpack("{}f".format(e), f.read(4))
-            if header_type in [1,2,3]: # 0 is no header, and 4 seems to be blank
-                header_val_sz = {1:('f',4), 2:('H',2), 3:('B',1)}[header_type]
-                header = list(struct.unpack("{}{}{}".format(e, count, header_val_sz[0]), f.read(header_val_sz[1] * count)))
-                while f.tell() % 4:
-                    f.seek(1,1)
-            else: # 4 is blank header, or "indexed"
-                header = list(range(count))
-        try:
-            assert ((type_ == 3 and header_type == 0) or (type_ in [0,2,8,9] and header_type > 0))
-        except AssertionError:
-            input("Panic!  Type {} at {} has an unexpected header!".format(hex(flag), hex(start_loc)))
-            pass
-        if type_ in [0,2]: # 0: Linear, 2: Step
-            vecs = []
-            for _ in range(count):
-                vecs.append(read_vals (f, e, vec_len, val_sz))
-            stream_data.append({'flag': flag, 'unk_float': unk_float, 'header': header, 'vecs': vecs})
-        elif type_ == 3: # Single vector
-            stream_data.append({'flag': flag, 'vec': read_vals (f, e, vec_len, val_sz)})
-        elif type_ in [8,9]: # Vectors are compressed with discrete cosine transform (DCT)
-            vecs = decompress_dct(f, flag, count)
-            stream_data.append({'flag': flag, 'unk_float': unk_float, 'header': header, 'vecs': vecs})
-            f.seek(data_toc[i][0] + data_toc[i][1])
-        try:
-            assert data_toc[i][0] + data_toc[i][1] == f.tell()
-        except AssertionError:
-            input("Panic!  Entry {} type {} at {} was read incorrectly!".format(i, hex(flag), hex(data_toc[i][0])))
-            raise
-        while f.tell() % 4:
-            f.seek(1,1)
-    return(stream_data)
+    return(data_toc)
+
+# Reads the flag and the key times of entry i of the animation data, and leaves f at its values.
+# Returns (flag, count, unk_float, header).
+def read_entry_header (f, i, data_toc, ctx):
+    f.seek(data_toc[i][0])
+    flag, = struct.unpack("{}I".format(ctx.e), f.read(4))
+    header_type = flag >> 8 & 0xF
+    count, unk_float, header = 0, 0.0, []
+    if header_type > 0:
+        count, = struct.unpack("{}I".format(ctx.e), f.read(4))
+        unk_float, = struct.unpack("{}f".format(ctx.e), f.read(4))
+        if header_type in [1,2,3]: # 0 is no header, and 4 seems to be blank
+            header_val_sz = {1:('f',4), 2:('H',2), 3:('B',1)}[header_type]
+            header = list(struct.unpack("{}{}{}".format(ctx.e, count, header_val_sz[0]), f.read(header_val_sz[1] * count)))
+            while f.tell() % 4:
+                f.seek(1,1)
+        else: # 4 is blank header, or "indexed"
+            header = list(range(count))
+    return(flag, count, unk_float, header)
+
+# Decodes entry i of the animation data into an animation_channel (see lib_channelstore.py).  dct_segments are the
+# decoded segments of a DCT compressed entry, if they have already been decoded.
+def read_vector_entry (f, i, data_toc, ctx, interactive = True, dct_segments = None):
+    start_loc = data_toc[i][0]
+    flag, count, unk_float, header = read_entry_header(f, i, data_toc, ctx)
+    # Not sure if val_sz should be f/e or f/h but f/e results in some NaN so will use f/h for now -> h might be SNORM (h / (2^15-1))
+    type_, val_sz, header_type, vec_len = flag & 0xF, {0:('f',4),1:('h',2)}[flag >> 4 & 0x3], flag >> 8 & 0xF, flag >> 12 & 0xF
+    entry = animation_channel(flag, [])
+    try:
+        assert ((type_ == 3 and header_type == 0) or (type_ in [0,2,8,9] and header_type > 0))
+    except AssertionError:
+        pause_on_error("Panic!  Type {} at {} has an unexpected header!".format(hex(flag), hex(start_loc)),
+            interactive, action = "continue")
+        pass
+    if type_ in [0,2]: # 0: Linear, 2: Step
+        vecs = []
+        for _ in range(count):
+            vecs.append(read_vals (f, ctx, vec_len, val_sz))
+        entry = animation_channel(flag, vecs, header, unk_float)
+    elif type_ == 3: # Single vector
+        entry = animation_channel(flag, [read_vals (f, ctx, vec_len, val_sz)])
+    elif type_ in [8,9]: # Vectors are compressed with discrete cosine transform (DCT)
+        vecs = decompress_dct(f, flag, count, ctx, dct_segments)
+        entry = animation_channel(flag, vecs, header, unk_float)
+        f.seek(data_toc[i][0] + data_toc[i][1])
+    try:
+        assert data_toc[i][0] + data_toc[i][1] == f.tell()
+    except AssertionError:
+        pause_on_error("Panic!  Entry {} type {} at {} was read incorrectly!".format(i, hex(flag), hex(data_toc[i][0])),
+            interactive)
+        raise
+    return(entry)
+
+# A read-only file over a buffer (e.g. shared memory), which is not copied
+class buffer_file:
+    def __init__ (self, buffer):
+        self.buffer = buffer
+        self.position = 0
+    def seek (self, offset, whence = 0):
+        self.position = [0, self.position, len(self.buffer)][whence] + offset
+        return(self.position)
+    def tell (self):
+        return(self.position)
+    def read (self, size = -1):
+        end = len(self.buffer) if size < 0 else min(self.position + size, len(self.buffer))
+        data = bytes(self.buffer[self.position:end])
+        self.position = max(self.position, end)
+        return(data)
+
+# The animation file being decoded, in every worker process of decode_dct_entries_parallel()
+worker_animation = {}
+
+def open_worker_animation (shared_memory_name, ctx):
+    worker_animation['shm'] = shared_memory.SharedMemory(name = shared_memory_name)
+    worker_animation['f'] = buffer_file(worker_animation['shm'].buf)
+    worker_animation['ctx'] = ctx
+    return
+
+def decode_worker_segment (task):
+    offset, base_all, vec_len, segment_len = task
+    worker_animation['f'].seek(offset)
+    return(read_dct_segment(worker_animation['f'], base_all, vec_len, segment_len, worker_animation['ctx']))
+
+# Number of processes for decoding a file of this size in parallel, 1 if it should be decoded in this process
+def parallel_decode_workers (file_size, workers = 0):
+    if workers < 1:
+        workers = os.cpu_count() or 1
+    return(workers if file_size >= parallel_decode_min_size else 1)
+
+# Decodes the DCT compressed entries among indices (of data_toc) in worker processes (0 for one per CPU).  Every
+# channel, and every segment of a long (type 9) channel, is independent of the others, so each segment is a task
+# of its own.  The animation file (data) is placed in shared memory once for all the workers.  The segments are
+# put back together in order here.  Returns {index: entry}, as read_vector_entry() would.
+def decode_dct_entries_parallel (data, indices, data_toc, ctx, workers = 0, interactive = True):
+    f = io.BytesIO(data)
+    tasks, entry_tasks = [], {}
+    for i in indices:
+        flag, count, unk_float, header = read_entry_header(f, i, data_toc, ctx)
+        if flag & 0xF in [8,9]:
+            layout = read_dct_layout(f, flag, count, ctx)
+            entry_tasks[i] = (len(tasks), len(layout['offsets']))
+            tasks.extend([(layout['offsets'][j], layout['base_all'], layout['vec_len'], layout['segment_lens'][j])
+                for j in range(len(layout['offsets']))])
+    if len(tasks) == 0:
+        return({})
+    if os.name == 'posix': # The workers must share this process's tracker, or each one unlinks the block on exit
+        resource_tracker.ensure_running()
+    shm = shared_memory.SharedMemory(create = True, size = len(data))
+    try:
+        shm.buf[:len(data)] = data
+        workers = workers if workers > 0 else (os.cpu_count() or 1)
+        with ProcessPoolExecutor(max_workers = workers, initializer = open_worker_animation,
+                initargs = (shm.name, ctx)) as pool:
+            segments = list(pool.map(decode_worker_segment, tasks, chunksize = max(1, len(tasks) // (workers * 4))))
+    finally:
+        shm.close()
+        shm.unlink()
+    return({i: read_vector_entry(f, i, data_toc, ctx, interactive, segments[x:x + n])
+        for i, (x, n) in entry_tasks.items()})
+
+# workers decodes large files in parallel, see parallel_decode_workers()
+def read_vector_stream (f, num_blocks, ctx, interactive = True, workers = 0):
+    data_toc = read_data_toc(f, num_blocks, ctx)
+    f.seek(0)
+    data = f.read()
+    decoded = {}
+    if parallel_decode_workers(len(data), workers) > 1:
+        decoded = decode_dct_entries_parallel(data, range(len(data_toc)), data_toc, ctx,
+            parallel_decode_workers(len(data), workers), interactive)
+    f = io.BytesIO(data)
+    return([decoded[i] if i in decoded else read_vector_entry(f, i, data_toc, ctx, interactive)
+        for i in range(len(data_toc))])
 
-def read_tosamsb (animbin_file):
-    global addr_size, e, file_version
+# The animation data, with each entry only decoded when it is first used.  Indexing, len() and iteration work as
+# with the list from read_vector_stream(), so the glTF writer only decodes the channels that it exports.
+# With cache_folder ('' for the current folder), entries are taken from the decoded animation cache (see
+# lib_animcache.py) when they are in it, and save() adds the entries decoded since.  prefetch() decodes the entries
+# that will be used all at once, in parallel if the file is large (workers, see parallel_decode_workers()).
+class lazy_vector_stream:
+    def __init__ (self, f, num_blocks, ctx, interactive = True, cache_folder = None, workers = 0):
+        self.data_toc = read_data_toc(f, num_blocks, ctx)
+        f.seek(0)
+        self.f = io.BytesIO(f.read())
+        self.ctx = ctx
+        self.interactive = interactive
+        self.workers = workers
+        self.decoded, self.cache_file = {}, ''
+        if cache_folder != None:
+            self.cache_file = animation_cache_file(cache_folder, self.f.getvalue(), __name__)
+            self.decoded = read_cached_entries(self.cache_file)
+        self.cached = set(self.decoded)
+    def __len__ (self):
+        return(len(self.data_toc))
+    def __getitem__ (self, i):
+        if not i in self.decoded:
+            self.decoded[i] = read_vector_entry(self.f, i, self.data_toc, self.ctx, self.interactive)
+        return(self.decoded[i])
+    def __iter__ (self):
+        for i in range(len(self.data_toc)):
+            yield self[i]
+    def prefetch (self, indices):
+        missing = sorted(set([x for x in indices if not x in self.decoded]))
+        workers = parallel_decode_workers(len(self.f.getbuffer()), self.workers)
+        if workers > 1 and len(missing) > 0:
+            self.decoded.update(decode_dct_entries_parallel(self.f.getvalue(), missing, self.data_toc, self.ctx,
+                workers, self.interactive))
+        return
+    def save (self):
+        if self.cache_file != '' and len(set(self.decoded) - self.cached) > 0:
+            write_cached_entries(self.cache_file, self.decoded)
+            self.cached = set(self.decoded)
+
+# Reads the headers and the target tables, and leaves f at the table of contents of the animation data.
+# Returns the data read so far, the format context and the number of animation data blocks, or False.
+def read_tosamsb_tables (f, animbin_file):
     data = {}
-    with open(animbin_file, 'rb') as f:
-        print("Processing {}...".format(animbin_file))
+    ctx = FormatContext()
+    explore = struct.unpack("<4I", f.read(16))
+    if explore[1] > 0:
+        if explore[1] < 0x10000000:
+            ctx.e = '>'
+        if explore[3] > 0:
+            ctx.addr_size = 4
+    f.seek(0)
+    data['file_type'] = {'address_size': ctx.addr_size, 'endianness': ctx.e}
+    data['header'] = list(ctx.read(f, 'animation_header'))
+    if ctx.addr_size == 8:
+        data['header'].append(struct.unpack("{}I".format(ctx.e), f.read(4))[0]) # Probably 64-bit alignment
+    offset1 = read_offset(f, ctx) # Offset to the first data block (tables)
+    if offset1 == 0x20:
+        ctx.file_version = 0
+    data['file_type']['version'] = ctx.file_version
+    hash_table_present = True
+    if ctx.file_version == 0:
+        temp_offset = f.tell()
         explore = struct.unpack("<4I", f.read(16))
-        if explore[1] > 0:
-            if explore[1] < 0x10000000:
-                set_endianness('>')
-            if explore[3] > 0:
-                set_address_size(4)
-        f.seek(0)
-        data['file_type'] = {'address_size': addr_size, 'endianness': e}
-        data['header'] = list(struct.unpack("{}I2f".format(e), f.read(12)))
-        if addr_size == 8:
-            data['header'].append(struct.unpack("{}I".format(e), f.read(4))[0]) # Probably 64-bit alignment
-        offset1 = read_offset(f) # Offset to the first data block (tables)
-        if offset1 == 0x20:
-            set_file_version(0)
-        data['file_type']['version'] = file_version
-        hash_table_present = True
-        if file_version == 0:
-            temp_offset = f.tell()
-            explore = struct.unpack("<4I", f.read(16))
-            if explore[3] == 0:
-                hash_table_present = False
-            f.seek(temp_offset)
-        count1a, = struct.unpack("{}{}".format(e, {4: "I", 8: "Q"}[addr_size]), f.read(addr_size)) # Number of data blocks
-        if hash_table_present == True:
-            count1b, = struct.unpack("{}{}".format(e, {4: "I", 8: "Q"}[addr_size]), f.read(addr_size)) # Number of hashes
-        if count1a == 0:
-            print("Empty file, skipping...")
-            return
-        offset2 = read_offset(f) # Offset to the second data block (actual animation data)
-        count2, = struct.unpack("{}{}".format(e, {4: "I", 8: "Q"}[addr_size]), f.read(addr_size)) # Number of data blocks, same as count1a
-        if hash_table_present == False:
-            f.seek(4,1) # Padding
-        if file_version == 1:
-            data['header2'] = struct.unpack("{}2{}f".format(e, {4: "I", 8: "Q"}[addr_size]), f.read(addr_size * 2 + 4)) # Berseria only??
-        try:
-            if hash_table_present == True:
-                assert offset1 + ((count1b + 1) * addr_size) + (count1a * 16) + (4 if file_version == 1 else 0) == offset2
-            else:
-                assert offset1 + (count1a * 16) + (4 if file_version == 1 else 0) == offset2
-        except AssertionError:
-            print("Error, {} not in the expected binary format!  Skipping...".format(animbin_file))
-            return
-        # Hash table
+        if explore[3] == 0:
+            hash_table_present = False
+        f.seek(temp_offset)
+    count1a, = ctx.read(f, 'address') # Number of data blocks
+    if hash_table_present == True:
+        count1b, = ctx.read(f, 'address') # Number of hashes
+    if count1a == 0:
+        print("Empty file, skipping...")
+        return False
+    offset2 = read_offset(f, ctx) # Offset to the second data block (actual animation data)
+    count2, = ctx.read(f, 'address') # Number of data blocks, same as count1a
+    if hash_table_present == False:
+        f.seek(4,1) # Padding
+    if ctx.file_version == 1:
+        data['header2'] = ctx.read(f, 'animation_header2') # Berseria only??
+    try:
         if hash_table_present == True:
-            data['hash_table'] = [] # Will be rebuilt when offsets known
-            temp_hash_table = [read_offset(f) for _ in range(count1b)]
-            offset2b = read_offset(f) # same as offset2
-            if file_version == 1:
-                f.seek(4,1) # Dunno
-        # Animation target data
-        data['target_table'] = []
-        data['decoded_target_table'] = []
-        target_indices = {}
-        for _ in range(count1a):
-            target_indices[f.tell()] = len(target_indices)
-            data['target_table'].append(struct.unpack("{}Q2I".format(e), f.read(16)))
-            decode = decode_target_flag(data['target_table'][-1][0])
-            decode['vec_index'] = data['target_table'][-1][1]
-            data['decoded_target_table'].append(decode)
+            assert offset1 + ((count1b + 1) * ctx.addr_size) + (count1a * 16) + (4 if ctx.file_version == 1 else 0) == offset2
+        else:
+            assert offset1 + (count1a * 16) + (4 if ctx.file_version == 1 else 0) == offset2
+    except AssertionError:
+        print("Error, {} not in the expected binary format!  Skipping...".format(animbin_file))
+        return False
+    # Hash table
+    if hash_table_present == True:
+        data['hash_table'] = [] # Will be rebuilt when offsets known
+        temp_hash_table = [read_offset(f, ctx) for _ in range(count1b)]
+        offset2b = read_offset(f, ctx) # same as offset2
+        if ctx.file_version == 1:
+            f.seek(4,1) # Dunno
+    # Animation target data
+    data['target_table'] = []
+    data['decoded_target_table'] = []
+    target_indices = {}
+    for _ in range(count1a):
         target_indices[f.tell()] = len(target_indices)
+        data['target_table'].append(ctx.read(f, 'target'))
+        decode = decode_target_flag(data['target_table'][-1][0])
+        decode['vec_index'] = data['target_table'][-1][1]
+        data['decoded_target_table'].append(decode)
+    target_indices[f.tell()] = len(target_indices)
+    data['targets'] = target_view(data['target_table'])
+    if hash_table_present == True:
+        data['hash_table'] = [target_indices[x] for x in temp_hash_table]
+    try:
         if hash_table_present == True:
-            data['hash_table'] = [target_indices[x] for x in temp_hash_table]
-        try:
-            if hash_table_present == True:
-                assert f.tell() == offset2 == offset2b
-            else:
-                assert f.tell() == offset2
-        except AssertionError:
-            print("Error, offsets do not match!  Will attempt to proceed.")
-            pass
+            assert f.tell() == offset2 == offset2b
+        else:
+            assert f.tell() == offset2
+    except AssertionError:
+        print("Error, offsets do not match!  Will attempt to proceed.")
+        pass
+    return(data, ctx, count2)
+
+# data_stream is a list of animation_channel and targets is the target table as a structured array, see
+# lib_channelstore.py.  With lazy, data_stream is a lazy_vector_stream and entries are only decoded when used.
+# Lazy streams of plain files also use the decoded animation cache, unless use_cache (by default
+# use_animation_cache) is False; call save_decoded_animation() once the channels have been used.  Large files are
+# decoded by decode_workers processes (0 for one per CPU), see parallel_decode_workers().
+def read_tosamsb (animbin_file, interactive = True, source = local_files, lazy = False, use_cache = None,
+        decode_workers = 0):
+    with source.open(animbin_file) as f:
+        print("Processing {}...".format(animbin_file))
+        tables = read_tosamsb_tables(f, animbin_file)
+        if tables == False:
+            return
+        data, ctx, count2 = tables
         # Animation data
-        data['data_stream'] = read_vector_stream(f, count2)
+        if lazy == True:
+            cache_folder = None
+            if (use_animation_cache if use_cache == None else use_cache) == True and source.local_path(animbin_file) != '':
+                cache_folder = os.path.dirname(source.local_path(animbin_file))
+            data['data_stream'] = lazy_vector_stream(f, count2, ctx, interactive, cache_folder, decode_workers)
+        else:
+            data['data_stream'] = read_vector_stream(f, count2, ctx, interactive, decode_workers)
     return(data)
 
-def write_glTF (ani_data, skel_struct, basename, write_glb = True):
-    gltf_data = {}
-    gltf_data['asset'] = { 'version': '2.0' }
-    gltf_data['accessors'] = []
-    gltf_data['animations'] = [{ 'channels': [], 'samplers': [] }]
-    gltf_data['bufferViews'] = []
-    gltf_data['buffers'] = []
-    gltf_data['nodes'] = []
-    gltf_data['scenes'] = [{}]
-    gltf_data['scenes'][0]['nodes'] = [0]
-    gltf_data['scene'] = 0
-    gltf_data['skins'] = []
-    giant_buffer = bytes()
-    buffer_view = 0
-    # Nodes
+# Stores the entries that were decoded from the file into the decoded animation cache
+def save_decoded_animation (ani_data):
+    if ani_data != None and isinstance(ani_data['data_stream'], lazy_vector_stream):
+        ani_data['data_stream'].save()
+    return
+
+# Estimates the work of decoding an animation from the data table of contents and the channel headers, without
+# decoding anything.  DCT channels cost much more per key than plain ones, and each DCT segment has a fixed cost
+# (the DCT table).  The unit is arbitrary, see lib_scheduler.py.
+def estimate_tosamsb_cost (animbin_file, source = local_files):
+    cost = 0
+    with source.open(animbin_file) as f:
+        tables = read_tosamsb_tables(f, animbin_file)
+        if tables == False:
+            return 0
+        data, ctx, count2 = tables
+        for dat_offset, _ in read_data_toc(f, count2, ctx):
+            f.seek(dat_offset)
+            flag, = struct.unpack("{}I".format(ctx.e), f.read(4))
+            type_, header_type, vec_len = flag & 0xF, flag >> 8 & 0xF, flag >> 12 & 0xF
+            count = struct.unpack("{}I".format(ctx.e), f.read(4))[0] if header_type > 0 else 1
+            if type_ in [8,9]:
+                segments = 1
+                if type_ == 9:
+                    f.seek(4 + (count * {1:4, 2:2, 3:1}.get(header_type, 0)), 1) # unk_float and header
+                    while f.tell() % 4:
+                        f.seek(1,1)
+                    f.seek(4, 1) # base_all
+                    segments, = struct.unpack("{}H".format(ctx.e), f.read(2))
+                cost += (segments * 3000) + (count * vec_len * 100)
+            else:
+                cost += count * vec_len * 2
+    return(cost)
+
+# The glTF nodes of the bind pose of a skeleton
+def make_skeleton_nodes (skel_struct):
+    nodes = []
     for i in range(len(skel_struct)):
         t,r,s = convert_matrix_to_trs(skel_struct[i]['matrix'])
         g_node = {'children': skel_struct[i]['children'], 'name': skel_struct[i]['name']}
@@ -340,131 +523,327 @@ def write_glTF (ani_data, skel_struct, basename, write_glb = True):
             g_node['rotation'] = r
         if not s == [1.0, 1.0, 1.0]:
             g_node['scale'] = s
-        gltf_data['nodes'].append(g_node)
-    for i in range(len(gltf_data['nodes'])):
-        if len(gltf_data['nodes'][i]['children']) == 0 and i > 0:
-            del(gltf_data['nodes'][i]['children'])
-    if len(gltf_data['nodes']) == 0:
-        gltf_data['nodes'].append({'children': [], 'name': 'root'})
-    # Animations
-    node_dict = {gltf_data['nodes'][j]['name']:j for j in range(len(gltf_data['nodes']))}
+        nodes.append(g_node)
+    for i in range(len(nodes)):
+        if len(nodes[i]['children']) == 0 and i > 0:
+            del(nodes[i]['children'])
+    if len(nodes) == 0:
+        nodes.append({'children': [], 'name': 'root'})
+    return(nodes)
+
+# The glTF channels of an animation, as a list of {'node', 'path', 'input', 'output', 'min', 'max', 'count',
+# 'original_count'} with the key times and values as float32 bytes.  skeleton_nodes are from make_skeleton_nodes(),
+# they are not modified.  tolerances ({path: tolerance}, see lib_keyframes.py) removes the keys that interpolation
+# can rebuild, original_count is the number of keys before that.  quantize stores rotations as normalized shorts
+# instead (glTF allows this for rotations without any extension), 'component_type' is the glTF type of the output.
+def make_animation_channels (ani_data, skel_struct, skeleton_nodes, tolerances = None, quantize = False):
+    node_dict = {skeleton_nodes[j]['name']:j for j in range(len(skeleton_nodes))}
     bone_id_to_name = {x['ani_id']:x['name'] for x in skel_struct}
     valid_bones = [skel_struct[i]['ani_id'] for i in range(len(skel_struct)) if skel_struct[i]['name'] in node_dict]
-    ani_list = [x for x in ani_data['decoded_target_table'] if x['target'] in valid_bones and x['type'] in [0x00003, 0x10014, 0x20003]]
-    for i in range(len(ani_list)):
-        vec_channel = ani_data['data_stream'][ani_list[i]['vec_index']]
-        outputs_raw = [vec_channel['vec']] if 'vec' in vec_channel else vec_channel['vecs']
-        outputs = []
-        for j in range(len(outputs_raw)):
-            if ani_list[i]['type'] == 0x20003:
-                if 'translation' in gltf_data['nodes'][node_dict[bone_id_to_name[ani_list[i]['target']]]]:
-                    new_ = (numpy.array(outputs_raw[j])
-                        + numpy.array(gltf_data['nodes'][node_dict[bone_id_to_name[ani_list[i]['target']]]]['translation']))
-                    outputs.append(new_.tolist())
-                else:
-                    outputs.append(outputs_raw[j])
-            if ani_list[i]['type'] == 0x10014:
-                if 'rotation' in gltf_data['nodes'][node_dict[bone_id_to_name[ani_list[i]['target']]]]:
-                    q1 = gltf_data['nodes'][node_dict[bone_id_to_name[ani_list[i]['target']]]]['rotation']
-                    qp = Quaternion([q1[3]] + q1[0:3])
-                    qc = Quaternion([outputs_raw[j][3]] + outputs_raw[j][0:3])
-                    new_ = list(qp * qc)
-                    outputs.append(new_[1:]+[new_[0]])
-                else:
-                    outputs.append(outputs_raw[j])
-            if ani_list[i]['type'] == 0x00003:
-                if 'scale' in gltf_data['nodes'][node_dict[bone_id_to_name[ani_list[i]['target']]]]:
-                    new_ = (numpy.array(outputs_raw[j])
-                        * numpy.array(gltf_data['nodes'][node_dict[bone_id_to_name[ani_list[i]['target']]]]['scale']))
-                    outputs.append(new_.tolist())
-                else:
-                    outputs.append(outputs_raw[j])
-        if 'header' in vec_channel:
-            inputs = [x / ani_fps for x in vec_channel['header']]
-        else:
-            inputs = [0.0]
-        sampler = { 'input': len(gltf_data['accessors']), 'interpolation': 'LINEAR', 'output':  len(gltf_data['accessors'])+1 }
-        channel = { 'sampler': len(gltf_data['animations'][0]['samplers']),\
-            'target': { 'node': node_dict[bone_id_to_name[ani_list[i]['target']]],
-                'path': {0x20003:'translation', 0x10014:'rotation', 0x00003:'scale'}[ani_list[i]['type']] } }
-        gltf_data['accessors'].append({"bufferView" : len(gltf_data['bufferViews']),\
-            "componentType": 5126,\
-            "count": len(inputs),\
-            "type": 'SCALAR',\
-            "max": [max(inputs)], "min": [min(inputs)]})
-        input_buffer = numpy.array(inputs,dtype='float32').tobytes()
-        gltf_data['bufferViews'].append({"buffer": 0,\
-            "byteOffset": len(giant_buffer),\
-            "byteLength": len(input_buffer)})                    
-        giant_buffer += input_buffer
-        gltf_data['accessors'].append({"bufferView" : len(gltf_data['bufferViews']),\
-            "componentType": 5126,\
-            "count": len(outputs),\
-            "type": {0x20003:'VEC3', 0x10014:'VEC4', 0x00003:'VEC3'}[ani_list[i]['type']]})
-        output_buffer = numpy.array(outputs,dtype='float32').tobytes()
-        gltf_data['bufferViews'].append({"buffer": 0,\
-            "byteOffset": len(giant_buffer),\
-            "byteLength": len(output_buffer)})                    
-        giant_buffer +=output_buffer
-        gltf_data['animations'][0]['channels'].append(channel)
-        gltf_data['animations'][0]['samplers'].append(sampler)
+    targets = ani_data['targets']
+    ani_list = numpy.flatnonzero(numpy.isin(targets['target'], valid_bones)
+        & numpy.isin(targets['type'], [0x00003, 0x10014, 0x20003])).tolist()
+    if isinstance(ani_data['data_stream'], lazy_vector_stream):
+        ani_data['data_stream'].prefetch(targets['vec_index'][ani_list].tolist())
+    channels = []
+    for i in ani_list:
+        vec_channel = ani_data['data_stream'][int(targets['vec_index'][i])]
+        node_index = node_dict[bone_id_to_name[int(targets['target'][i])]]
+        node = skeleton_nodes[node_index]
+        path = {0x20003:'translation', 0x10014:'rotation', 0x00003:'scale'}[int(targets['type'][i])]
+        outputs = vec_channel.values.astype('float64')
+        if path == 'translation' and 'translation' in node:
+            outputs = outputs + numpy.array(node['translation'])
+        elif path == 'rotation' and 'rotation' in node:
+            outputs = quaternion_multiply(numpy.array(node['rotation'], dtype = 'float64'), outputs.reshape(-1,4))
+        elif path == 'scale' and 'scale' in node:
+            outputs = outputs * numpy.array(node['scale'])
+        if vec_channel.type_ != 3:
+            inputs = vec_channel.keys.astype('float64') / ani_fps
+        else: # Single vector
+            inputs = numpy.zeros(1)
+        original_count = len(outputs)
+        if tolerances != None and path in tolerances and len(inputs) == len(outputs):
+            keep = reduce_keyframes(inputs, outputs, tolerances[path], rotation = (path == 'rotation'))
+            inputs, outputs = inputs[keep], outputs[keep]
+        component_type, output = 5126, outputs.astype('float32').tobytes()
+        if quantize == True and path == 'rotation':
+            rotations = outputs / numpy.linalg.norm(outputs, axis = 1)[:,None]
+            component_type, output = 5122, numpy.round(rotations * 32767).astype('<i2').tobytes()
+        channels.append({'node': node_index, 'path': path, 'input': inputs.astype('float32').tobytes(),
+            'min': float(inputs.min()), 'max': float(inputs.max()), 'output': output,
+            'component_type': component_type, 'count': len(outputs), 'original_count': original_count})
+    return(channels)
+
+def print_key_reduction (name, channels):
+    before, after = sum([x['original_count'] for x in channels]), sum([x['count'] for x in channels])
+    print("{0}: {1} keys reduced to {2} ({3:.1f}%).".format(name, before, after,
+        100.0 * after / before if before > 0 else 100.0))
+    return
+
+# A glTF with the nodes and the skin of a skeleton, and no animations yet
+def make_animation_gltf (skel_struct, skeleton_nodes = None):
+    gltf_data = {}
+    gltf_data['asset'] = { 'version': '2.0' }
+    gltf_data['accessors'] = []
+    gltf_data['animations'] = []
+    gltf_data['bufferViews'] = []
+    gltf_data['buffers'] = []
+    gltf_data['nodes'] = skeleton_nodes if skeleton_nodes != None else make_skeleton_nodes(skel_struct)
+    gltf_data['scenes'] = [{}]
+    gltf_data['scenes'][0]['nodes'] = [0]
+    gltf_data['scene'] = 0
+    gltf_data['skins'] = []
     skin = {}
     skin['skeleton'] = 0
     joints = [i for i in range(len(gltf_data['nodes'])) if i != 0]
     if len(joints) > 0:
         skin['joints'] = joints
     gltf_data['skins'].append(skin)
-    gltf_data['buffers'].append({"byteLength": len(giant_buffer)})
+    return(gltf_data)
+
+# Adds one animation, from make_animation_channels(), to the glTF.  Key times are only stored once:
+# time_accessors maps the key times already in the glTF to their accessor, and is shared by every animation of
+# the glTF.  buffer_chunks is the list of byte strings of the buffer.
+def add_gltf_animation (gltf_data, buffer_chunks, channels, time_accessors, name = ''):
+    animation = { 'channels': [], 'samplers': [] }
+    if name != '':
+        animation['name'] = name
+    buffer_length = sum([len(x) for x in buffer_chunks])
+    for i in range(len(channels)):
+        if not channels[i]['input'] in time_accessors:
+            time_accessors[channels[i]['input']] = len(gltf_data['accessors'])
+            gltf_data['accessors'].append({"bufferView" : len(gltf_data['bufferViews']),\
+                "componentType": 5126,\
+                "count": len(channels[i]['input']) // 4,\
+                "type": 'SCALAR',\
+                "max": [channels[i]['max']], "min": [channels[i]['min']]})
+            gltf_data['bufferViews'].append({"buffer": 0,\
+                "byteOffset": buffer_length,\
+                "byteLength": len(channels[i]['input'])})
+            buffer_chunks.append(channels[i]['input'])
+            buffer_length += len(channels[i]['input'])
+        sampler = { 'input': time_accessors[channels[i]['input']], 'interpolation': 'LINEAR', 'output': len(gltf_data['accessors']) }
+        channel = { 'sampler': len(animation['samplers']),\
+            'target': { 'node': channels[i]['node'], 'path': channels[i]['path'] } }
+        gltf_data['accessors'].append({"bufferView" : len(gltf_data['bufferViews']),\
+            "componentType": channels[i]['component_type'],\
+            "count": channels[i]['count'],\
+            "type": {'translation':'VEC3', 'rotation':'VEC4', 'scale':'VEC3'}[channels[i]['path']]})
+        if channels[i]['component_type'] != 5126:
+            gltf_data['accessors'][-1]['normalized'] = True
+        gltf_data['bufferViews'].append({"buffer": 0,\
+            "byteOffset": buffer_length,\
+            "byteLength": len(channels[i]['output'])})
+        buffer_chunks.append(channels[i]['output'])
+        buffer_length += len(channels[i]['output'])
+        animation['channels'].append(channel)
+        animation['samplers'].append(sampler)
+    gltf_data['animations'].append(animation)
+    return
+
+def write_animation_gltf (gltf_data, buffer_chunks, basename, write_glb = True, sink = local_output):
+    buffer_length = sum([len(x) for x in buffer_chunks])
+    gltf_data['buffers'].append({"byteLength": buffer_length})
     if write_glb == True:
-        with open(basename+'.glb', 'wb') as f:
+        with sink.open(basename+'.glb') as f:
             jsondata = json.dumps(gltf_data).encode('utf-8')
             jsondata += b' ' * (4 - len(jsondata) % 4)
-            f.write(struct.pack('<III', 1179937895, 2, 12 + 8 + len(jsondata) + 8 + len(giant_buffer)))
+            f.write(struct.pack('<III', 1179937895, 2, 12 + 8 + len(jsondata) + 8 + buffer_length))
             f.write(struct.pack('<II', len(jsondata), 1313821514))
             f.write(jsondata)
-            f.write(struct.pack('<II', len(giant_buffer), 5130562))
-            f.write(giant_buffer)
+            f.write(struct.pack('<II', buffer_length, 5130562))
+            for chunk in buffer_chunks:
+                f.write(chunk)
     else:
         gltf_data['buffers'][0]["uri"] = basename+'.bin'
-        with open(basename+'.bin', 'wb') as f:
-            f.write(giant_buffer)
-        with open(basename+'.gltf', 'wb') as f:
-            f.write(json.dumps(gltf_data, indent=4).encode("utf-8"))
+        sink.write(basename+'.bin', b''.join(buffer_chunks))
+        sink.write(basename+'.gltf', json.dumps(gltf_data, indent=4).encode("utf-8"))
+    return
 
-def process_tosamsb (animbin_file, overwrite = False, write_glb = True, dump_extra_animation_data = False):
+# skeleton_nodes can be given if make_skeleton_nodes() has already been run on skel_struct, they are not modified
+# tolerances reduces the keys and quantize stores rotations as shorts, see make_animation_channels().
+def write_glTF (ani_data, skel_struct, basename, write_glb = True, sink = local_output, skeleton_nodes = None,
+        tolerances = None, quantize = False):
+    if skeleton_nodes == None:
+        skeleton_nodes = make_skeleton_nodes(skel_struct)
+    gltf_data, buffer_chunks = make_animation_gltf(skel_struct, skeleton_nodes), []
+    channels = make_animation_channels(ani_data, skel_struct, skeleton_nodes, tolerances, quantize)
+    if tolerances != None:
+        print_key_reduction(basename, channels)
+    add_gltf_animation(gltf_data, buffer_chunks, channels, {})
+    write_animation_gltf(gltf_data, buffer_chunks, basename, write_glb, sink)
+
+# Dumped skeletons (*full_skeleton.json) are preferred over binary skeletons (.TOMDLB_D), searched for in the
+# folder of the animation unless skeleton_file is given (which can also be a plain file outside of source)
+def read_skeleton (search_folder = '', skeleton_file = '', interactive = True, source = local_files):
+    if skeleton_file != '' and not source.exists(skeleton_file):
+        source = local_files
+    if skeleton_file == '':
+        full_skels = source.glob(os.path.join(search_folder, '*full_skeleton.json'))
+        skeleton_file = choose_from_list(full_skels, "Use which skeleton?", interactive = interactive)
+    if skeleton_file[-5:].lower() == '.json':
+        if source.local_path(skeleton_file) != '':
+            return(read_struct_from_json(source.local_path(skeleton_file), interactive = interactive))
+        with source.open(skeleton_file) as f:
+            return(json.loads(f.read()))
+    elif skeleton_file == '':
+        skeleton_file = find_primary_skeleton([], search_folder, interactive, source)
+    return(combine_skeletons (skeleton_file, [], source))
+
+# skel_struct (and skeleton_nodes, see write_glTF()) can be given if the skeleton has already been read, they are
+# not modified.  source is where the animation and skeleton are read from (see lib_filesource.py), the glTF is
+# written with the same folders to sink (see lib_filesink.py).  tolerances reduces the keys, see lib_keyframes.py,
+# and quantize stores rotations as shorts, see make_animation_channels().  decode_workers is the number of processes
+# that decode a large file (0 for one per CPU), see read_tosamsb().  dump_format is 'json', or 'npz' for the binary
+# dump of lib_channelstore.py.
+def process_tosamsb (animbin_file, overwrite = False, write_glb = True, dump_extra_animation_data = False,
+        skeleton_file = '', interactive = True, skel_struct = None, source = local_files, sink = local_output,
+        skeleton_nodes = None, tolerances = None, quantize = False, decode_workers = 0, dump_format = 'json'):
     basename = ".".join(animbin_file.split(".")[:-1])
-    ani_data = read_tosamsb (animbin_file)
+    # Only the channels that end up in the glTF are decoded, unless everything is dumped
+    ani_data = read_tosamsb (animbin_file, interactive, source, lazy = not dump_extra_animation_data,
+        decode_workers = decode_workers)
     if dump_extra_animation_data == True:
-        open(basename + "_ani_data.json", 'wb').write(json.dumps(ani_data, indent = 4).encode())
-    try:
-        full_skels = [os.path.basename(x) for x in glob.glob('*full_skeleton.json')]
-        if len(full_skels) > 1:
-            match = ''
-            print("Multiple skeleton json files found, please choose one.")
-            for i in range(len(full_skels)):
-                print("{0}. {1}".format(i+1, full_skels[i]))
-            while match == '':
-                raw_input = input("Use which skeleton? ")
-                if raw_input.isnumeric() and int(raw_input)-1 in range(len(full_skels)):
-                    match = full_skels[int(raw_input)-1]
-                else:
-                    print("Invalid entry!")
-        elif len(full_skels) == 1:
-            match = full_skels[0]
+        if dump_format == 'npz':
+            with sink.open(basename + "_ani_data.npz") as f:
+                write_animation_dump(f, ani_data, os.path.basename(animbin_file))
         else:
-            match = ''
-        if not match == '':
-            skel_struct = read_struct_from_json(match)
-        else:
-            skel_struct = combine_skeletons (find_primary_skeleton([]),[])
+            sink.write(basename + "_ani_data.json", animation_data_json(ani_data))
+    try:
+        if skel_struct == None:
+            skel_struct = read_skeleton (os.path.dirname(animbin_file), skeleton_file, interactive, source)
     except FileNotFoundError:
-        input("No compatible skeleton file found!  Press Enter to quit.")
+        pause_on_error("No compatible skeleton file found!", interactive, action = "quit")
         raise
-    if (os.path.exists(basename + '.gltf') or os.path.exists(basename + '.glb')) and (overwrite == False):
-        if str(input(basename + ".glb/.gltf exists! Overwrite? (y/N) ")).lower()[0:1] == 'y':
-            overwrite = True
-    if (overwrite == True) or not (os.path.exists(basename + '.gltf') or os.path.exists(basename + '.glb')):
-        write_glTF(ani_data, skel_struct, basename, write_glb = write_glb)
+    if (sink.exists(basename + '.gltf') or sink.exists(basename + '.glb')):
+        overwrite = confirm_overwrite(basename + ".glb/.gltf", overwrite, interactive)
+    if (overwrite == True) or not (sink.exists(basename + '.gltf') or sink.exists(basename + '.glb')):
+        write_glTF(ani_data, skel_struct, basename, write_glb = write_glb, sink = sink, skeleton_nodes = skeleton_nodes,
+            tolerances = tolerances, quantize = quantize)
+        save_decoded_animation(ani_data)
+
+# Skeletons shared by a batch of animations, by folder of the animation: (skel_struct, skeleton_nodes).  Set in
+# every worker process before its first animation (see process_tosamsbs()).
+batch_skeletons = {}
+
+def set_batch_skeletons (skeletons):
+    batch_skeletons.clear()
+    batch_skeletons.update(skeletons)
+    return
+
+# Reads the skeleton of each folder of animbin_files once, or skeleton_file once for all of them.  Folders without
+# a usable skeleton are left out, and their animations report the problem themselves.
+def resolve_batch_skeletons (animbin_files, skeleton_file = '', interactive = True, source = local_files):
+    folders = sorted(set([os.path.dirname(x) for x in animbin_files]))
+    if skeleton_file != '':
+        skel_struct = read_skeleton('', skeleton_file, interactive, source)
+        skeleton = (skel_struct, make_skeleton_nodes(skel_struct))
+        return({x: skeleton for x in folders})
+    skeletons = {}
+    for folder in folders:
+        try:
+            skel_struct = read_skeleton(folder, '', interactive, source)
+        except (FileNotFoundError, ValueError): # No skeleton, or several to choose from
+            continue
+        skeletons[folder] = (skel_struct, make_skeleton_nodes(skel_struct))
+    return(skeletons)
+
+# process_tosamsb() with the skeleton from batch_skeletons
+def process_batch_tosamsb (animbin_file, **kwargs):
+    skel_struct, skeleton_nodes = batch_skeletons.get(os.path.dirname(animbin_file), (None, None))
+    return(process_tosamsb(animbin_file, skel_struct = skel_struct, skeleton_nodes = skeleton_nodes, **kwargs))
+
+# Exports a batch of animations.  The skeletons are read first, once (so that any question is only asked once),
+# and the animations are then exported by workers processes (0 for one per CPU), longest first, see
+# lib_scheduler.py.  With a single process, each large animation is decoded in parallel instead.  Returns the
+# number of files that failed.
+def process_tosamsbs (animbin_files, overwrite = False, write_glb = True, dump_extra_animation_data = False,
+        skeleton_file = '', interactive = True, workers = 1, source = local_files, sink = local_output, tolerances = None,
+        quantize = False, dump_format = 'json'):
+    skeletons = resolve_batch_skeletons(animbin_files, skeleton_file, interactive, source)
+    function = functools.partial(process_batch_tosamsb, overwrite = overwrite, write_glb = write_glb,
+        dump_extra_animation_data = dump_extra_animation_data, skeleton_file = skeleton_file,
+        interactive = interactive and workers == 1, source = source, sink = sink, tolerances = tolerances,
+        quantize = quantize, decode_workers = 0 if workers == 1 else 1, dump_format = dump_format)
+    if workers == 1:
+        set_batch_skeletons(skeletons)
+        try:
+            for animbin_file in animbin_files:
+                function(animbin_file)
+        finally:
+            set_batch_skeletons({})
+        return(0)
+    import lib_scheduler
+    jobs = []
+    for animbin_file in animbin_files:
+        try:
+            cost = estimate_tosamsb_cost(animbin_file, source)
+        except Exception: # The job itself will report the problem
+            cost = 0
+        jobs.append({'name': animbin_file, 'function': function, 'args': (animbin_file,), 'cost': cost})
+    return(lib_scheduler.run_longest_first(jobs, workers, label = 'export-animation',
+        initializer = set_batch_skeletons, initargs = (skeletons,)))
+
+# Name of the glTF with all the animations of a folder, e.g. chara/CHR/CHR_animations
+def combined_animation_basename (folder):
+    return(os.path.join(folder, os.path.basename(os.path.abspath(folder if folder != '' else '.')) + '_animations'))
+
+# make_animation_channels() with the skeleton from batch_skeletons, runs in the worker processes
+def read_batch_animation_channels (animbin_file, interactive = False, source = local_files, tolerances = None,
+        quantize = False, decode_workers = 1):
+    skel_struct, skeleton_nodes = batch_skeletons[os.path.dirname(animbin_file)]
+    ani_data = read_tosamsb(animbin_file, interactive, source, lazy = True, decode_workers = decode_workers)
+    if ani_data == None: # Empty file
+        return([])
+    channels = make_animation_channels(ani_data, skel_struct, skeleton_nodes, tolerances, quantize)
+    save_decoded_animation(ani_data)
+    return(channels)
+
+# Exports the animations of each folder into a single glTF (see combined_animation_basename()), with one copy of
+# the skeleton and one animation per file, named after the file.  Key times are stored once for all the
+# animations.  With workers other than 1, the animations are decoded by that many processes (0 for one per CPU),
+# and the glTF is put together in this one.  Returns the names of the glTF files written.
+def process_tosamsbs_combined (animbin_files, overwrite = False, write_glb = True, skeleton_file = '',
+        interactive = True, workers = 1, source = local_files, sink = local_output, tolerances = None, quantize = False):
+    skeletons = resolve_batch_skeletons(animbin_files, skeleton_file, interactive, source)
+    folders = sorted(set([os.path.dirname(x) for x in animbin_files]))
+    for folder in folders:
+        if not folder in skeletons: # Read again to report the problem
+            skel_struct = read_skeleton(folder, '', interactive, source)
+            skeletons[folder] = (skel_struct, make_skeleton_nodes(skel_struct))
+    basenames = {x: combined_animation_basename(x) for x in folders}
+    for folder in folders:
+        if (sink.exists(basenames[folder] + '.gltf') or sink.exists(basenames[folder] + '.glb')):
+            if confirm_overwrite(basenames[folder] + ".glb/.gltf", overwrite, interactive) == False:
+                del(basenames[folder])
+    animbin_files = [x for x in animbin_files if os.path.dirname(x) in basenames]
+    set_batch_skeletons(skeletons)
+    try:
+        if workers == 1:
+            channels = [read_batch_animation_channels(x, interactive, source, tolerances, quantize, decode_workers = 0)
+                for x in animbin_files]
+        else:
+            with ProcessPoolExecutor(max_workers = workers if workers > 0 else None,
+                    initializer = set_batch_skeletons, initargs = (skeletons,)) as pool:
+                channels = list(pool.map(functools.partial(read_batch_animation_channels, source = source,
+                    tolerances = tolerances, quantize = quantize), animbin_files))
+    finally:
+        set_batch_skeletons({})
+    for folder in basenames:
+        skel_struct, skeleton_nodes = skeletons[folder]
+        gltf_data, buffer_chunks, time_accessors = make_animation_gltf(skel_struct, skeleton_nodes), [], {}
+        for i in range(len(animbin_files)):
+            if os.path.dirname(animbin_files[i]) == folder:
+                add_gltf_animation(gltf_data, buffer_chunks, channels[i], time_accessors,
+                    name = ".".join(os.path.basename(animbin_files[i]).split(".")[:-1]))
+        if tolerances != None:
+            print_key_reduction(basenames[folder], [x for i in range(len(animbin_files))
+                if os.path.dirname(animbin_files[i]) == folder for x in channels[i]])
+        write_animation_gltf(gltf_data, buffer_chunks, basenames[folder], write_glb, sink)
+        print("Wrote {0} animations and {1} key time arrays to {2}.".format(len(gltf_data['animations']),
+            len(time_accessors), basenames[folder] + ('.glb' if write_glb == True else '.gltf')))
+    return([basenames[x] for x in basenames])
 
 if __name__ == "__main__":
     # Set current directory
@@ -479,14 +858,36 @@ if __name__ == "__main__":
         parser.add_argument('-o', '--overwrite', help="Overwrite existing files", action="store_true")
         parser.add_argument('-t', '--textformat', help="Write gltf instead of glb", action="store_false")
         parser.add_argument('-d', '--dumpanidata', help="Write extra animation data to json", action="store_true")
-        parser.add_argument('animbin_file', help="Name of binary animation file to parse.")
+        parser.add_argument('--dumpformat', help="Format of --dumpanidata, json or npz (binary, much smaller)",
+            choices=['json', 'npz'], default='json')
+        parser.add_argument('-k', '--skeleton', help="Skeleton json or TOMDLB_D file to use for every animation", default='')
+        parser.add_argument('-j', '--jobs', help="Number of files to process at once, longest first (0 for one per CPU)",
+            type=int, default=1)
+        parser.add_argument('-c', '--combine', help="Write all the animations of the folder into one glTF", action="store_true")
+        parser.add_argument('-r', '--reduce', help="Remove keys that interpolation can rebuild", action="store_true")
+        parser.add_argument('--tolerance', help="Largest error of --reduce, e.g. translation=0.001,rotation=0.0005,scale=0.001 (radians for rotation)", default='')
+        parser.add_argument('-q', '--quantize', help="Store rotations as normalized shorts (smaller, slightly less precise)", action="store_true")
+        parser.add_argument('animbin_file', help="Name of binary animation file to parse, or all of them in the folder if not given.",
+            nargs='?', default='')
         args = parser.parse_args()
-        if (os.path.exists(args.animbin_file)
+        tolerances = parse_tolerances(args.tolerance) if args.reduce == True else None
+        if args.animbin_file == '':
+            animbin_files = glob.glob('*.TOANMB') + glob.glob('*.TOANMSB')
+        elif (os.path.exists(args.animbin_file)
             and (args.animbin_file[-8:].lower() == '.toanmsb'
               or args.animbin_file[-7:].lower() == '.toanmb')):
-            process_tosamsb(args.animbin_file, overwrite = args.overwrite, write_glb = args.textformat,\
-                dump_extra_animation_data = args.dumpanidata)
+            animbin_files = [args.animbin_file]
+        else:
+            animbin_files = []
+        if args.combine == True:
+            if args.dumpanidata == True:
+                print("--dumpanidata is not used with --combine, run without --combine to dump the animation data.")
+            process_tosamsbs_combined(animbin_files, overwrite = args.overwrite, write_glb = args.textformat,\
+                skeleton_file = args.skeleton, workers = args.jobs, tolerances = tolerances, quantize = args.quantize)
+        else:
+            process_tosamsbs(animbin_files, overwrite = args.overwrite, write_glb = args.textformat,\
+                dump_extra_animation_data = args.dumpanidata, skeleton_file = args.skeleton, workers = args.jobs,
+                tolerances = tolerances, quantize = args.quantize, dump_format = args.dumpformat)
     else:
         animbin_files = glob.glob('*.TOANMB') + glob.glob('*.TOANMSB')
-        for animbin_file in animbin_files:
-            process_tosamsb(animbin_file)
\ No newline at end of file
+        process_tosamsbs(animbin_files)
\ No newline at end of file
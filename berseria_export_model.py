@@ -7,13 +7,22 @@
 # For command line options, run:
 # /path/to/python3 berseria_export_model.py --help
 #
-# Requires lib_fmtibvb.py, put in the same directory
+# Requires lib_fmtibvb.py, lib_schema.py, lib_meshpack.py, lib_prompt.py, lib_exportcache.py, lib_filesource.py and
+# lib_filesink.py, put in the same directory
 #
 # GitHub eArmada8/berseria_model_tool
 
 try:
-    import struct, json, numpy, glob, copy, os, sys
+    import struct, json, numpy, hashlib, functools, glob, copy, os, sys
+    from concurrent.futures import ProcessPoolExecutor
+    from multiprocessing import shared_memory, resource_tracker
     from lib_fmtibvb import *
+    from lib_schema import *
+    from lib_meshpack import write_meshpack_stream, meshpack_filename
+    from lib_prompt import *
+    from lib_exportcache import make_cache_key, restore_cached_export, store_cached_export
+    from lib_filesource import local_files
+    from lib_filesink import local_output, ArchiveSink, archive_formats
 except ModuleNotFoundError as e:
     print("Python module missing! {}".format(e.msg))
     input("Press Enter to abort.")
@@ -22,26 +31,12 @@ except ModuleNotFoundError as e:
 # Configuration variable
 # True to enable combining models (requires a compatible skeleton, no commandline arguments)
 combine_models_into_single_gltf = True
+# True to skip models whose files, export options and outputs are unchanged since the last export
+use_export_cache = True
 
-# Global variable, do not edit
-addr_size = 8
-e = '<'
-
-def set_address_size (size):
-    global addr_size
-    if size in [4,8]:
-        addr_size = size
-    return
-
-def set_endianness (endianness):
-    global e
-    if endianness in ['<', '>']:
-        e = endianness
-    return
-
-def read_offset (f):
+def read_offset (f, ctx):
     start_offset = f.tell()
-    diff_offset, = struct.unpack("{}{}".format(e, {4: "I", 8: "Q"}[addr_size]), f.read(addr_size))
+    diff_offset, = ctx.read(f, 'address')
     return(start_offset + diff_offset)
 
 def read_string (f, start_offset):
@@ -73,45 +68,45 @@ def trianglestrip_to_list(ib_list):
     triangles = [x for x in triangles if len(set(x)) == 3]
     return(triangles)
 
-def read_opening_dict (f):
-    dict_offset = read_offset(f)
-    dict_size, = struct.unpack("{}{}".format(e, {4: "I", 8: "Q"}[addr_size]), f.read(addr_size))
+def read_opening_dict (f, ctx):
+    dict_offset = read_offset(f, ctx)
+    dict_size, = ctx.read(f, 'address')
     opening_dict = []
     return_to_offset = f.tell()
     f.seek(dict_offset)
     for _ in range(dict_size):
-        opening_dict.append(read_string(f, read_offset(f)))
+        opening_dict.append(read_string(f, read_offset(f, ctx)))
     f.seek(return_to_offset)
     return(opening_dict)
 
 #Node Tree, offset should be toc[0]
-def read_section_0 (f, offset):
+def read_section_0 (f, offset, ctx):
     # Jump to #0
     f.seek(offset)
-    section_0_header = struct.unpack("{}3I6H".format(e), f.read(24))
+    section_0_header = ctx.read(f, 'skeleton_header')
     section_0_toc = []
     for _ in range(8):
-        offset = read_offset(f)
-        num_entries, = struct.unpack("{}{}".format(e,{4: "I", 8: "Q"}[addr_size]), f.read(addr_size))
+        offset = read_offset(f, ctx)
+        num_entries, = ctx.read(f, 'address')
         section_0_toc.append({'offset': offset, 'num_entries': num_entries})
-    unk_block = list(struct.unpack("{}2{}".format(e,{4: "I", 8: "Q"}[addr_size]), f.read(addr_size * 2)))
-    unk_block.extend(struct.unpack("{}4Hfi6f".format(e), f.read(40)))
+    unk_block = list(ctx.read(f, 'pointer'))
+    unk_block.extend(struct.unpack("{}4Hfi6f".format(ctx.e), f.read(40)))
     f.seek(section_0_toc[0]['offset'])
-    id_ = struct.unpack("{}{}I".format(e, section_0_toc[0]['num_entries']), f.read(section_0_toc[0]['num_entries']*4))
+    id_ = struct.unpack("{}{}I".format(ctx.e, section_0_toc[0]['num_entries']), f.read(section_0_toc[0]['num_entries']*4))
     f.seek(section_0_toc[1]['offset'])
-    true_parent = struct.unpack("{}{}i".format(e, section_0_toc[1]['num_entries']), f.read(section_0_toc[1]['num_entries']*4))
+    true_parent = struct.unpack("{}{}i".format(ctx.e, section_0_toc[1]['num_entries']), f.read(section_0_toc[1]['num_entries']*4))
     f.seek(section_0_toc[2]['offset'])
-    tree_info = [struct.unpack("{}4h".format(e), f.read(8)) for _ in range(section_0_toc[2]['num_entries'])]
+    tree_info = [ctx.read(f, 'tree_info') for _ in range(section_0_toc[2]['num_entries'])]
     f.seek(section_0_toc[3]['offset'])
-    name = [read_string(f, read_offset(f)) for _ in range(section_0_toc[3]['num_entries'])]
+    name = [read_string(f, read_offset(f, ctx)) for _ in range(section_0_toc[3]['num_entries'])]
     f.seek(section_0_toc[4]['offset'])
-    unk_matrix = [[struct.unpack("{}16f".format(e), f.read(64)) for _ in range(2)] for _ in range(section_0_toc[4]['num_entries'])]
+    unk_matrix = [[ctx.read(f, 'matrix') for _ in range(2)] for _ in range(section_0_toc[4]['num_entries'])]
     f.seek(section_0_toc[5]['offset'])
-    abs_matrix = [struct.unpack("{}16f".format(e), f.read(64)) for _ in range(section_0_toc[5]['num_entries'])]
+    abs_matrix = [ctx.read(f, 'matrix') for _ in range(section_0_toc[5]['num_entries'])]
     f.seek(section_0_toc[6]['offset'])
-    inv_matrix = [struct.unpack("{}16f".format(e), f.read(64)) for _ in range(section_0_toc[6]['num_entries'])]
+    inv_matrix = [ctx.read(f, 'matrix') for _ in range(section_0_toc[6]['num_entries'])]
     f.seek(section_0_toc[7]['offset'])
-    parent_list = struct.unpack("{}{}h".format(e, section_0_toc[7]['num_entries']), f.read(section_0_toc[7]['num_entries']*2))
+    parent_list = struct.unpack("{}{}h".format(ctx.e, section_0_toc[7]['num_entries']), f.read(section_0_toc[7]['num_entries']*2))
     raw_data = [section_0_header, unk_block, id_, true_parent, tree_info, name, unk_matrix, abs_matrix, inv_matrix, parent_list]
     skel_struct = [{'id': id_[i], 'ani_id': id_[i] & 0xFFFF, 'ani_group': id_[i] >> 16, 'true_parent': true_parent[i],
         'tree_info': tree_info[i], 'name': name[i], 'abs_matrix': abs_matrix[i], 'inv_matrix': inv_matrix[i],
@@ -130,57 +125,48 @@ def read_section_0 (f, offset):
         skel_struct[i]['children'] = [j for j in range(len(skel_struct)) if skel_struct[j]['parent'] == i]
     return(skel_struct, raw_data)
 
-def read_dlb_skeleton (dlb_file):
-    current_addr_size = addr_size # Store original size so we can restore it at the end
-    current_endian = e
+def read_dlb_skeleton (dlb_file, source = local_files):
     skel_list = []
-    with open(dlb_file, 'rb') as f:
+    with source.open(dlb_file) as f:
         magic = f.read(4)
         if magic in [b'DPDF', b'FDPD']:
-            set_endianness({b'DPDF': '<', b'FDPD': '>'}[magic])
-            unk_int, = struct.unpack("{}I".format(e), f.read(4))
-            set_address_size(8)
+            ctx = FormatContext({b'DPDF': '<', b'FDPD': '>'}[magic])
+            unk_int, = struct.unpack("{}I".format(ctx.e), f.read(4))
             if not unk_int == 0:
-                set_address_size(4) # Cannot assume that the skeleton is the same!
-            f.seek({4: 4, 8: 16}[addr_size],1)
+                ctx.addr_size = 4 # Cannot assume that the skeleton is the same!
+            f.seek({4: 4, 8: 16}[ctx.addr_size],1)
             magic = f.read(4)
             if magic in [b'BLDM', b'MDLB']:
                 f.seek(4,1)
-                offset = read_offset(f)
+                offset = read_offset(f, ctx)
                 f.seek(offset) # Jump to section 0
                 f.seek(0x18,1)
-                offset = read_offset(f)
-                num_entries, = struct.unpack("{}{}".format(e, {4: "I", 8: "Q"}[addr_size]), f.read(addr_size))
+                offset = read_offset(f, ctx)
+                num_entries, = ctx.read(f, 'address')
                 f.seek(offset)
-                skel_list.extend(list(struct.unpack("{}{}I".format(e, num_entries), f.read(num_entries * 4))))
-    set_address_size(current_addr_size) # Restore original address size
-    set_endianness(current_endian) # Restore original endianness
+                skel_list.extend(list(struct.unpack("{}{}I".format(ctx.e, num_entries), f.read(num_entries * 4))))
     return(skel_list)
 
-def find_primary_skeleton (missing_bone_palette_ids):
-    print("Searching all dlb files for primary skeleton in current folder.")
-    dlb_files = glob.glob('*.TOMDLB_D')
+# Cached by source, file name, size and modification time, so that batch jobs do not re-read every .TOMDLB_D in
+# the folder for each model that needs an external skeleton
+@functools.lru_cache(maxsize = 4096)
+def read_dlb_skeleton_cached (source, dlb_file, file_size, mtime):
+    return(tuple(read_dlb_skeleton(dlb_file, source)))
+
+# search_folder is the folder of the model being exported, '' for the current folder (or the top of the source)
+def find_primary_skeleton (missing_bone_palette_ids, search_folder = '', interactive = True, source = local_files):
+    print("Searching all dlb files for primary skeleton in {}.".format(
+        "folder " + search_folder if search_folder else "current folder"))
+    dlb_files = source.glob(os.path.join(search_folder, '*.TOMDLB_D'))
     if len(dlb_files) > 10:
         print("This may take a long time...")
     palettes = {}
     for i in range(len(dlb_files)):
-        palettes[dlb_files[i]] = read_dlb_skeleton(dlb_files[i])
+        file_size, mtime = source.stat(dlb_files[i])
+        palettes[dlb_files[i]] = read_dlb_skeleton_cached(source,
+            os.path.abspath(dlb_files[i]) if source == local_files else dlb_files[i], file_size, mtime)
     matches = [x for x in dlb_files if all([y in palettes[x] for y in missing_bone_palette_ids])]
-    match = ''
-    if len(matches) > 1:
-        print("Multiple matches found, please choose one.")
-        for i in range(len(matches)):
-            print("{0}. {1}".format(i+1, matches[i]))
-            if (i+1) % 25 == 0:
-                input("More results, press Enter to continue...")
-        while match == '':
-            raw_input = input("Use which skeleton? ")
-            if raw_input.isnumeric() and int(raw_input)-1 in range(len(matches)):
-                match = matches[int(raw_input)-1]
-            else:
-                print("Invalid entry!")
-    elif len(matches) == 1:
-        match = matches[0]
+    match = choose_from_list(matches, "Use which skeleton?", interactive = interactive)
     if match == '':
         print("No matches found!")
     else:
@@ -188,23 +174,20 @@ def find_primary_skeleton (missing_bone_palette_ids):
     return match
 
 # skel_struct will be appended onto the skeleton_file struct, not the other way around
-def combine_skeletons (skeleton_file, skel_struct):
-    current_addr_size = addr_size # Store original size so we can restore it at the end
-    current_endian = e
-    with open(skeleton_file, 'rb') as f:
+def combine_skeletons (skeleton_file, skel_struct, source = local_files):
+    with source.open(skeleton_file) as f:
         magic = f.read(4)
         if magic in [b'DPDF', b'FDPD']:
-            set_endianness({b'DPDF': '<', b'FDPD': '>'}[magic])
-            unk_int, = struct.unpack("{}I".format(e), f.read(4))
-            set_address_size(8)
+            ctx = FormatContext({b'DPDF': '<', b'FDPD': '>'}[magic])
+            unk_int, = struct.unpack("{}I".format(ctx.e), f.read(4))
             if not unk_int == 0:
-                set_address_size(4) # Cannot assume that the skeleton is the same!
-            f.seek({4: 4, 8: 16}[addr_size],1)
+                ctx.addr_size = 4 # Cannot assume that the skeleton is the same!
+            f.seek({4: 4, 8: 16}[ctx.addr_size],1)
             magic = f.read(4)
             if magic in [b'BLDM', b'MDLB']:
                 f.seek(4,1)
-                offset = read_offset(f)
-                primary_skel_struct, _ = read_section_0(f, offset)
+                offset = read_offset(f, ctx)
+                primary_skel_struct, _ = read_section_0(f, offset, ctx)
                 new_skel_struct = primary_skel_struct + skel_struct
                 #Reassign parent
                 new_indices = [x['id'] for x in new_skel_struct]
@@ -225,27 +208,31 @@ def combine_skeletons (skeleton_file, skel_struct):
                     else:
                         new_skel_struct[i]['matrix'] = new_skel_struct[i]['abs_matrix']
                     new_skel_struct[i]['children'] = [j for j in range(len(new_skel_struct)) if new_skel_struct[j]['parent'] == i]
-                set_address_size(current_addr_size) # Restore original address size
-                set_endianness(current_endian) # Restore original endianness
                 return(new_skel_struct)
             else:
                 print("Invalid skeleton file!")
-                set_address_size(current_addr_size) # Restore original address size
-                set_endianness(current_endian) # Restore original endianness
                 return skel_struct
         else:
             print("Invalid skeleton file!")
-            set_address_size(current_addr_size) # Restore original address size
-            set_endianness(current_endian) # Restore original endianness
             return skel_struct
 
-def find_and_add_external_skeleton (skel_struct, bone_palette_ids):
+# skeleton_file skips the search and uses the given .TOMDLB_D as the primary skeleton, from source or else from
+# the plain file system.  The file that is used is appended to used_files if given.
+def find_and_add_external_skeleton (skel_struct, bone_palette_ids, search_folder = '', skeleton_file = '', interactive = True,
+        used_files = None, source = local_files):
     #Sanity check, if the skeleton is already complete then skip the search
     if not all([y in [x['id'] for x in skel_struct] for y in bone_palette_ids]):
         missing_bone_palette_ids = [y for y in bone_palette_ids if not y in [x['id'] for x in skel_struct]]
-        primary_skeleton_file = find_primary_skeleton (missing_bone_palette_ids)
-        if os.path.exists(primary_skeleton_file):
-            return(combine_skeletons (primary_skeleton_file, skel_struct))
+        if skeleton_file != '':
+            primary_skeleton_file = skeleton_file
+            if not source.exists(skeleton_file):
+                source = local_files
+        else:
+            primary_skeleton_file = find_primary_skeleton (missing_bone_palette_ids, search_folder, interactive, source)
+        if primary_skeleton_file != '' and source.exists(primary_skeleton_file):
+            if used_files != None:
+                used_files.append(source.local_path(primary_skeleton_file))
+            return(combine_skeletons (primary_skeleton_file, skel_struct, source))
         else:
             return([])
     else:
@@ -320,11 +307,11 @@ def make_fmt(num_uvs, semantics_present = {'NORMAL': True, 'TANGENT': False, 'BI
     fmt['elements'] = elements
     return(fmt)
 
-def read_mesh (main_f, idx_f, start_offset, flags):
+def read_mesh (main_f, idx_f, start_offset, flags, ctx):
     def read_floats (f, num):
-        return(list(struct.unpack("{}{}f".format(e, num), f.read(num * 4))))
+        return(list(struct.unpack("{}{}f".format(ctx.e, num), f.read(num * 4))))
     def read_bytes (f, num):
-        return(list(struct.unpack("{}{}B".format(e, num), f.read(num))))
+        return(list(struct.unpack("{}{}B".format(ctx.e, num), f.read(num))))
     def read_interleaved_floats (f, num, stride, total):
         vecs = []
         padding = stride - (num * 4)
@@ -353,7 +340,7 @@ def read_mesh (main_f, idx_f, start_offset, flags):
             weights = [x+[round(1-sum(x),6)] if len(x) < 4 else x for x in weights]
         return(weights)
     main_f.seek(start_offset)
-    num_verts, num_idx, offset_uvs, offset_idx = struct.unpack("{}2H2I".format(e), main_f.read(12))
+    num_verts, num_idx, offset_uvs, offset_idx = ctx.read(main_f, 'mesh_data_header')
     uv_stride = (offset_idx - offset_uvs) // num_verts
     num_uv_maps = flags & 0xF
     #num_uv_maps = (uv_stride - 4) // 8 # 4 byte buffer + VEC2 per map
@@ -362,15 +349,15 @@ def read_mesh (main_f, idx_f, start_offset, flags):
     if flags & 0xF0 == 0x50:
         blend_idx = []
         weights = []
-        num_v_per_wt_grp = list(struct.unpack("{}4I".format(e), main_f.read(16)))
+        num_v_per_wt_grp = list(ctx.read(main_f, 'weight_group_counts'))
         if sum(num_v_per_wt_grp) == num_verts:
             num_vertices_array = [num_v_per_wt_grp]
         else: # Some builds have arrays of arrays, might be a PS3 thing
             main_f.seek(-16,1)
             num_vertices_array = [[]]
-            count, = struct.unpack("{}I".format(e), main_f.read(4))
+            count, = struct.unpack("{}I".format(ctx.e), main_f.read(4))
             for i in range(count):
-                num_vertices_array.append(list(struct.unpack("{}4H".format(e), main_f.read(8))))
+                num_vertices_array.append(list(struct.unpack("{}4H".format(ctx.e), main_f.read(8))))
         for i in range(len(num_vertices_array)):
             for j in range(len(num_vertices_array[i])):
                 vert_offset = main_f.tell()
@@ -393,8 +380,8 @@ def read_mesh (main_f, idx_f, start_offset, flags):
                 main_f.seek(end_offset)
         weights = fix_weights(weights)
     elif flags & 0xF0 == 0x70:
-        num_unk = struct.unpack("{}2H".format(e), main_f.read(4)) # Dunno what this is, maybe shape morphs?
-        unk_list = list(struct.unpack("{}{}I".format(e, num_unk[0]), main_f.read(4 * num_unk[0])))
+        num_unk = struct.unpack("{}2H".format(ctx.e), main_f.read(4)) # Dunno what this is, maybe shape morphs?
+        unk_list = list(struct.unpack("{}{}I".format(ctx.e, num_unk[0]), main_f.read(4 * num_unk[0])))
         vert_offset = main_f.tell()
         norm_offset = vert_offset + 12
         stride = 24
@@ -442,12 +429,14 @@ def read_mesh (main_f, idx_f, start_offset, flags):
             idx_f.seek(offset_uvs + 28 + (i * 8))
             uv_maps.append(read_interleaved_floats (idx_f, 2, stride, num_verts))
     idx_f.seek(offset_idx)
-    idx_buffer = list(struct.unpack("{}{}h".format(e, num_idx), idx_f.read(num_idx * 2)))
+    idx_buffer = list(struct.unpack("{}{}h".format(ctx.e, num_idx), idx_f.read(num_idx * 2)))
+    ib = trianglestrip_to_list(idx_buffer)
     if not flags & 0xF0 in [0xC0]:
         fmt = make_fmt(len(uv_maps))
     elif flags & 0xF0 == 0xC0:
         fmt = make_fmt(len(uv_maps), semantics_present = {'NORMAL': True, 'TANGENT': True, 'BINORMAL': True,
             'COLOR': True, 'BLENDWEIGHTS': True, 'BLENDINDICES': True})
+    fmt['format'] = get_ib_format(ib)
     vb = [{'Buffer': verts}, {'Buffer': norms}]
     if flags & 0xF0 == 0xC0:
         vb.append({'Buffer': tangents})
@@ -461,23 +450,18 @@ def read_mesh (main_f, idx_f, start_offset, flags):
     elif flags & 0xF0 in [0x0, 0x40, 0x70, 0xC0]:
         vb.append({'Buffer': [[1.0, 0.0, 0.0, 0.0] for _ in range(len(verts))]})
         vb.append({'Buffer': [[0, 0, 0, 0] for _ in range(len(verts))]})
-    return({'fmt': fmt, 'vb': vb, 'ib': trianglestrip_to_list(idx_buffer)})
-
-#This function is purely for flipping endianness
-def read_generic_int_section (f, offset, length):
-    f.seek(offset)
-    return(list(struct.unpack("{}{}I".format(e, length // 4), f.read(length))))
+    return({'fmt': fmt, 'vb': vb, 'ib': ib})
 
 #Physics parameters, offset should be toc[4].
-def read_section_4 (f, offset):
+def read_section_4 (f, offset, ctx):
     f.seek(offset)
-    section_4_unk = struct.unpack("{}2I".format(e), f.read(8))
-    counts = struct.unpack("{}2H".format(e), f.read(4))
-    if addr_size == 8:
+    section_4_unk = struct.unpack("{}2I".format(ctx.e), f.read(8))
+    counts = struct.unpack("{}2H".format(ctx.e), f.read(4))
+    if ctx.addr_size == 8:
         f.seek(4,1) # Padding
-    offset = read_offset(f)
-    count, = struct.unpack("{}{}".format(e, {4: "I", 8: "Q"}[addr_size]), f.read(addr_size))
-    data = [list(struct.unpack("{}4h25f".format(e), f.read(0x6c))) for _ in range(count)]
+    offset = read_offset(f, ctx)
+    count, = ctx.read(f, 'address')
+    data = [list(ctx.read(f, 'physics')) for _ in range(count)]
     param_names = ['flag', 'target_node', 'group', 'unk_correction', 'elasticity_x', 'elasticity_y',
         'air_resist', 'gravity', 'weight', 'friction', 'size_of_collision', 'unk0', 'unk1', 'unk2', 'unk3',
         'maybe_wind', 'child_pos_x', 'child_pos_y', 'child_pos_z', 'child_len', 'dynamic_mtx_00',
@@ -489,14 +473,14 @@ def read_section_4 (f, offset):
     return(decoded)
 
 #Collision meshes, offset should be toc[5].
-def read_section_5 (f, offset, decode_data = False):
+def read_section_5 (f, offset, ctx, decode_data = False):
     f.seek(offset)
-    offset1 = read_offset(f)
-    count1, = struct.unpack("{}{}".format(e, {4: "I", 8: "Q"}[addr_size]), f.read(addr_size))
-    offset2 = read_offset(f)
-    count2, = struct.unpack("{}{}".format(e, {4: "I", 8: "Q"}[addr_size]), f.read(addr_size))
-    data1 = [list(struct.unpack("{}2H6f2I".format(e), f.read(36))) for _ in range(count1)]
-    data2 = [list(struct.unpack("{}9f".format(e), f.read(36))) for _ in range(count2)]
+    offset1 = read_offset(f, ctx)
+    count1, = ctx.read(f, 'address')
+    offset2 = read_offset(f, ctx)
+    count2, = ctx.read(f, 'address')
+    data1 = [list(ctx.read(f, 'collision')) for _ in range(count1)]
+    data2 = [list(ctx.read(f, 'collision_triangle')) for _ in range(count2)]
     if decode_data == True:
         triangles = [[x[0:3], x[3:6], x[6:9]] for x in data2]
         decoded = []
@@ -508,46 +492,46 @@ def read_section_5 (f, offset, decode_data = False):
         return([data1, data2])
 
 #Meshes, offset should be toc[6].  Requires dlp filename for uv's and index buffer.
-def read_section_6 (f, offset, dlp_file):
+def read_section_6 (f, offset, dlp_file, ctx, source = local_files):
     f.seek(offset)
-    section_6_unk = struct.unpack("{}4I".format(e), f.read(16))
+    section_6_unk = ctx.read(f, 'mesh_section_header')
     section_6_toc = []
     for _ in range(4):
-        offset = read_offset(f)
-        num_entries, = struct.unpack("{}{}".format(e, {4: "I", 8: "Q"}[addr_size]), f.read(addr_size))
+        offset = read_offset(f, ctx)
+        num_entries, = ctx.read(f, 'address')
         section_6_toc.append({'offset': offset, 'num_entries': num_entries})
     #section_6_toc[0] - VEC4 (u32, f32?) - in sample is all zeroes
     #section_6_toc[1] - meshes
     #section_6_toc[2] - bone palette
     #section_6_toc[3] - u32 x 2 - # meshes, # bones
     f.seek(section_6_toc[2]['offset'])
-    bone_palette_ids = struct.unpack("{}{}I".format(e, section_6_toc[2]['num_entries']), f.read(4 * section_6_toc[2]['num_entries']))
+    bone_palette_ids = struct.unpack("{}{}I".format(ctx.e, section_6_toc[2]['num_entries']), f.read(4 * section_6_toc[2]['num_entries']))
     mesh_blocks_info = []
     meshes = []
     f.seek(section_6_toc[1]['offset'])
-    with open (dlp_file, 'rb') as idx_f:
+    with source.open(dlp_file) as idx_f:
         for i in range(section_6_toc[1]['num_entries']):
             data = {'current_block_offset': f.tell(), 'name': ''}
             data["mesh"], data["submesh"], data["node"], \
-                data["flags"], data["material"], data["unknown"] = struct.unpack("{}i4hi".format(e), f.read(16))
-            data['string_offset'] = read_offset(f)
-            data['data_offset'] = read_offset(f)
-            data["data_block_size"], = struct.unpack("{}{}".format(e, {4: "I", 8: "Q"}[addr_size]), f.read(addr_size))
+                data["flags"], data["material"], data["unknown"] = ctx.read(f, 'mesh')
+            data['string_offset'] = read_offset(f, ctx)
+            data['data_offset'] = read_offset(f, ctx)
+            data["data_block_size"], = ctx.read(f, 'address')
             current_offset = f.tell()
             data["name"] = read_string (f, data['string_offset'])
-            meshes.append(read_mesh (f, idx_f, data['data_offset'], data["flags"]))
+            meshes.append(read_mesh (f, idx_f, data['data_offset'], data["flags"], ctx))
             mesh_blocks_info.append(data)
             f.seek(current_offset)
     return(meshes, bone_palette_ids, mesh_blocks_info)
 
 #Materials, offset should be toc[7]
-def read_section_7 (f, offset):
+def read_section_7 (f, offset, ctx):
     f.seek(offset)
-    section_7_unk = struct.unpack("{}2I8H".format(e), f.read(24))
+    section_7_unk = ctx.read(f, 'material_section_header')
     section_7_toc = []
     for _ in range(7):
-        offset = read_offset(f)
-        num_entries, = struct.unpack("{}{}".format(e, {4: "I", 8: "Q"}[addr_size]), f.read(addr_size))
+        offset = read_offset(f, ctx)
+        num_entries, = ctx.read(f, 'address')
         section_7_toc.append({'offset': offset, 'num_entries': num_entries})
     set_0_names = ['material_id','mat_variation_flags','mat_alpha_flags','num_uv','ani_mat_id','tex0',
         'shader','render_type','unk0','unk1','unk2']
@@ -557,25 +541,25 @@ def read_section_7 (f, offset):
         'specular_red','specular_green','specular_blue','specular_power']
     set_0 = [] # Materials, including the indices that map to set_1 (textures)
     for i in range(section_7_toc[0]['num_entries']):
-        f.seek(section_7_toc[0]['offset'] + (i * (4 * addr_size + 0x18)))
-        values = dict(zip(set_0_names, struct.unpack("{}I10h".format(e), f.read(24))))
-        offset1 = read_offset(f)
-        num_vals1, = struct.unpack("{}{}".format(e, {4: "I", 8: "Q"}[addr_size]), f.read(addr_size))
-        offset2 = read_offset(f)
-        num_vals2, = struct.unpack("{}{}".format(e, {4: "I", 8: "Q"}[addr_size]), f.read(addr_size))
+        f.seek(section_7_toc[0]['offset'] + (i * (4 * ctx.addr_size + 0x18)))
+        values = dict(zip(set_0_names, ctx.read(f, 'material')))
+        offset1 = read_offset(f, ctx)
+        num_vals1, = ctx.read(f, 'address')
+        offset2 = read_offset(f, ctx)
+        num_vals2, = ctx.read(f, 'address')
         end_offset = f.tell()
         f.seek(offset1)
         param_names_1 = ['unk{0:02d}'.format(j) for j in range(num_vals1)]
         if num_vals1 == 11:
             param_names_1[0:len(set_0_params)] = set_0_params
-        vals1 = dict(zip(param_names_1, struct.unpack("{}{}I".format(e, num_vals1), f.read(num_vals1 * 4))))
+        vals1 = dict(zip(param_names_1, struct.unpack("{}{}I".format(ctx.e, num_vals1), f.read(num_vals1 * 4))))
         f.seek(offset2)
         if num_vals2 == 0x17:
-            vals2 = struct.unpack("{}8I4f4If6I".format(e), f.read(92))
+            vals2 = ctx.read(f, 'shader_params_0x17')
         elif num_vals2 == 0x11:
-            vals2 = struct.unpack("{}8I4f4If".format(e), f.read(68))
+            vals2 = ctx.read(f, 'shader_params_0x11')
         else:
-            vals2 = struct.unpack("{}{}I".format(e, num_vals2), f.read(num_vals2 * 4))
+            vals2 = struct.unpack("{}{}I".format(ctx.e, num_vals2), f.read(num_vals2 * 4))
         param_names_2 = ['unk{0:02d}'.format(j) for j in range(num_vals2)]
         if num_vals2 > len(set_0_shader_params):
             param_names_2[0:len(set_0_shader_params)] = set_0_shader_params
@@ -583,47 +567,47 @@ def read_section_7 (f, offset):
     set_1 = [] # Texture assignments, each is a tuple where the second number points to set_6
     for i in range(section_7_toc[1]['num_entries']):
         f.seek(section_7_toc[1]['offset'] + (i * 6))
-        values = struct.unpack("{}3h".format(e), f.read(6))
+        values = ctx.read(f, 'texture_assignment')
         set_1.append(values)
     set_2 = [] # Materials, including material names (and alpha)
     for i in range(section_7_toc[2]['num_entries']):
-        f.seek(section_7_toc[2]['offset'] + (i * (5 * addr_size)))
-        offset1 = read_offset(f)
-        num_vals1, = struct.unpack("{}{}".format(e, {4: "I", 8: "Q"}[addr_size]), f.read(addr_size))
-        offset2 = read_offset(f)
-        num_vals2, = struct.unpack("{}{}".format(e, {4: "I", 8: "Q"}[addr_size]), f.read(addr_size))
-        str_offset = read_offset(f)
+        f.seek(section_7_toc[2]['offset'] + (i * (5 * ctx.addr_size)))
+        offset1 = read_offset(f, ctx)
+        num_vals1, = ctx.read(f, 'address')
+        offset2 = read_offset(f, ctx)
+        num_vals2, = ctx.read(f, 'address')
+        str_offset = read_offset(f, ctx)
         f.seek(offset1)
-        vals1 = struct.unpack("{}{}I".format(e, num_vals1), f.read(num_vals1 * 4))
+        vals1 = struct.unpack("{}{}I".format(ctx.e, num_vals1), f.read(num_vals1 * 4))
         f.seek(offset2)
-        vals2 = struct.unpack("{}{}I".format(e, num_vals2), f.read(num_vals2 * 4))
+        vals2 = struct.unpack("{}{}I".format(ctx.e, num_vals2), f.read(num_vals2 * 4))
         name = read_string(f, str_offset)
         set_2.append({'name': name, 'vals1': vals1, 'vals2': vals2})
     set_3 = [] # Used by Symphonia only, index of materials
     if section_7_toc[3]['num_entries'] > 0:
         f.seek(section_7_toc[3]['offset'])
-        set_3 = list(struct.unpack("{}{}H".format(e, section_7_toc[3]['num_entries']),
+        set_3 = list(struct.unpack("{}{}H".format(ctx.e, section_7_toc[3]['num_entries']),
             f.read(section_7_toc[3]['num_entries'] * 2)))
     set_4 = [] # Used by Symphonia only, each value index of material
     if section_7_toc[4]['num_entries'] > 0:
         f.seek(section_7_toc[4]['offset'])
-        set_4 = list(struct.unpack("{}{}H".format(e, section_7_toc[4]['num_entries']),
+        set_4 = list(struct.unpack("{}{}H".format(ctx.e, section_7_toc[4]['num_entries']),
             f.read(section_7_toc[4]['num_entries'] * 2)))
     set_5 = [] # Used by Symphonia only, index of materials
     if section_7_toc[5]['num_entries'] > 0:
         f.seek(section_7_toc[5]['offset'])
-        set_5 = list(struct.unpack("{}{}H".format(e, section_7_toc[5]['num_entries']),
+        set_5 = list(struct.unpack("{}{}H".format(ctx.e, section_7_toc[5]['num_entries']),
             f.read(section_7_toc[5]['num_entries'] * 2)))
     set_6 = [] # Texture names
     for i in range(section_7_toc[6]['num_entries']):
-        if addr_size == 8:
+        if ctx.addr_size == 8:
             f.seek(section_7_toc[6]['offset'] + (i * 24))
-            str_offset = read_offset(f)
-            vals = struct.unpack("{}2Q".format(e), f.read(16))
+            str_offset = read_offset(f, ctx)
+            vals = struct.unpack("{}2Q".format(ctx.e), f.read(16))
         else:
             f.seek(section_7_toc[6]['offset'] + (i * 8))
-            str_offset = read_offset(f)
-            vals = struct.unpack("{}2H".format(e), f.read(4))
+            str_offset = read_offset(f, ctx)
+            vals = struct.unpack("{}2H".format(ctx.e), f.read(4))
         tex_name = read_string(f, str_offset)
         set_6.append({'tex_name': tex_name, 'vals': vals})
     material_struct = []
@@ -646,7 +630,7 @@ def read_section_7 (f, offset):
     return(material_struct)
 
 #Something to do with animation, offset should be toc[11]. By default the data is not decoded (unneeded).
-def read_section_11 (f, offset, decode_data = False):
+def read_section_11 (f, offset, ctx, decode_data = False):
     def decode_target_flag (flag):
         return({'type': flag & 0xFFFFFFFF, 'target': flag >> 32 & 0xFFFF, 'unknown': flag >> 48})
     def decode_block_11 (data1, data2):
@@ -661,14 +645,14 @@ def read_section_11 (f, offset, decode_data = False):
             decoded[i]
         return(decoded)
     f.seek(offset)
-    offset1 = read_offset(f)
-    count1, = struct.unpack("{}{}".format(e, {4: "I", 8: "Q"}[addr_size]), f.read(addr_size))
-    offset2 = read_offset(f)
-    count2, = struct.unpack("{}{}".format(e, {4: "I", 8: "Q"}[addr_size]), f.read(addr_size))
+    offset1 = read_offset(f, ctx)
+    count1, = ctx.read(f, 'address')
+    offset2 = read_offset(f, ctx)
+    count2, = ctx.read(f, 'address')
     f.seek(offset1) # Skip 0x10 zero bytes for 8-byte addressing, 0x0c zero bytes for 4-byte - maybe a blank address?
     # data1 does not look like u64, except when looking at endianness, dunno why
-    data1 = [struct.unpack("{}Q".format(e), f.read(8))[0] for _ in range(count1)]
-    data2 = [struct.unpack("{}f".format(e), f.read(4))[0] for _ in range(count2)]
+    data1 = [struct.unpack("{}Q".format(ctx.e), f.read(8))[0] for _ in range(count1)]
+    data2 = [struct.unpack("{}f".format(ctx.e), f.read(4))[0] for _ in range(count2)]
     if decode_data == True:
         return(decode_block_11(data1, data2))
     else:
@@ -737,8 +721,133 @@ def fix_strides(submesh):
         offset += submesh['vb'][i]['stride']
     return(submesh)
 
+# KHR_mesh_quantization: positions are stored as unsigned shorts, position = offset + value * scale, with one offset
+# and scale for all the submeshes that share a glTF mesh (keys, e.g. the mesh number of each submesh).  The scale is
+# the same on every axis so that the normals are not distorted, and write_gltf() undoes it with the transform of
+# the mesh node, or the inverse bind matrices of a skinned mesh.  Returns the quantization of each submesh, None
+# for submeshes that are already encoded.
+def mesh_position_quantization (meshes, keys):
+    groups = {}
+    for i in range(len(meshes)):
+        if 'vb' in meshes[i]:
+            groups.setdefault(keys[i], []).append(i)
+    quantization = [None] * len(meshes)
+    for group in groups.values():
+        positions = [numpy.array(meshes[i]['vb'][j]['Buffer'], dtype = 'float64')[:,:3] for i in group
+            for j in range(len(meshes[i]['fmt']['elements'])) if meshes[i]['fmt']['elements'][j]['SemanticName']
+            == 'POSITION' and len(meshes[i]['vb'][j]['Buffer']) > 0]
+        offset, scale = [0.0, 0.0, 0.0], 1.0
+        if len(positions) > 0:
+            low = numpy.min([x.min(axis = 0) for x in positions], axis = 0)
+            high = numpy.max([x.max(axis = 0) for x in positions], axis = 0)
+            offset = low.tolist()
+            if numpy.max(high - low) > 0:
+                scale = float(numpy.max(high - low)) / 65535
+        for i in group:
+            quantization[i] = {'offset': offset, 'scale': scale}
+    return(quantization)
+
+# Column major, as in glTF
+def dequantization_matrix (quantization):
+    s, (x, y, z) = quantization['scale'], quantization['offset']
+    return([s, 0.0, 0.0, 0.0, 0.0, s, 0.0, 0.0, 0.0, 0.0, s, 0.0, x, y, z, 1.0])
+
+# Encodes the vertex buffers of a submesh with KHR_mesh_quantization.  Positions use the quantization from
+# mesh_position_quantization(), normals and tangents are normalized shorts, UVs are normalized (unsigned) shorts
+# if they are within 0 to 1 (or -1 to 1), and weights are normalized bytes that still add up to exactly 1.
+# Everything else is written as usual.  The elements of gltf_fmt are changed to match, three component elements
+# are padded to 8 bytes to keep every vertex 4-byte aligned.  Returns the vertex bytes and the position bounds.
+def encode_quantized_vertex_buffers (mesh, gltf_fmt, quantization):
+    chunks, bounds = [], {}
+    for element in range(len(gltf_fmt['elements'])):
+        gltf_element = gltf_fmt['elements'][element]
+        semantic = gltf_element['SemanticName'].split('_')[0]
+        values = numpy.array(mesh['vb'][element]['Buffer'], dtype = 'float64').reshape(len(mesh['vb'][element]['Buffer']), -1)
+        if semantic == 'POSITION' and values.shape[1] >= 3:
+            quantized = numpy.clip(numpy.round((values[:,:3] - numpy.array(quantization['offset']))
+                / quantization['scale']), 0, 65535).astype('<u2')
+            bounds[element] = [quantized.max(axis = 0).tolist(), quantized.min(axis = 0).tolist()]
+            chunks.append(numpy.pad(quantized, ((0,0),(0,1))).tobytes())
+            gltf_element.update({'Format': 'R16G16B16A16_UINT', 'componentType': 5123, 'componentStride': 8,
+                'accessor_type': 'VEC3', 'byteStride': 8})
+        elif semantic in ['NORMAL', 'TANGENT'] and values.shape[1] >= 3:
+            vectors = values[:,:3] if semantic == 'NORMAL' else values[:,:4]
+            length = numpy.linalg.norm(vectors[:,:3], axis = 1)[:,None]
+            vectors[:,:3] /= numpy.where(length > 0, length, 1.0)
+            quantized = numpy.round(numpy.clip(vectors, -1.0, 1.0) * 32767).astype('<i2')
+            chunks.append(numpy.pad(quantized, ((0,0),(0,4 - quantized.shape[1]))).tobytes())
+            gltf_element.update({'Format': 'R16G16B16A16_SNORM', 'componentType': 5122, 'componentStride': 8,
+                'accessor_type': ['VEC3', 'VEC4'][quantized.shape[1] - 3], 'normalized': True})
+            if quantized.shape[1] == 3:
+                gltf_element['byteStride'] = 8
+        elif semantic == 'TEXCOORD' and values.shape[1] == 2 and len(values) > 0 and values.min() >= -1.0 \
+                and values.max() <= 1.0:
+            if values.min() >= 0.0:
+                chunks.append(numpy.round(values * 65535).astype('<u2').tobytes())
+                gltf_element.update({'Format': 'R16G16_UNORM', 'componentType': 5123})
+            else:
+                chunks.append(numpy.round(values * 32767).astype('<i2').tobytes())
+                gltf_element.update({'Format': 'R16G16_SNORM', 'componentType': 5122})
+            gltf_element.update({'componentStride': 4, 'normalized': True})
+        elif semantic == 'WEIGHTS' and values.shape[1] == 4:
+            total = values.sum(axis = 1)[:,None]
+            quantized = numpy.round(values / numpy.where(total > 0, total, 1.0) * 255)
+            # Rounding can leave the sum a little off 255, which goes to the largest weight
+            largest = numpy.argmax(quantized, axis = 1)
+            quantized[numpy.arange(len(quantized)), largest] += numpy.where(total[:,0] > 0, 255 - quantized.sum(axis = 1), 0)
+            chunks.append(numpy.clip(quantized, 0, 255).astype('u1').tobytes())
+            gltf_element.update({'Format': 'R8G8B8A8_UNORM', 'componentType': 5121, 'componentStride': 4,
+                'normalized': True})
+        else:
+            stream = io.BytesIO()
+            for vector in mesh['vb'][element]['Buffer']:
+                pack_dxgi_vector(stream, vector, gltf_element['componentStride'], gltf_element['Format'], '<')
+            chunks.append(stream.getvalue())
+    return(b''.join(chunks), bounds)
+
+# Encodes the vertex and index buffers of a submesh for glTF, along with everything else write_gltf() needs from
+# the submesh (accessor counts, position bounds, and a hash of the geometry to find identical submeshes).
+# quantization (from mesh_position_quantization()) writes the vertices with KHR_mesh_quantization.
+def encode_gltf_geometry (mesh, quantization = None):
+    # Index width is chosen from the largest index, not from the raw buffer format
+    gltf_fmt = convert_fmt_for_gltf({**mesh['fmt'], 'format': get_ib_format(mesh['ib'])})
+    if quantization != None:
+        vb_bytes, bounds = encode_quantized_vertex_buffers(mesh, gltf_fmt, quantization)
+    else:
+        vb_stream = io.BytesIO()
+        write_vb_stream(mesh['vb'], vb_stream, gltf_fmt, e='<', interleave = False)
+        vb_bytes = vb_stream.getvalue()
+        vb_stream.close()
+        bounds = {}
+        for element in range(len(gltf_fmt['elements'])):
+            if gltf_fmt['elements'][element]['SemanticName'] == 'POSITION':
+                bounds[element] = [[max([x[j] for x in mesh['vb'][element]['Buffer']]) for j in range(3)],
+                    [min([x[j] for x in mesh['vb'][element]['Buffer']]) for j in range(3)]]
+    # Index Buffers
+    ib_stream = io.BytesIO()
+    write_ib_stream(mesh['ib'], ib_stream, gltf_fmt, e='<')
+    # IB can be 16-bit so can be misaligned, unlike VB
+    while (ib_stream.tell() % 4) > 0:
+        ib_stream.write(b'\x00')
+    ib_bytes = ib_stream.getvalue()
+    ib_stream.close()
+    geometry_hash = hashlib.sha1()
+    geometry_hash.update(json.dumps([[x['SemanticName'], x['Format']] for x in gltf_fmt['elements']]
+        + [gltf_fmt['format']] + ([quantization] if quantization != None else [])).encode())
+    geometry_hash.update(struct.pack("<2Q", len(vb_bytes), len(ib_bytes)))
+    geometry_hash.update(vb_bytes)
+    geometry_hash.update(ib_bytes)
+    return({'fmt': gltf_fmt, 'vb': vb_bytes, 'ib': ib_bytes, 'hash': geometry_hash.digest(),
+        'counts': [len(mesh['vb'][x]['Buffer']) for x in range(len(gltf_fmt['elements']))],
+        'index_count': len([index for triangle in mesh['ib'] for index in triangle]), 'bounds': bounds,
+        'quantization': quantization})
+
+# A mesh in meshes can also be {'gltf_geometry': encode_gltf_geometry(mesh)} if it has already been encoded,
+# in which case the vertex and index data can be any bytes-like object (e.g. a view of shared memory).
+# sink is where the files are written (see lib_filesink.py).  quantize writes the meshes that are not already
+# encoded with KHR_mesh_quantization (see mesh_position_quantization()).
 def write_gltf(base_name, skel_struct, vgmaps, mesh_blocks_info, meshes, material_struct,\
-        overwrite = False, write_binary_gltf = True):
+        overwrite = False, write_binary_gltf = True, interactive = True, sink = local_output, quantize = False):
     gltf_data = {}
     gltf_data['asset'] = { 'version': '2.0' }
     gltf_data['accessors'] = []
@@ -753,7 +862,9 @@ def write_gltf(base_name, skel_struct, vgmaps, mesh_blocks_info, meshes, materia
     gltf_data['scene'] = 0
     gltf_data['skins'] = []
     gltf_data['textures'] = []
-    giant_buffer = bytes()
+    # The binary buffer is kept as a list of pieces which are written out one after the other
+    buffer_chunks = []
+    buffer_length = 0
     buffer_view = 0
     # Materials
     material_dict = [{'name': material_struct[i]['name'],
@@ -804,6 +915,9 @@ def write_gltf(base_name, skel_struct, vgmaps, mesh_blocks_info, meshes, materia
             gltf_data['nodes'][0]['children'].append(len(gltf_data['nodes']))
             gltf_data['nodes'].append(g_node)
     mesh_block_tree = {x:[i for i in range(len(mesh_blocks_info)) if mesh_blocks_info[i]['mesh_v'] == x] for x in mesh_node_ids}
+    quantization = [None] * len(meshes)
+    if quantize == True:
+        quantization = mesh_position_quantization(meshes, [x['mesh_v'] for x in mesh_blocks_info])
     node_list = [x['name'] for x in gltf_data['nodes']]
     # Skin matrices
     skinning_possible = True
@@ -819,63 +933,63 @@ def write_gltf(base_name, skel_struct, vgmaps, mesh_blocks_info, meshes, materia
     except ValueError:
         skinning_possible = False
     # Meshes
+    # Identical submeshes (e.g. weapon variants, duplicated accessories) share one set of accessors, keyed by
+    # a hash of the encoded vertex and index payload.  Identical meshes likewise share one glTF mesh.
+    geometry_cache = {}
+    mesh_cache = {}
+    dedupe_stats = {'submeshes': 0, 'shared_submeshes': 0, 'shared_meshes': 0, 'bytes_saved': 0}
+    quantized = False
     for mesh in mesh_block_tree: #Mesh
         primitives = []
         for j in range(len(mesh_block_tree[mesh])): #Submesh
             i = mesh_block_tree[mesh][j]
-            # Vertex Buffer
-            gltf_fmt = convert_fmt_for_gltf(meshes[i]['fmt'])
-            vb_stream = io.BytesIO()
-            write_vb_stream(meshes[i]['vb'], vb_stream, gltf_fmt, e='<', interleave = False)
-            block_offset = len(giant_buffer)
-            primitive = {"attributes":{}}
-            for element in range(len(gltf_fmt['elements'])):
-                primitive["attributes"][gltf_fmt['elements'][element]['SemanticName']]\
-                    = len(gltf_data['accessors'])
+            geometry = meshes[i]['gltf_geometry'] if 'gltf_geometry' in meshes[i] \
+                else encode_gltf_geometry(meshes[i], quantization[i])
+            gltf_fmt, vb_bytes, ib_bytes, geometry_hash = geometry['fmt'], geometry['vb'], geometry['ib'], geometry['hash']
+            dedupe_stats['submeshes'] += 1
+            if geometry_hash in geometry_cache:
+                primitive = copy.deepcopy(geometry_cache[geometry_hash])
+                dedupe_stats['shared_submeshes'] += 1
+                dedupe_stats['bytes_saved'] += len(vb_bytes) + len(ib_bytes)
+            else:
+                block_offset = buffer_length
+                primitive = {"attributes":{}}
+                for element in range(len(gltf_fmt['elements'])):
+                    primitive["attributes"][gltf_fmt['elements'][element]['SemanticName']]\
+                        = len(gltf_data['accessors'])
+                    gltf_data['accessors'].append({"bufferView" : len(gltf_data['bufferViews']),\
+                        "componentType": gltf_fmt['elements'][element]['componentType'],\
+                        "count": geometry['counts'][element],\
+                        "type": gltf_fmt['elements'][element]['accessor_type']})
+                    if gltf_fmt['elements'][element].get('normalized', False) == True:
+                        gltf_data['accessors'][-1]['normalized'] = True
+                    if element in geometry['bounds']:
+                        gltf_data['accessors'][-1]['max'] = geometry['bounds'][element][0]
+                        gltf_data['accessors'][-1]['min'] = geometry['bounds'][element][1]
+                    gltf_data['bufferViews'].append({"buffer": 0,\
+                        "byteOffset": block_offset,\
+                        "byteLength": geometry['counts'][element] *\
+                        gltf_fmt['elements'][element]['componentStride'],\
+                        "target" : 34962})
+                    if 'byteStride' in gltf_fmt['elements'][element]:
+                        gltf_data['bufferViews'][-1]['byteStride'] = gltf_fmt['elements'][element]['byteStride']
+                    block_offset += geometry['counts'][element] *\
+                        gltf_fmt['elements'][element]['componentStride']
+                buffer_chunks.append(vb_bytes)
+                buffer_length += len(vb_bytes)
+                primitive["indices"] = len(gltf_data['accessors'])
                 gltf_data['accessors'].append({"bufferView" : len(gltf_data['bufferViews']),\
-                    "componentType": gltf_fmt['elements'][element]['componentType'],\
-                    "count": len(meshes[i]['vb'][element]['Buffer']),\
-                    "type": gltf_fmt['elements'][element]['accessor_type']})
-                if gltf_fmt['elements'][element]['SemanticName'] == 'POSITION':
-                    gltf_data['accessors'][-1]['max'] =\
-                        [max([x[0] for x in meshes[i]['vb'][element]['Buffer']]),\
-                         max([x[1] for x in meshes[i]['vb'][element]['Buffer']]),\
-                         max([x[2] for x in meshes[i]['vb'][element]['Buffer']])]
-                    gltf_data['accessors'][-1]['min'] =\
-                        [min([x[0] for x in meshes[i]['vb'][element]['Buffer']]),\
-                         min([x[1] for x in meshes[i]['vb'][element]['Buffer']]),\
-                         min([x[2] for x in meshes[i]['vb'][element]['Buffer']])]
+                    "componentType": gltf_fmt['componentType'],\
+                    "count": geometry['index_count'],\
+                    "type": gltf_fmt['accessor_type']})
                 gltf_data['bufferViews'].append({"buffer": 0,\
-                    "byteOffset": block_offset,\
-                    "byteLength": len(meshes[i]['vb'][element]['Buffer']) *\
-                    gltf_fmt['elements'][element]['componentStride'],\
-                    "target" : 34962})
-                block_offset += len(meshes[i]['vb'][element]['Buffer']) *\
-                    gltf_fmt['elements'][element]['componentStride']
-            vb_stream.seek(0)
-            giant_buffer += vb_stream.read()
-            vb_stream.close()
-            del(vb_stream)
-            # Index Buffers
-            ib_stream = io.BytesIO()
-            write_ib_stream(meshes[i]['ib'], ib_stream, gltf_fmt, e='<')
-            # IB is 16-bit so can be misaligned, unlike VB
-            while (ib_stream.tell() % 4) > 0:
-                ib_stream.write(b'\x00')
-            primitive["indices"] = len(gltf_data['accessors'])
-            gltf_data['accessors'].append({"bufferView" : len(gltf_data['bufferViews']),\
-                "componentType": gltf_fmt['componentType'],\
-                "count": len([index for triangle in meshes[i]['ib'] for index in triangle]),\
-                "type": gltf_fmt['accessor_type']})
-            gltf_data['bufferViews'].append({"buffer": 0,\
-                "byteOffset": len(giant_buffer),\
-                "byteLength": ib_stream.tell(),\
-                "target" : 34963})
-            ib_stream.seek(0)
-            giant_buffer += ib_stream.read()
-            ib_stream.close()
-            del(ib_stream)
-            primitive["mode"] = 4 #TRIANGLES
+                    "byteOffset": buffer_length,\
+                    "byteLength": len(ib_bytes),\
+                    "target" : 34963})
+                buffer_chunks.append(ib_bytes)
+                buffer_length += len(ib_bytes)
+                primitive["mode"] = 4 #TRIANGLES
+                geometry_cache[geometry_hash] = copy.deepcopy(primitive)
             primitive["material"] = mesh_blocks_info[i]['material']
             primitives.append(primitive)
         if len(primitives) > 0:
@@ -883,10 +997,31 @@ def write_gltf(base_name, skel_struct, vgmaps, mesh_blocks_info, meshes, materia
                 node_id = node_list.index(mesh_node_ids[mesh])
             else: # One of the pre-assigned nodes
                 node_id = node_id_list.index(mesh_blocks_info[i]["mesh_v"])
-            gltf_data['nodes'][node_id]['mesh'] = len(gltf_data['meshes'])
-            gltf_data['meshes'].append({"primitives": primitives, "name": mesh_node_ids[mesh]})
+            skinned = len(vgmaps[mesh_blocks_info[i]["vgmap"]]) > 0 and skinning_possible == True
+            mesh_quantization = geometry.get('quantization', None)
+            if mesh_quantization != None:
+                quantized = True
+                if not skinned: # Dequantized by the node, a child node if the node already has a transform
+                    if 'matrix' in gltf_data['nodes'][node_id] or 'children' in gltf_data['nodes'][node_id]:
+                        gltf_data['nodes'][node_id].setdefault('children', []).append(len(gltf_data['nodes']))
+                        gltf_data['nodes'].append({'name': mesh_node_ids[mesh]})
+                        node_id = len(gltf_data['nodes']) - 1
+                    gltf_data['nodes'][node_id]['matrix'] = dequantization_matrix(mesh_quantization)
+            mesh_key = json.dumps(primitives, sort_keys = True)
+            if mesh_key in mesh_cache: # Instance of a mesh already in the glTF, attach it to this node as well
+                gltf_data['nodes'][node_id]['mesh'] = mesh_cache[mesh_key]
+                dedupe_stats['shared_meshes'] += 1
+            else:
+                gltf_data['nodes'][node_id]['mesh'] = len(gltf_data['meshes'])
+                mesh_cache[mesh_key] = len(gltf_data['meshes'])
+                gltf_data['meshes'].append({"primitives": primitives, "name": mesh_node_ids[mesh]})
             # Skinning
-            if len(vgmaps[mesh_blocks_info[i]["vgmap"]]) > 0 and skinning_possible == True:
+            if skinned == True:
+                inv_mtx_buffer = inv_mtx_buffers[mesh_blocks_info[i]["vgmap"]]
+                if mesh_quantization != None: # Dequantized by the inverse bind matrices
+                    ibms = numpy.array(ibms_struct[mesh_blocks_info[i]["vgmap"]]).reshape(-1,4,4).transpose(0,2,1)
+                    dequantize = numpy.array(dequantization_matrix(mesh_quantization)).reshape(4,4).T
+                    inv_mtx_buffer = (ibms @ dequantize).transpose(0,2,1).astype('<f4').tobytes()
                 gltf_data['nodes'][node_id]['skin'] = len(gltf_data['skins'])
                 gltf_data['skins'].append({"inverseBindMatrices": len(gltf_data['accessors']),\
                     "joints": [node_list.index(x) for x in vgmaps[mesh_blocks_info[i]["vgmap"]]]})
@@ -895,162 +1030,411 @@ def write_gltf(base_name, skel_struct, vgmaps, mesh_blocks_info, meshes, materia
                     "count": len(ibms_struct[mesh_blocks_info[i]["vgmap"]]),\
                     "type": "MAT4"})
                 gltf_data['bufferViews'].append({"buffer": 0,\
-                    "byteOffset": len(giant_buffer),\
-                    "byteLength": len(inv_mtx_buffers[mesh_blocks_info[i]["vgmap"]])})
-                giant_buffer += inv_mtx_buffers[mesh_blocks_info[i]["vgmap"]]
+                    "byteOffset": buffer_length,\
+                    "byteLength": len(inv_mtx_buffer)})
+                buffer_chunks.append(inv_mtx_buffer)
+                buffer_length += len(inv_mtx_buffer)
+    if dedupe_stats['shared_submeshes'] > 0:
+        print("Shared geometry: {0} of {1} submeshes reused existing accessors ({2} meshes reused), {3} bytes saved.".format(
+            dedupe_stats['shared_submeshes'], dedupe_stats['submeshes'], dedupe_stats['shared_meshes'],
+            dedupe_stats['bytes_saved']))
+    if quantized == True:
+        gltf_data['extensionsUsed'] = ['KHR_mesh_quantization']
+        gltf_data['extensionsRequired'] = ['KHR_mesh_quantization']
     # Write GLB
-    gltf_data['buffers'].append({"byteLength": len(giant_buffer)})
-    if (os.path.exists(base_name + '.gltf') or os.path.exists(base_name + '.glb')) and (overwrite == False):
-        if str(input(base_name + ".glb/.gltf exists! Overwrite? (y/N) ")).lower()[0:1] == 'y':
-            overwrite = True
-    if (overwrite == True) or not (os.path.exists(base_name + '.gltf') or os.path.exists(base_name + '.glb')):
+    gltf_data['buffers'].append({"byteLength": buffer_length})
+    if (sink.exists(base_name + '.gltf') or sink.exists(base_name + '.glb')):
+        overwrite = confirm_overwrite(base_name + ".glb/.gltf", overwrite, interactive)
+    if (overwrite == True) or not (sink.exists(base_name + '.gltf') or sink.exists(base_name + '.glb')):
         if write_binary_gltf == True:
-            with open(base_name+'.glb', 'wb') as f:
+            written = [base_name + '.glb']
+            with sink.open(base_name+'.glb') as f:
                 jsondata = json.dumps(gltf_data).encode('utf-8')
                 jsondata += b' ' * (4 - len(jsondata) % 4)
-                f.write(struct.pack('<III', 1179937895, 2, 12 + 8 + len(jsondata) + 8 + len(giant_buffer)))
+                f.write(struct.pack('<III', 1179937895, 2, 12 + 8 + len(jsondata) + 8 + buffer_length))
                 f.write(struct.pack('<II', len(jsondata), 1313821514))
                 f.write(jsondata)
-                f.write(struct.pack('<II', len(giant_buffer), 5130562))
-                f.write(giant_buffer)
+                f.write(struct.pack('<II', buffer_length, 5130562))
+                for chunk in buffer_chunks:
+                    f.write(chunk)
         else:
             gltf_data['buffers'][0]["uri"] = base_name+'.bin'
-            with open(base_name+'.bin', 'wb') as f:
-                f.write(giant_buffer)
-            with open(base_name+'.gltf', 'wb') as f:
-                f.write(json.dumps(gltf_data, indent=4).encode("utf-8"))
+            written = [base_name + '.bin', base_name + '.gltf']
+            with sink.open(base_name+'.bin') as f:
+                for chunk in buffer_chunks:
+                    f.write(chunk)
+            sink.write(base_name+'.gltf', json.dumps(gltf_data, indent=4).encode("utf-8"))
+        return(written)
+    return([])
 
-def process_dlb (dlb_file, overwrite = False, write_raw_buffers = True, write_binary_gltf = True):
-    print("Processing {}...".format(dlb_file))
-    base_name = dlb_file.split('.TOMDLB_D')[0]
-    with open(dlb_file, 'rb') as f:
+# Reads the mesh table of section 6 (names, flags, materials and vertex / index counts) and the bone palette,
+# without reading any geometry or the .TOMDLP_P file.  offset should be toc[6].
+def read_mesh_table (f, offset, ctx):
+    f.seek(offset)
+    ctx.read(f, 'mesh_section_header')
+    section_6_toc = []
+    for _ in range(4):
+        offset = read_offset(f, ctx)
+        num_entries, = ctx.read(f, 'address')
+        section_6_toc.append({'offset': offset, 'num_entries': num_entries})
+    f.seek(section_6_toc[2]['offset'])
+    bone_palette_ids = struct.unpack("{}{}I".format(ctx.e, section_6_toc[2]['num_entries']), f.read(4 * section_6_toc[2]['num_entries']))
+    mesh_table = []
+    f.seek(section_6_toc[1]['offset'])
+    for i in range(section_6_toc[1]['num_entries']):
+        data = {}
+        data["mesh"], data["submesh"], data["node"], data["flags"], data["material"], _ = ctx.read(f, 'mesh')
+        string_offset = read_offset(f, ctx)
+        data_offset = read_offset(f, ctx)
+        ctx.read(f, 'address')
+        current_offset = f.tell()
+        data["name"] = read_string (f, string_offset)
+        f.seek(data_offset)
+        data["num_verts"], data["num_idx"], _, _ = ctx.read(f, 'mesh_data_header')
+        mesh_table.append(data)
+        f.seek(current_offset)
+    return(mesh_table, bone_palette_ids)
+
+# Estimates the work of exporting (or importing) a model from the mesh table in section 6 alone, without reading
+# the .TOMDLP_P file: vertex counts (weighted by the number of UV maps) and index counts of every submesh.
+# The unit is arbitrary, see lib_scheduler.py.
+def estimate_dlb_cost (dlb_file, source = local_files):
+    cost = 0
+    with source.open(dlb_file) as f:
         magic = f.read(4)
         if magic in [b'DPDF', b'FDPD']:
-            if magic == b'FDPD':
-                set_endianness('>')
-            unk_int, = struct.unpack("{}I".format(e), f.read(4))
+            ctx = FormatContext({b'DPDF': '<', b'FDPD': '>'}[magic])
+            unk_int, = struct.unpack("{}I".format(ctx.e), f.read(4))
             if not unk_int == 0:
                 f.seek(4,0)
-                set_address_size(4) # Zestiria
-            opening_dict = read_opening_dict (f)
-            dlp_file = opening_dict[0]
+                ctx.addr_size = 4 # Zestiria
+            read_opening_dict (f, ctx)
             magic = f.read(4)
             if magic in [b'BLDM', b'MDLB']:
-                unk_int2, = struct.unpack("{}I".format(e), f.read(4))
-                toc = [read_offset(f) for _ in range(12)]
+                f.seek(4,1)
+                toc = [read_offset(f, ctx) for _ in range(12)]
+                for submesh in read_mesh_table(f, toc[6], ctx)[0]:
+                    cost += (submesh['num_verts'] * (4 + (submesh['flags'] & 0xF))) + submesh['num_idx'] + 100
+    return(cost)
+
+# Reads a model into python structures without writing anything.  The .TOMDLP_P file is looked for next to the
+# .TOMDLB_D file, in the same source (see lib_filesource.py).  Returns False if the file is not a model or the
+# .TOMDLP_P is missing.
+def read_tomdlb (dlb_file, skeleton_file = '', interactive = True, source = local_files):
+    with source.open(dlb_file) as f:
+        magic = f.read(4)
+        if magic in [b'DPDF', b'FDPD']:
+            ctx = FormatContext({b'DPDF': '<', b'FDPD': '>'}[magic])
+            unk_int, = struct.unpack("{}I".format(ctx.e), f.read(4))
+            if not unk_int == 0:
+                f.seek(4,0)
+                ctx.addr_size = 4 # Zestiria
+            opening_dict = read_opening_dict (f, ctx)
+            dlp_file = os.path.join(os.path.dirname(dlb_file), opening_dict[0])
+            magic = f.read(4)
+            if magic in [b'BLDM', b'MDLB']:
+                unk_int2, = struct.unpack("{}I".format(ctx.e), f.read(4))
+                toc = [read_offset(f, ctx) for _ in range(12)]
                 #toc[0] - Nodes.  1 - (mesh) 0x16c, 0x82, mostly zeros (6x zero len sections) (skel) 0x10 header, 6 sections.  2 - 16 zero bytes, 3 - 0x16c, 0x82, mostly zeros.  
                 #4 - starts with 0x16c, 0x82, lots of floats.
                 #5 - offset1, count1, offset2, count2, 0x24 * count1 (u32, f32 *6, u32 *2), 0x24 * count2 (all f)
                 #6 - meshes.  7 - materials.  8,9,10,11 - dunno
-                if os.path.exists(dlp_file) or os.path.exists(dlp_file.upper()): # TLTool uses uppercase extension
-                    skel_struct, raw_skel_data = read_section_0(f, toc[0])
-                    physics_params = read_section_4 (f, toc[4])
-                    collision_data = read_section_5 (f, toc[5], decode_data = True)
-                    meshes, bone_palette_ids, mesh_blocks_info = read_section_6(f, toc[6], dlp_file)
+                if source.exists(dlp_file): # Case is ignored, TLTool uses uppercase extension
+                    model = {'opening_dict': opening_dict, 'dlp_file': dlp_file, 'external_files': []}
+                    model['skel_struct'], model['raw_skel_data'] = read_section_0(f, toc[0], ctx)
+                    model['physics_params'] = read_section_4 (f, toc[4], ctx)
+                    model['collision_data'] = read_section_5 (f, toc[5], ctx, decode_data = True)
+                    model['meshes'], model['bone_palette_ids'], model['mesh_blocks_info'] = read_section_6(f, toc[6],
+                        dlp_file, ctx, source)
                     # Attempt to incorporate an external skeleton (skipped if skeleton already complete)
-                    skel_struct = find_and_add_external_skeleton (skel_struct, bone_palette_ids)
-                    vgmap = {'bone_{}'.format(bone_palette_ids[i]):i for i in range(len(bone_palette_ids))}
-                    if all([y in [x['id'] for x in skel_struct] for y in bone_palette_ids]):
-                        skel_index = {skel_struct[i]['id']:i for i in range(len(skel_struct))}
-                        vgmap = {skel_struct[skel_index[bone_palette_ids[i]]]['name']:i for i in range(len(bone_palette_ids))}
-                    for i in range(len(mesh_blocks_info)):
-                        mesh_blocks_info[i]['vgmap'] = 0
-                    material_struct = read_section_7(f, toc[7])
-                    gltf_overwrite = copy.deepcopy(overwrite)
-                    if write_raw_buffers == True:
-                        if os.path.exists(base_name) and (os.path.isdir(base_name)) and (overwrite == False):
-                            if str(input(base_name + " folder exists! Overwrite? (y/N) ")).lower()[0:1] == 'y':
-                                overwrite = True
-                        if (overwrite == True) or not os.path.exists(base_name):
-                            if not os.path.exists(base_name):
-                                os.mkdir(base_name)
-                            for i in range(len(meshes)):
-                                if len(meshes[i]['ib']) > 0:
-                                    filename = '{0:02d}_{1}'.format(i, mesh_blocks_info[i]['name'])
-                                    write_fmt(meshes[i]['fmt'], '{0}/{1}.fmt'.format(base_name, filename))
-                                    write_ib(meshes[i]['ib'], '{0}/{1}.ib'.format(base_name, filename), meshes[i]['fmt'], '<')
-                                    write_vb(meshes[i]['vb'], '{0}/{1}.vb'.format(base_name, filename), meshes[i]['fmt'], '<')
-                                    open('{0}/{1}.vgmap'.format(base_name, filename), 'wb').write(json.dumps(vgmap,indent=4).encode())
-                            mesh_struct = [{y:x[y] for y in x if not any(
-                                ['offset' in y, 'num' in y])} for x in mesh_blocks_info]
-                            for i in range(len(mesh_struct)):
-                                mesh_struct[i]['material'] = material_struct[mesh_struct[i]['material']]['name']
-                            write_struct_to_json(physics_params, base_name + '/physics_info')
-                            local_bone_dict = [(raw_skel_data[2][i], raw_skel_data[5][i]) for i in range(len(raw_skel_data[2]))]
-                            for i in range(len(physics_params)):
-                                physics_params[i]['target_node'] = local_bone_dict[physics_params[i]['target_node']][1]
-                            mesh_struct = [{'id_referenceonly': i, **mesh_struct[i]} for i in range(len(mesh_struct))]
-                            #write_struct_to_json(raw_skel_data, base_name + '/skeleton_info')
-                            write_struct_to_json(mesh_struct, base_name + '/mesh_info')
-                            write_struct_to_json(physics_params, base_name + '/physics_info')
-                            #write_struct_to_json(collision_data, base_name + '/collision_info')
-                            write_struct_to_json(material_struct, base_name + '/material_info')
-                            write_struct_to_json(opening_dict, base_name + '/linked_files')
-                            #write_struct_to_json(skel_struct, base_name + '/skeleton_info')
-                    if combine_models_into_single_gltf == False:
-                        write_gltf(base_name, skel_struct, [vgmap], mesh_blocks_info, meshes, material_struct,\
-                            overwrite = gltf_overwrite, write_binary_gltf = write_binary_gltf)
+                    model['skel_struct'] = find_and_add_external_skeleton (model['skel_struct'], model['bone_palette_ids'],
+                        os.path.dirname(dlb_file), skeleton_file, interactive, model['external_files'], source)
+                    model['material_struct'] = read_section_7(f, toc[7], ctx)
+                    return(model)
                 else:
                     print("Skipping {0} as {1} not present...".format(dlb_file, dlp_file))
+    return False
+
+# Returns the key of the export cache for these .TOMDLB_D files (and their .TOMDLP_P files) and options,
+# or '' if any of them is not a model.  Only models that are plain files can be cached.
+def export_cache_key (dlb_files, options, source = local_files):
+    input_files = []
+    for dlb_file in dlb_files:
+        if source.local_path(dlb_file) == '':
+            return ''
+        with source.open(dlb_file) as f:
+            magic = f.read(4)
+            if not magic in [b'DPDF', b'FDPD']:
+                return ''
+            ctx = FormatContext({b'DPDF': '<', b'FDPD': '>'}[magic])
+            unk_int, = struct.unpack("{}I".format(ctx.e), f.read(4))
+            if not unk_int == 0:
+                f.seek(4,0)
+                ctx.addr_size = 4 # Zestiria
+            dlp_file = source.local_path(os.path.join(os.path.dirname(dlb_file), read_opening_dict(f, ctx)[0]))
+        if dlp_file == '':
+            return ''
+        input_files.extend([source.local_path(dlb_file), dlp_file])
+    return(make_cache_key(input_files, options,
+        [__name__, 'lib_fmtibvb', 'lib_schema', 'lib_meshpack', 'lib_exportcache']))
+
+# separate_gltf writes a .glb for this model alone, by default only when models are not being combined.
+# model is the output of read_tomdlb() if it has already been read (it will be modified), or a function that
+# returns it, which is only called if the model needs to be exported.  use_cache skips the export if the model,
+# the options and the outputs are unchanged since the last export (by default use_export_cache), and force
+# exports again regardless.  source is where the model is read from (see lib_filesource.py), the output is written
+# with the same folders as in the source.  sink is where the output is written (see lib_filesink.py), by default
+# plain files; archive_format 'zip' or 'tar' instead writes everything for this model into {model}.zip / .tar.
+# The export cache is only used for plain files.  quantize writes the glTF with KHR_mesh_quantization (see
+# mesh_position_quantization()).  Returns the list of files written.
+def process_dlb (dlb_file, overwrite = False, write_raw_buffers = True, write_binary_gltf = True, use_meshpack = False,
+        skeleton_file = '', interactive = True, separate_gltf = None, model = None, use_cache = None, force = False,
+        source = local_files, sink = None, archive_format = '', quantize = False):
+    print("Processing {}...".format(dlb_file))
+    base_name = dlb_file.split('.TOMDLB_D')[0]
+    if separate_gltf == None:
+        separate_gltf = not combine_models_into_single_gltf
+    if sink == None and archive_format in archive_formats:
+        archive_file = base_name + archive_formats[archive_format]
+        if os.path.exists(archive_file) and confirm_overwrite(archive_file, overwrite, interactive) == False:
+            return([])
+        if model == None:
+            model = read_tomdlb(dlb_file, skeleton_file, interactive, source)
+        if model == False:
+            return([])
+        sink = ArchiveSink(archive_file, archive_format, os.path.dirname(base_name))
+        try:
+            process_dlb(dlb_file, overwrite, write_raw_buffers, write_binary_gltf, use_meshpack, skeleton_file,
+                interactive, separate_gltf, model, source = source, sink = sink, quantize = quantize)
+        except:
+            sink.abort()
+            raise
+        sink.close()
+        return([archive_file])
+    if sink == None:
+        sink = local_output
+    cache_key = ''
+    if (use_export_cache if use_cache == None else use_cache) == True and sink.local == True:
+        cache_key = export_cache_key([dlb_file], [write_raw_buffers, write_binary_gltf, use_meshpack,
+            skeleton_file, separate_gltf, quantize], source)
+        if cache_key != '' and force == False and restore_cached_export(cache_key, os.path.dirname(dlb_file), overwrite):
+            print("{} is unchanged since the last export, skipping...".format(dlb_file))
+            return([])
+    if model == None:
+        model = read_tomdlb(dlb_file, skeleton_file, interactive, source)
+    elif callable(model):
+        model = model()
+    if model == False:
+        return([])
+    opening_dict, skel_struct, raw_skel_data, physics_params, meshes, bone_palette_ids, mesh_blocks_info, material_struct = \
+        [model[x] for x in ['opening_dict', 'skel_struct', 'raw_skel_data', 'physics_params', 'meshes',
+        'bone_palette_ids', 'mesh_blocks_info', 'material_struct']]
+    vgmap = {'bone_{}'.format(bone_palette_ids[i]):i for i in range(len(bone_palette_ids))}
+    if all([y in [x['id'] for x in skel_struct] for y in bone_palette_ids]):
+        skel_index = {skel_struct[i]['id']:i for i in range(len(skel_struct))}
+        vgmap = {skel_struct[skel_index[bone_palette_ids[i]]]['name']:i for i in range(len(bone_palette_ids))}
+    for i in range(len(mesh_blocks_info)):
+        mesh_blocks_info[i]['vgmap'] = 0
+    gltf_overwrite = copy.deepcopy(overwrite)
+    written, raw_buffers_written, gltf_written = [], False, []
+    if write_raw_buffers == True:
+        if sink.exists(base_name) and (os.path.isdir(base_name)):
+            overwrite = confirm_overwrite(base_name + " folder", overwrite, interactive)
+        if (overwrite == True) or not sink.exists(base_name):
+            meshpack_submeshes = []
+            for i in range(len(meshes)):
+                if len(meshes[i]['ib']) > 0:
+                    filename = '{0:02d}_{1}'.format(i, mesh_blocks_info[i]['name'])
+                    if use_meshpack == True:
+                        meshpack_submeshes.append({'name': filename, 'fmt': meshes[i]['fmt'],
+                            'ib': meshes[i]['ib'], 'vb': meshes[i]['vb'], 'vgmap': vgmap})
+                        continue
+                    with sink.open('{0}/{1}.fmt'.format(base_name, filename)) as f:
+                        write_fmt_stream(meshes[i]['fmt'], f)
+                    with sink.open('{0}/{1}.ib'.format(base_name, filename)) as f:
+                        write_ib_stream(meshes[i]['ib'], f, meshes[i]['fmt'], '<')
+                    with sink.open('{0}/{1}.vb'.format(base_name, filename)) as f:
+                        write_vb_stream(meshes[i]['vb'], f, meshes[i]['fmt'], '<')
+                    sink.write('{0}/{1}.vgmap'.format(base_name, filename), json.dumps(vgmap,indent=4).encode())
+                    written.extend(['{0}/{1}.{2}'.format(base_name, filename, x) for x in ['fmt', 'ib', 'vb', 'vgmap']])
+            if use_meshpack == True:
+                with sink.open('{0}/{1}'.format(base_name, meshpack_filename)) as f:
+                    write_meshpack_stream(meshpack_submeshes, f)
+                written.append('{0}/{1}'.format(base_name, meshpack_filename))
+            mesh_struct = [{y:x[y] for y in x if not any(
+                ['offset' in y, 'num' in y])} for x in mesh_blocks_info]
+            for i in range(len(mesh_struct)):
+                mesh_struct[i]['material'] = material_struct[mesh_struct[i]['material']]['name']
+            local_bone_dict = [(raw_skel_data[2][i], raw_skel_data[5][i]) for i in range(len(raw_skel_data[2]))]
+            for i in range(len(physics_params)):
+                physics_params[i]['target_node'] = local_bone_dict[physics_params[i]['target_node']][1]
+            mesh_struct = [{'id_referenceonly': i, **mesh_struct[i]} for i in range(len(mesh_struct))]
+            #write_struct_to_json(raw_skel_data, base_name + '/skeleton_info')
+            sink.write(base_name + '/mesh_info.json', json.dumps(mesh_struct, indent=4).encode("utf-8"))
+            sink.write(base_name + '/physics_info.json', json.dumps(physics_params, indent=4).encode("utf-8"))
+            #write_struct_to_json(collision_data, base_name + '/collision_info')
+            sink.write(base_name + '/material_info.json', json.dumps(material_struct, indent=4).encode("utf-8"))
+            sink.write(base_name + '/linked_files.json', json.dumps(opening_dict, indent=4).encode("utf-8"))
+            #write_struct_to_json(skel_struct, base_name + '/skeleton_info')
+            written.extend([base_name + x for x in ['/mesh_info.json', '/physics_info.json', '/material_info.json',
+                '/linked_files.json']])
+            raw_buffers_written = True
+    if separate_gltf == True:
+        gltf_written = write_gltf(base_name, skel_struct, [vgmap], mesh_blocks_info, meshes, material_struct,\
+            overwrite = gltf_overwrite, write_binary_gltf = write_binary_gltf, interactive = interactive, sink = sink,
+            quantize = quantize)
+        written.extend(gltf_written)
+    # Only complete exports are cached, an output that was not overwritten is not known to match
+    if cache_key != '' and len(written) > 0 and raw_buffers_written == write_raw_buffers and (len(gltf_written) > 0) == separate_gltf:
+        store_cached_export(cache_key, os.path.dirname(dlb_file), written, model.get('external_files', []))
+    return(written)
+
+# Reads one model for process_dlbs_combined(), with the geometry of every submesh already encoded for glTF.  Only
+# the skeleton is read if the .TOMDLP_P file is missing.  Returns False if the file is not a model.  quantize
+# encodes the geometry with KHR_mesh_quantization.
+def read_combined_part (dlb_file, source = local_files, quantize = False):
+    with source.open(dlb_file) as f:
+        magic = f.read(4)
+        if magic in [b'DPDF', b'FDPD']:
+            ctx = FormatContext({b'DPDF': '<', b'FDPD': '>'}[magic])
+            unk_int, = struct.unpack("{}I".format(ctx.e), f.read(4))
+            if not unk_int == 0:
+                f.seek(4,0)
+                ctx.addr_size = 4 # Zestiria
+            opening_dict = read_opening_dict (f, ctx)
+            dlp_file = os.path.join(os.path.dirname(dlb_file), opening_dict[0])
+            magic = f.read(4)
+            if magic in [b'BLDM', b'MDLB']:
+                unk_int2, = struct.unpack("{}I".format(ctx.e), f.read(4))
+                toc = [read_offset(f, ctx) for _ in range(12)]
+                part = {'dlp_file': dlp_file, 'meshes': False}
+                part['skel_struct'], _ = read_section_0(f, toc[0], ctx)
+                if source.exists(dlp_file): # Case is ignored, TLTool uses uppercase extension
+                    meshes, part['bone_palette_ids'], part['mesh_blocks_info'] = read_section_6(f, toc[6], dlp_file,
+                        ctx, source)
+                    part['material_struct'] = read_section_7(f, toc[7], ctx)
+                    quantization = [None] * len(meshes)
+                    if quantize == True:
+                        quantization = mesh_position_quantization(meshes, [x['mesh'] for x in part['mesh_blocks_info']])
+                    part['meshes'] = [{'gltf_geometry': encode_gltf_geometry(meshes[j], quantization[j])}
+                        for j in range(len(meshes))]
+                return(part)
+    return False
+
+# Shared memory blocks created by this (worker) process.  They stay open until the worker exits, so that the
+# parent can still attach to them on Windows, where a block disappears as soon as nobody has it open.
+worker_shared_memory = []
+
+# Runs in a worker process.  The encoded vertex and index bytes of the model are placed in one shared memory block,
+# and only their (offset, length) are sent back, along with the rest of the part.
+def read_combined_part_to_shared_memory (dlb_file, source = local_files, quantize = False):
+    part = read_combined_part(dlb_file, source, quantize)
+    if part == False or part['meshes'] == False:
+        return(part)
+    geometry = [x['gltf_geometry'] for x in part['meshes']]
+    shm = shared_memory.SharedMemory(create = True, size = max(sum([len(x['vb']) + len(x['ib']) for x in geometry]), 1))
+    worker_shared_memory.append(shm)
+    offset = 0
+    for i in range(len(geometry)):
+        for key in ['vb', 'ib']:
+            shm.buf[offset:offset + len(geometry[i][key])] = geometry[i][key]
+            geometry[i][key] = (offset, len(geometry[i][key]))
+            offset += geometry[i][key][1]
+    part['shared_memory'] = shm.name
+    return(part)
+
+# Decodes the models in worker processes.  Returns the parts with their vertex and index data as views of the
+# shared memory, and the blocks themselves, which must be released with release_shared_parts() afterwards.
+def read_combined_parts_parallel (dlb_files, workers = 0, source = local_files, quantize = False):
+    shared_blocks = []
+    if os.name == 'posix': # The workers must share this process's tracker, or each one unlinks its blocks on exit
+        resource_tracker.ensure_running()
+    with ProcessPoolExecutor(max_workers = workers if workers > 0 else None) as pool:
+        parts = list(pool.map(functools.partial(read_combined_part_to_shared_memory, source = source,
+            quantize = quantize), dlb_files))
+        # Attach while the workers still hold the blocks open
+        try:
+            for part in parts:
+                if part != False and 'shared_memory' in part:
+                    shm = shared_memory.SharedMemory(name = part['shared_memory'])
+                    shared_blocks.append(shm)
+                    for mesh in part['meshes']:
+                        for key in ['vb', 'ib']:
+                            offset, length = mesh['gltf_geometry'][key]
+                            mesh['gltf_geometry'][key] = shm.buf[offset:offset + length]
+        except:
+            release_shared_parts(parts, shared_blocks)
+            raise
+    return(parts, shared_blocks)
+
+def release_shared_parts (parts, shared_blocks):
+    # Every view has to be dropped before a block can be closed
+    for part in parts:
+        if part != False and part['meshes'] != False:
+            for mesh in part['meshes']:
+                if isinstance(mesh['gltf_geometry']['vb'], memoryview):
+                    mesh['gltf_geometry']['vb'].release()
+                if isinstance(mesh['gltf_geometry']['ib'], memoryview):
+                    mesh['gltf_geometry']['ib'].release()
+    for shm in shared_blocks:
+        shm.close()
+        shm.unlink()
     return
 
-def process_dlbs_combined (dlb_files, overwrite = False, write_binary_gltf = True):
+# use_cache and force work as in process_dlb().  Returns the list of files written.  With workers other than 1, the
+# models are decoded in parallel (workers 0 uses every CPU), and this process only merges the skeletons and writes
+# the glTF, reading the geometry straight from the workers' shared memory.  source, sink and quantize work as in
+# process_dlb().
+def process_dlbs_combined (dlb_files, overwrite = False, write_binary_gltf = True, skeleton_file = '', interactive = True,
+        use_cache = None, force = False, workers = 1, source = local_files, sink = None, quantize = False):
+    if sink == None:
+        sink = local_output
+    cache_key = ''
+    if (use_export_cache if use_cache == None else use_cache) == True and sink.local == True:
+        cache_key = export_cache_key(dlb_files, ['combined', write_binary_gltf, skeleton_file, quantize], source)
+        if cache_key != '' and force == False and restore_cached_export(cache_key, os.path.dirname(dlb_files[0]), overwrite):
+            print("Models are unchanged since the last combined export, skipping...")
+            return([])
+    if workers == 1 or len(dlb_files) < 2:
+        parts, shared_blocks = [read_combined_part(x, source, quantize) for x in dlb_files], []
+    else:
+        parts, shared_blocks = read_combined_parts_parallel(dlb_files, workers, source, quantize)
+    try:
+        return(write_combined_gltf(dlb_files, parts, overwrite, write_binary_gltf, skeleton_file, interactive, cache_key,
+            source, sink))
+    finally:
+        release_shared_parts(parts, shared_blocks)
+
+def write_combined_gltf (dlb_files, parts, overwrite, write_binary_gltf, skeleton_file, interactive, cache_key,
+        source = local_files, sink = local_output):
     skel_struct, meshes, bone_palettes, vgmaps, mesh_blocks_info, material_struct, tex_data = [], [], [], [], [], [], []
+    external_files = []
     gltf_overwrite = copy.deepcopy(overwrite)
     base_name_dict = {}
     for i in range(len(dlb_files)):
-        with open(dlb_files[i], 'rb') as f:
-            magic = f.read(4)
-            if magic in [b'DPDF', b'FDPD']:
-                if magic == b'FDPD':
-                    set_endianness('>')
-                unk_int, = struct.unpack("{}I".format(e), f.read(4))
-                if not unk_int == 0:
-                    f.seek(4,0)
-                    set_address_size(4) # Zestiria
-                opening_dict = read_opening_dict (f)
-                dlp_file = opening_dict[0]
-                magic = f.read(4)
-                if magic in [b'BLDM', b'MDLB']:
-                    unk_int2, = struct.unpack("{}I".format(e), f.read(4))
-                    toc = [read_offset(f) for _ in range(12)]
-                    new_skel_struct, _ = read_section_0(f, toc[0])
-                    # Prevent addition of repeated bones - although in my experiments probably not necessary
-                    unique_skel = [x for x in new_skel_struct if not x['id'] in [y['id'] for y in skel_struct]]
-                    skel_struct.extend(unique_skel) # At this point the children lists are garbage
+        if parts[i] != False:
+            # Prevent addition of repeated bones - although in my experiments probably not necessary
+            unique_skel = [x for x in parts[i]['skel_struct'] if not x['id'] in [y['id'] for y in skel_struct]]
+            skel_struct.extend(unique_skel) # At this point the children lists are garbage
     for i in range(len(dlb_files)):
         base_name = dlb_files[i].split('.TOMDLB_D')[0]
-        with open(dlb_files[i], 'rb') as f:
-            print("Processing {} for combined glTF...".format(dlb_files[i]))
-            magic = f.read(4)
-            if magic in [b'DPDF', b'FDPD']:
-                if magic == b'FDPD':
-                    set_endianness('>')
-                unk_int, = struct.unpack("{}I".format(e), f.read(4))
-                if not unk_int == 0:
-                    f.seek(4,0)
-                    set_address_size(4) # Zestiria
-                opening_dict = read_opening_dict (f)
-                dlp_file = opening_dict[0]
-                magic = f.read(4)
-                if magic in [b'BLDM', b'MDLB']:
-                    unk_int2, = struct.unpack("{}I".format(e), f.read(4))
-                    toc = [read_offset(f) for _ in range(12)]
-                    if os.path.exists(dlp_file) or os.path.exists(dlp_file.upper()): # TLTool uses uppercase extension
-                        meshes_i, bone_palette_ids_i, mesh_blocks_info_i = read_section_6(f, toc[6], dlp_file)
-                        material_struct_i = read_section_7(f, toc[7])
-                        base_name_dict[len(bone_palettes)] = base_name 
-                        for i in range(len(mesh_blocks_info_i)):
-                            mesh_blocks_info_i[i]['material'] = mesh_blocks_info_i[i]['material'] + len(material_struct)
-                            mesh_blocks_info_i[i]['vgmap'] = len(bone_palettes)
-                        bone_palettes.append(bone_palette_ids_i)
-                        meshes.extend(meshes_i)
-                        mesh_blocks_info.extend(mesh_blocks_info_i)
-                        material_struct.extend(material_struct_i)
-                    else:
-                        print("Skipping {0} as {1} not present...".format(dlb_files[i], dlp_file))
+        print("Processing {} for combined glTF...".format(dlb_files[i]))
+        if parts[i] != False:
+            if parts[i]['meshes'] != False:
+                mesh_blocks_info_i = parts[i]['mesh_blocks_info']
+                base_name_dict[len(bone_palettes)] = base_name 
+                for j in range(len(mesh_blocks_info_i)):
+                    mesh_blocks_info_i[j]['material'] = mesh_blocks_info_i[j]['material'] + len(material_struct)
+                    mesh_blocks_info_i[j]['vgmap'] = len(bone_palettes)
+                bone_palettes.append(parts[i]['bone_palette_ids'])
+                meshes.extend(parts[i]['meshes'])
+                mesh_blocks_info.extend(mesh_blocks_info_i)
+                material_struct.extend(parts[i]['material_struct'])
+            else:
+                print("Skipping {0} as {1} not present...".format(dlb_files[i], parts[i]['dlp_file']))
     bone_palette_ids = list(set([x for y in bone_palettes for x in y]))
-    skel_struct = find_and_add_external_skeleton (skel_struct, bone_palette_ids)
+    skel_struct = find_and_add_external_skeleton (skel_struct, bone_palette_ids,
+        os.path.dirname(dlb_files[0]), skeleton_file, interactive, external_files, source)
     for i in range(len(bone_palettes)):
         vgmap = {'bone_{}'.format(bone_palettes[i][j]):j for j in range(len(bone_palettes[i]))}
         if all([y in [x['id'] for x in skel_struct] for y in bone_palettes[i]]):
@@ -1064,13 +1448,16 @@ def process_dlbs_combined (dlb_files, overwrite = False, write_binary_gltf = Tru
         else:
             break
     if len(common_name) > 1:
-        base_name = common_name[:-1] if common_name[-1] == '_' else common_name
+        base_name = os.path.join(os.path.dirname(dlb_files[0]), common_name[:-1] if common_name[-1] == '_' else common_name)
     else:
         base_name = base_name + '_combined'
-    write_struct_to_json(skel_struct, base_name + '_full_skeleton')
-    write_gltf(base_name, skel_struct, vgmaps, mesh_blocks_info, meshes, material_struct,\
-        overwrite = gltf_overwrite, write_binary_gltf = write_binary_gltf)
-    return
+    sink.write(base_name + '_full_skeleton.json', json.dumps(skel_struct, indent=4).encode("utf-8"))
+    written = [base_name + '_full_skeleton.json'] + write_gltf(base_name, skel_struct, vgmaps, mesh_blocks_info,\
+        meshes, material_struct, overwrite = gltf_overwrite, write_binary_gltf = write_binary_gltf, interactive = interactive,
+        sink = sink)
+    if cache_key != '' and len(written) > 1:
+        store_cached_export(cache_key, os.path.dirname(dlb_files[0]), written, external_files)
+    return(written)
 
 if __name__ == "__main__":
     # Set current directory
@@ -1085,11 +1472,15 @@ if __name__ == "__main__":
         parser.add_argument('-t', '--textformat', help="Write gltf instead of glb", action="store_false")
         parser.add_argument('-s', '--skiprawbuffers', help="Skip writing fmt/ib/vb/vgmap files in addition to glb", action="store_false")
         parser.add_argument('-o', '--overwrite', help="Overwrite existing files", action="store_true")
+        parser.add_argument('-n', '--meshpack', help="Write raw buffers into a single meshes.npz instead of fmt/ib/vb/vgmap files", action="store_true")
+        parser.add_argument('-f', '--force', help="Export even if the model is unchanged since the last export", action="store_true")
+        parser.add_argument('-q', '--quantize', help="Write the glTF with KHR_mesh_quantization (smaller, slightly less precise)", action="store_true")
         parser.add_argument('dlb_filename', help="Name of dlb file to process.")
         args = parser.parse_args()
         if os.path.exists(args.dlb_filename) and args.dlb_filename[-5:] == 'DLB_D':
             process_dlb(args.dlb_filename, overwrite = args.overwrite, \
-                write_raw_buffers = args.skiprawbuffers, write_binary_gltf = args.textformat)
+                write_raw_buffers = args.skiprawbuffers, write_binary_gltf = args.textformat, use_meshpack = args.meshpack,
+                force = args.force, quantize = args.quantize)
     else:
         dlb_files = glob.glob('*.TOMDLB_D')
         # Remove external skeletons
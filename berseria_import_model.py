@@ -7,294 +7,340 @@
 # For command line options, run:
 # /path/to/python3 berseria_import_model.py --help
 #
-# Requires pyffi_tstrip module and lib_fmtibvb.py, put in the same directory
+# Requires pyffi_tstrip module, lib_fmtibvb.py, lib_schema.py, lib_meshpack.py, lib_endian.py, lib_prompt.py, lib_exportcache.py,
+# lib_filesource.py and lib_filesink.py, put in the same directory
+#
+# The model folder can also be read from {model}.zip / .tar, as written by berseria.py export-model --archive.
 #
 # GitHub eArmada8/berseria_model_tool
 
 try:
-    import struct, json, io, shutil, glob, os, sys
+    import struct, json, io, shutil, copy, tempfile, time, glob, os, sys, numpy
     from lib_fmtibvb import *
     from berseria_export_model import *
+    from lib_meshpack import read_meshpack, mapped_meshpack, meshpack_filename
+    from lib_endian import swap_tomdlb_endianness
+    from lib_filesource import open_source
     from pyffi_tstrip.tristrip import *
 except ModuleNotFoundError as err:
     print("Python module missing! {}".format(err.msg))
     input("Press Enter to abort.")
     raise
 
-# Global variables, do not edit
-addr_size = 8
-e = '<'
-
 # Input is a list of bytes / bytearrays.
 # Internal block is a first data block not in the table of contents, e.g. opening dict in BLDM
 # Returns the block, as well as the offset of the internal block
-def create_data_block (data_list, internal_block = bytearray(),
-        address_size = 8, data_alignment = 1, block_alignment = 8):
-    base_offset = address_size * len(data_list) + len(internal_block)
+def create_data_block (data_list, ctx, internal_block = bytearray(), data_alignment = 1, block_alignment = 8):
+    base_offset = ctx.addr_size * len(data_list) + len(internal_block)
     data_offset = [0]
     for i in range(len(data_list)):
         if len(data_list[i]) % data_alignment:
             data_list[i] += b'\x00' * (data_alignment - (len(data_list[i]) % data_alignment))
     for i in range(len(data_list)-1):
         data_offset.append(len(data_list[i]) + data_offset[i])
-    final_offset = [(base_offset + data_offset[i] - ((i)*address_size)) for i in range(len(data_list))]
-    offset_block = struct.pack("{}{}{}".format(e, len(final_offset), {4:"I", 8:"Q"}[address_size]),
+    final_offset = [(base_offset + data_offset[i] - ((i)*ctx.addr_size)) for i in range(len(data_list))]
+    offset_block = struct.pack("{}{}{}".format(ctx.e, len(final_offset), {4:"I", 8:"Q"}[ctx.addr_size]),
         *final_offset)
     data_block = b''.join(data_list)
     if len(data_block) % block_alignment:
         data_block += b'\x00' * (block_alignment - (len(data_block) % block_alignment))
     return ((offset_block + internal_block + data_block), len(offset_block))
 
-def write_string_dict (strings_list):
+def write_string_dict (strings_list, ctx):
     enc_strings = [bytearray(x.encode()) + b'\x00' for x in strings_list]
-    return create_data_block(enc_strings, b'', addr_size, 2, addr_size) # Data alignment of 2 otherwise default
+    return create_data_block(enc_strings, ctx, b'', 2, ctx.addr_size) # Data alignment of 2 otherwise default
 
-def read_physics_data (tomdlb_file, backup_phys_block, raw_skel_data):
+# model_folder is the folder with the exported files, by default the folder named after the model
+def read_physics_data (tomdlb_file, backup_phys_block, raw_skel_data, ctx, interactive = True, model_folder = ''):
+    model_folder = model_folder if model_folder != '' else tomdlb_file[:-9]
     # Will read data from JSON file, or load original data from the mdl file if JSON is missing
     try:
-        physics_params = read_struct_from_json(tomdlb_file[:-9] + "/physics_info.json")
+        physics_params = read_struct_from_json(model_folder + "/physics_info.json", interactive = interactive)
         local_bone_dict = {raw_skel_data[5][i]:i for i in range(len(raw_skel_data[2]))}
         for i in range(len(physics_params)):
             physics_params[i]['target_node'] = local_bone_dict[physics_params[i]['target_node']]
     except:
         print("{0}/physics_info.json missing or unreadable, reading data from {0}.TOMBDLB_D instead...".format(tomdlb_file[-9:]))
         with io.BytesIO(backup_phys_block) as ff:
-            physics_params = read_section_4 (ff, 0)
+            physics_params = read_section_4 (ff, 0, ctx)
     return physics_params
 
-def read_material_data (tomdlb_file, backup_mat_block):
+def read_material_data (tomdlb_file, backup_mat_block, ctx, interactive = True, model_folder = ''):
+    model_folder = model_folder if model_folder != '' else tomdlb_file[:-9]
     # Will read data from JSON file, or load original data from the mdl file if JSON is missing
     try:
-        material_struct = read_struct_from_json(tomdlb_file[:-9] + "/material_info.json")
+        material_struct = read_struct_from_json(model_folder + "/material_info.json", interactive = interactive)
     except:
         print("{0}/material_info.json missing or unreadable, reading data from {0}.TOMBDLB_D instead...".format(tomdlb_file[-9:]))
         with io.BytesIO(backup_mat_block) as ff:
-            material_struct = read_section_7 (ff, 0)
+            material_struct = read_section_7 (ff, 0, ctx)
     return material_struct
 
-#This function is purely for flipping endianness
-def write_generic_int_section (int_list):
-    return(struct.pack("{}{}I".format(e, len(int_list)), *int_list))
-
 #Hierarchy
-def create_section_0 (raw_skel_struct):
+def create_section_0 (raw_skel_struct, ctx):
     header_block = bytearray()
     data_block = bytearray()
-    header_size = (addr_size * 16)
-    data_block.extend(struct.pack("{}2{}4Hfi6f".format(e, {4: "I", 8: "Q"}[addr_size]), *raw_skel_struct[1]))
+    header_size = (ctx.addr_size * 16)
+    data_block.extend(ctx.pack('skeleton_unk_block', *raw_skel_struct[1]))
     for i in range(2,10):
         count = len(raw_skel_struct[i])
         if i == 2:
-            data = struct.pack("{}{}I".format(e, count), *raw_skel_struct[i])
+            data = struct.pack("{}{}I".format(ctx.e, count), *raw_skel_struct[i])
         elif i == 3:
-            data = struct.pack("{}{}i".format(e, count), *raw_skel_struct[i])
+            data = struct.pack("{}{}i".format(ctx.e, count), *raw_skel_struct[i])
         elif i == 4:
-            data = struct.pack("{}{}h".format(e, 4 * count), *[x for y in raw_skel_struct[i] for x in y])
+            data = struct.pack("{}{}h".format(ctx.e, 4 * count), *[x for y in raw_skel_struct[i] for x in y])
         elif i == 5:
-            data, _ = write_string_dict (raw_skel_struct[i])
+            data, _ = write_string_dict (raw_skel_struct[i], ctx)
         elif i == 6:
             flat1 = [x for y in raw_skel_struct[i] for x in y]
             flat2 = [x for y in flat1 for x in y]
-            data = struct.pack("{}{}f".format(e, 32 * count), *flat2)
+            data = struct.pack("{}{}f".format(ctx.e, 32 * count), *flat2)
         elif i in [7,8]:
-            data = struct.pack("{}{}f".format(e, 16 * count), *[x for y in raw_skel_struct[i] for x in y])
+            data = struct.pack("{}{}f".format(ctx.e, 16 * count), *[x for y in raw_skel_struct[i] for x in y])
         elif i == 9:
-            data = struct.pack("{}{}h".format(e, count), *raw_skel_struct[i])
+            data = struct.pack("{}{}h".format(ctx.e, count), *raw_skel_struct[i])
         if count > 0:
-            header_block.extend(struct.pack("{}{}".format(e, {4: "I", 8: "Q"}[addr_size]), len(data_block) + header_size - len(header_block)))
-            header_block.extend(struct.pack("{}{}".format(e, {4: "I", 8: "Q"}[addr_size]), count))
+            header_block.extend(ctx.pack('address', len(data_block) + header_size - len(header_block)))
+            header_block.extend(ctx.pack('address', count))
         else:
-            header_block.extend(struct.pack("{}2{}".format(e, {4: "I", 8: "Q"}[addr_size]), 0, 0))
+            header_block.extend(ctx.pack('pointer', 0, 0))
         data_block.extend(data)
-        if len(data_block) % addr_size:
-            data_block.extend(b'\x00' * (addr_size - (len(data_block) % addr_size)))
+        if len(data_block) % ctx.addr_size:
+            data_block.extend(b'\x00' * (ctx.addr_size - (len(data_block) % ctx.addr_size)))
         if i == 5: # The text block has extra padding
             data_block.extend(b'\x00' * 8)
-    return(struct.pack("{}3I6H".format(e), *raw_skel_struct[0]) + header_block + data_block)
+    return(ctx.pack('skeleton_header', *raw_skel_struct[0]) + header_block + data_block)
 
 #Physics
-def create_section_4 (physics_params, unk0 = 0, unk1 = 0):
+def create_section_4 (physics_params, ctx, unk0 = 0, unk1 = 0):
     raw_sec4_struct = [list(x.values()) for x in physics_params] # Remove dict keys
     data_block = bytearray()
-    data_block.extend(struct.pack("{}2I2H".format(e), unk0, unk1, len(raw_sec4_struct), len(raw_sec4_struct)))
-    if addr_size == 8:
-        data_block.extend(struct.pack("{}I".format(e), 0)) # Padding
+    data_block.extend(ctx.pack('physics_header', unk0, unk1, len(raw_sec4_struct), len(raw_sec4_struct)))
+    if ctx.addr_size == 8:
+        data_block.extend(struct.pack("{}I".format(ctx.e), 0)) # Padding
     if len(raw_sec4_struct) > 0:
-        data_block.extend(struct.pack("{}2{}".format(e, {4: "I", 8: "Q"}[addr_size]), 2 * addr_size, len(raw_sec4_struct)))
+        data_block.extend(ctx.pack('pointer', 2 * ctx.addr_size, len(raw_sec4_struct)))
     else:
-        data_block.extend(struct.pack("{}2{}".format(e, {4: "I", 8: "Q"}[addr_size]), 0, 0))
+        data_block.extend(ctx.pack('pointer', 0, 0))
     for i in range(len(raw_sec4_struct)):
-        data_block.extend(struct.pack("{}4h25f".format(e), *raw_sec4_struct[i]))
-    if len(data_block) % addr_size:
-        data_block.extend(b'\x00' * (addr_size - (len(data_block) % addr_size)))
+        data_block.extend(ctx.pack('physics', *raw_sec4_struct[i]))
+    if len(data_block) % ctx.addr_size:
+        data_block.extend(b'\x00' * (ctx.addr_size - (len(data_block) % ctx.addr_size)))
     return(data_block)
 
 #Collision
-def create_section_5 (raw_sec5_struct):
+def create_section_5 (raw_sec5_struct, ctx):
     header_block = bytearray()
     data_block = bytearray()
-    header_size = (addr_size * 4)
+    header_size = (ctx.addr_size * 4)
     for i in range(2):
         count = len(raw_sec5_struct[i])
         data = bytearray()
         for j in range(len(raw_sec5_struct[i])):
             if i == 0:
-                data.extend(struct.pack("{}2H6f2I".format(e), *raw_sec5_struct[i][j]))
+                data.extend(ctx.pack('collision', *raw_sec5_struct[i][j]))
             else:
-                data.extend(struct.pack("{}9f".format(e), *raw_sec5_struct[i][j]))
+                data.extend(ctx.pack('collision_triangle', *raw_sec5_struct[i][j]))
         if count > 0:
-            header_block.extend(struct.pack("{}{}".format(e, {4: "I", 8: "Q"}[addr_size]), len(data_block) + header_size - len(header_block)))
-            header_block.extend(struct.pack("{}{}".format(e, {4: "I", 8: "Q"}[addr_size]), count))
+            header_block.extend(ctx.pack('address', len(data_block) + header_size - len(header_block)))
+            header_block.extend(ctx.pack('address', count))
         else:
-            header_block.extend(struct.pack("{}2{}".format(e, {4: "I", 8: "Q"}[addr_size]), 0, 0))
+            header_block.extend(ctx.pack('pointer', 0, 0))
         data_block.extend(data)
-        if len(data_block) % addr_size:
-            data_block.extend(b'\x00' * (addr_size - (len(data_block) % addr_size)))
+        if len(data_block) % ctx.addr_size:
+            data_block.extend(b'\x00' * (ctx.addr_size - (len(data_block) % ctx.addr_size)))
     return(header_block + data_block)
 
 #Meshes
-def create_section_6 (tomdlb_file, backup_mesh_block, dlp_file, material_struct, unk0 = 0, unk1 = 0):
+# Input files of a submesh, used to tell if a cached build of the submesh is still valid
+def submesh_input_key (mesh_filename, mesh_block_info, meshpack_file, ctx):
+    files = [mesh_filename + x for x in ['.fmt', '.ib', '.vb', '.vb0']]
+    if not os.path.exists(mesh_filename + '.fmt'):
+        files.append(meshpack_file)
+    stats = [(x, os.stat(x).st_size, os.stat(x).st_mtime_ns) if os.path.exists(x) else (x,) for x in files]
+    return(tuple(stats) + (mesh_block_info["flags"], ctx.e, ctx.addr_size))
+
+# Packs vertex data one vertex after the other, as struct.pack would one vertex at a time.  columns is a list of
+# (array with one row per vertex, struct type), e.g. [(positions, 'f'), (blend_indices, 'B')].
+def pack_vertex_columns (columns, ctx):
+    dtype = numpy.dtype([('c{}'.format(i), ctx.e + {'f': 'f4', 'i': 'i4', 'B': 'u1'}[columns[i][1]],
+        columns[i][0].shape[1:]) for i in range(len(columns))])
+    records = numpy.empty(len(columns[0][0]), dtype = dtype)
+    for i in range(len(columns)):
+        records['c{}'.format(i)] = columns[i][0]
+    return(bytearray(records.tobytes()))
+
+def pack_index_block (ib, ctx):
+    ib_block = bytearray(numpy.asarray(ib).astype(ctx.e + 'u2').tobytes()) # Triangles
+    if len(ib_block) % 4:
+        ib_block += b'\x00' * (4 - (len(ib_block) % 4))
+    return(ib_block)
+
+# Builds the vertex, index and weight data of one submesh, the slow part of the import (mostly triangle stripping).
+# The buffers can be lists (read from .vb files) or arrays (mapped from the mesh pack), they are packed as arrays.
+# Returns False if the mesh type is not supported.
+def build_submesh (mesh_filename, mesh_block_info, meshpack, ctx):
+    num_uvs = (mesh_block_info["flags"] & 0xF)
+    try:
+        if not os.path.exists(mesh_filename + '.fmt') and os.path.basename(mesh_filename) in meshpack:
+            submesh = meshpack[os.path.basename(mesh_filename)]
+            fmt, ib, vb = submesh['fmt'], submesh['ib'].tolist(), submesh['vb']
+        else:
+            fmt = read_fmt(mesh_filename + '.fmt')
+            ib = read_ib(mesh_filename + '.ib', fmt)
+            vb = read_vb(mesh_filename + '.vb', fmt)
+        ib = stripify(ib, stitchstrips = True)[0]
+        assert ([x['SemanticName'] for x in fmt['elements']]
+            == ['POSITION', 'NORMAL']
+            + ['TEXCOORD'] * num_uvs
+            + ['BLENDWEIGHTS', 'BLENDINDICES'])
+        stride_semantic = 'vb0 stride' if 'vb0 stride' in fmt else 'stride'
+        assert (int(fmt[stride_semantic]) == 44 + (8 * (mesh_block_info["flags"] & 0xF)))
+        assert len(ib) > 2
+    except (FileNotFoundError, AssertionError) as err:
+        print("Submesh {0} not found or corrupt, generating an empty submesh...".format(mesh_filename))
+        # Generate an empty submesh
+        fmt = make_fmt(num_uvs)
+        ib = [0,0,0]
+        vb = [{'Buffer':[[0.0, 0.0, 0.0]]}, {'Buffer':[[0.0, 0.0, 0.0]]}]
+        vb.extend([{'Buffer':[[0.0, 0.0]]} for _ in range(num_uvs)])
+        vb.extend([{'Buffer':[[1.0, 0.0, 0.0, 0.0]]}, {'Buffer':[[0, 0, 0, 0]]}])
+    print("Processing submesh {0}...".format(mesh_filename))
+    positions = numpy.asarray(vb[0]['Buffer']).reshape(-1,3)
+    normals = numpy.asarray(vb[1]['Buffer']).reshape(-1,3)
+    uvs = [(numpy.asarray(vb[2+l]['Buffer']).reshape(-1,2), 'f') for l in range(num_uvs)]
+    padding = (numpy.full(len(positions), -1), 'i')
+    # Standard weighted meshes
+    if mesh_block_info["flags"] & 0xF0 == 0x50:
+        weights = numpy.asarray(vb[-2]['Buffer']).reshape(len(positions), -1)
+        blend_indices = numpy.asarray(vb[-1]['Buffer']).reshape(len(positions), -1)
+        # Split vertices into weight types (the number of weights in use), stored by type
+        vgrp = numpy.select([weights[:,3] != 0.0, weights[:,2] != 0.0, weights[:,1] != 0.0], [4, 3, 2], 1)
+        order = numpy.argsort(vgrp, kind = 'stable')
+        new_v_assgn = numpy.empty(len(order), dtype = 'int64')
+        new_v_assgn[order] = numpy.arange(len(order))
+        new_ib = new_v_assgn[numpy.asarray(ib, dtype = 'int64')]
+        group_counts = numpy.bincount(vgrp, minlength = 5)[1:]
+        submesh_datablock = bytearray()
+        submesh_datablock.extend(ctx.pack('weight_group_counts', *group_counts.tolist()))
+        group_starts = numpy.concatenate([[0], numpy.cumsum(group_counts)])
+        for j in range(len(group_counts)):
+            v = order[group_starts[j]:group_starts[j+1]]
+            # Vertices, normals, blend indices and blend weights (after the first, which is implied)
+            submesh_datablock.extend(pack_vertex_columns([(positions[v], 'f'), (normals[v], 'f'),
+                (blend_indices[v], 'B')] + ([(weights[v,:j], 'f')] if j > 0 else []), ctx))
+        uv_block = pack_vertex_columns([padding] + [(x[order], t) for x, t in uvs], ctx)
+        return({'vertex_count': len(positions), 'index_count': len(new_ib), 'uv_block': uv_block,
+            'ib_block': pack_index_block(new_ib, ctx), 'data_block': submesh_datablock})
+    # Unweighted meshes
+    elif mesh_block_info["flags"] & 0xF0 == 0x0:
+        uv_block = pack_vertex_columns([(positions, 'f'), (normals, 'f'), padding] + uvs, ctx)
+        return({'vertex_count': len(positions), 'index_count': len(ib), 'uv_block': uv_block,
+            'ib_block': pack_index_block(ib, ctx), 'data_block': struct.pack("{}5I".format(ctx.e), 0, 0, 0, 0, 0)})
+    # Unsupported mesh type, e.g. 0x70 mesh
+    else:
+        return False
+
+# original_mesh_data is (bone_palette_ids, mesh_blocks_info) of the original mesh block if already read.
+# submesh_cache is a dictionary of submesh builds that are reused while their input files are unchanged.
+def create_section_6 (tomdlb_file, backup_mesh_block, dlp_file, material_struct, read_ctx, ctx, unk0 = 0, unk1 = 0,
+        interactive = True, original_mesh_data = None, submesh_cache = None, model_folder = ''):
+    model_folder = model_folder if model_folder != '' else tomdlb_file[:-9]
     # We will need some information from the original block regardless, so we will read it
-    with io.BytesIO(backup_mesh_block) as ff:
-        original_meshes, bone_palette_ids, orig_mesh_blocks_info = read_section_6(ff, 0, dlp_file)
+    if original_mesh_data == None:
+        with io.BytesIO(backup_mesh_block) as ff:
+            original_meshes, bone_palette_ids, orig_mesh_blocks_info = read_section_6(ff, 0, dlp_file, read_ctx)
+    else:
+        bone_palette_ids, orig_mesh_blocks_info = copy.deepcopy(original_mesh_data)
     # Will read data from JSON file, or load original data from the mdl file if JSON is missing
     try:
-        mesh_blocks_info = read_struct_from_json(tomdlb_file[:-9] + "/mesh_info.json")
+        mesh_blocks_info = read_struct_from_json(model_folder + "/mesh_info.json", interactive = interactive)
     except:
         print("{0}/mesh_info.json missing or unreadable, using data from {0}.TOMBDLB_D instead...".format(tomdlb_file[-9:]))
         mesh_blocks_info = orig_mesh_blocks_info
+    # Submeshes that are not present as loose .fmt/.ib/.vb files will be taken from the mesh pack, if there is one
+    # The pack is closed once every submesh is built, so that it can be written again (e.g. while watching)
+    meshpack_file = model_folder + '/' + meshpack_filename
+    submeshes = []
+    with read_meshpack(meshpack_file) if os.path.exists(meshpack_file) else mapped_meshpack() as meshpack:
+        for i in range(len(mesh_blocks_info)):
+            safe_filename = "".join([x if x not in "\\/:*?<>|" else "_" for x in mesh_blocks_info[i]["name"]])
+            mesh_filename = model_folder + '/{0:02d}_{1}'.format(i, safe_filename)
+            if submesh_cache != None:
+                key = submesh_input_key(mesh_filename, mesh_blocks_info[i], meshpack_file, ctx)
+                if mesh_filename in submesh_cache and submesh_cache[mesh_filename][0] == key:
+                    submesh = submesh_cache[mesh_filename][1]
+                else:
+                    submesh = build_submesh(mesh_filename, mesh_blocks_info[i], meshpack, ctx)
+                    submesh_cache[mesh_filename] = (key, submesh)
+            else:
+                submesh = build_submesh(mesh_filename, mesh_blocks_info[i], meshpack, ctx)
+            if submesh == False:
+                return False, False
+            submeshes.append(submesh)
     material_dict = {material_struct[i]['name']: i for i in range(len(material_struct))}
     material_list = []
     sec_0 = bytearray()
     sec_1_header = bytearray()
-    sec_1_header_length = (addr_size * 3 + 0x10) * len(mesh_blocks_info)
+    sec_1_header_length = (ctx.addr_size * 3 + 0x10) * len(mesh_blocks_info)
     sec_1_data = bytearray()
     uvidx_data = bytearray()
     for i in range(len(mesh_blocks_info)):
         safe_filename = "".join([x if x not in "\\/:*?<>|" else "_" for x in mesh_blocks_info[i]["name"]])
-        num_uvs = (mesh_blocks_info[i]["flags"] & 0xF)
-        try:
-            mesh_filename = tomdlb_file[:-9] + '/{0:02d}_{1}'.format(i, safe_filename)
-            fmt = read_fmt(mesh_filename + '.fmt')
-            ib = stripify(read_ib(mesh_filename + '.ib', fmt), stitchstrips = True)[0]
-            vb = read_vb(mesh_filename + '.vb', fmt)
-            assert ([x['SemanticName'] for x in fmt['elements']]
-                == ['POSITION', 'NORMAL']
-                + ['TEXCOORD'] * num_uvs
-                + ['BLENDWEIGHTS', 'BLENDINDICES'])
-            stride_semantic = 'vb0 stride' if 'vb0 stride' in fmt else 'stride'
-            assert (int(fmt[stride_semantic]) == 44 + (8 * (mesh_blocks_info[i]["flags"] & 0xF)))
-            assert len(ib) > 2
-        except (FileNotFoundError, AssertionError) as err:
-            print("Submesh {0} not found or corrupt, generating an empty submesh...".format(mesh_filename))
-            # Generate an empty submesh
-            fmt = make_fmt(num_uvs)
-            ib = [0,0,0]
-            vb = [{'Buffer':[[0.0, 0.0, 0.0]]}, {'Buffer':[[0.0, 0.0, 0.0]]}]
-            vb.extend([{'Buffer':[[0.0, 0.0]]} for _ in range(num_uvs)])
-            vb.extend([{'Buffer':[[1.0, 0.0, 0.0, 0.0]]}, {'Buffer':[[0, 0, 0, 0]]}])
-        print("Processing submesh {0}...".format(mesh_filename))
+        submesh = submeshes[i]
         try:
             material_list.append(material_dict[mesh_blocks_info[i]["material"]])
         except KeyError: # Try legacy metadata format
             try:
-                material = read_struct_from_json(tomdlb_file[:-9] + '/{0:02d}_{1}.material'.format(i, safe_filename))
+                material = read_struct_from_json(model_folder + '/{0:02d}_{1}.material'.format(i, safe_filename),
+                    interactive = interactive)
                 material_list.append(material_dict[material['material']])
             except:
-                print("Unable to read material for {}!  The material assignment is either missing or invalid.".format(safe_filename))
-                input("Press Enter to quit.")
+                pause_on_error("Unable to read material for {}!  The material assignment is either missing or invalid.".format(
+                    safe_filename), interactive, action = "quit")
                 raise
         # I don't know what these are, in the sample models they are always 0.  Might be for non-mesh TOMDLB_D's
-        sec_0.extend(struct.pack("{}4I".format(e), 0, 0, 0, 0))
+        sec_0.extend(ctx.pack('mesh_unk_block', 0, 0, 0, 0))
         # Add basic data
-        sec_1_header.extend(struct.pack("{}i4hi".format(e), mesh_blocks_info[i]["mesh"], mesh_blocks_info[i]["submesh"],
+        sec_1_header.extend(ctx.pack('mesh', mesh_blocks_info[i]["mesh"], mesh_blocks_info[i]["submesh"],
             mesh_blocks_info[i]["node"], mesh_blocks_info[i]["flags"], material_list[-1],
             mesh_blocks_info[i]["unknown"]))
         data_block_start = len(sec_1_data)
         # Add mesh name
         offset = sec_1_header_length - len(sec_1_header) + len(sec_1_data)
-        sec_1_header.extend(struct.pack("{}{}".format(e, {4: "I", 8: "Q"}[addr_size]), offset))
+        sec_1_header.extend(ctx.pack('address', offset))
         sec_1_data.extend(mesh_blocks_info[i]["name"].encode()+b'\x00')
         if len(sec_1_data) % 4:
             sec_1_data += b'\x00' * (4 - (len(sec_1_data) % 4))
         # Add mesh data
         offset = sec_1_header_length - len(sec_1_header) + len(sec_1_data)
-        sec_1_header.extend(struct.pack("{}{}".format(e, {4: "I", 8: "Q"}[addr_size]), offset))
-        # Standard weighted meshes
-        if mesh_blocks_info[i]["flags"] & 0xF0 == 0x50:
-            # Split vertices into weight types
-            vgrp = [4 if not x[3]==0.0 else 3 if not x[2]==0.0 else 2 if not x[1]==0.0 else 1 for x in vb[-2]['Buffer']]
-            v_by_grp = [[k for k, vgrpval in enumerate(vgrp) if vgrpval == j] for j in range(1,5)]
-            new_v_assgn = {}
-            counter = 0
-            for j in range(len(v_by_grp)):
-                for k in range(len(v_by_grp[j])):
-                    new_v_assgn[v_by_grp[j][k]] = counter
-                    counter += 1
-            new_ib = [new_v_assgn[x] for x in ib]
-            submesh_datablock = bytearray()
-            submesh_datablock.extend(struct.pack("{}4I".format(e), *[len(x) for x in v_by_grp]))
-            uv_block = bytearray()
-            for j in range(len(v_by_grp)):
-                for k in range(len(v_by_grp[j])):
-                    submesh_datablock.extend(struct.pack("{}3f".format(e), *vb[0]['Buffer'][v_by_grp[j][k]])) # Vertices
-                    submesh_datablock.extend(struct.pack("{}3f".format(e), *vb[1]['Buffer'][v_by_grp[j][k]])) # Normals
-                    submesh_datablock.extend(struct.pack("{}4B".format(e), *vb[-1]['Buffer'][v_by_grp[j][k]])) # Blend indices
-                    if j > 0:
-                        submesh_datablock.extend(struct.pack("{}{}f".format(e, j),
-                            *vb[-2]['Buffer'][v_by_grp[j][k]][:j])) # Blend weights
-                    uv_block.extend(struct.pack("{}i".format(e), -1)) # Padding
-                    for l in range(num_uvs):
-                        uv_block.extend(struct.pack("{}2f".format(e), *vb[2+l]['Buffer'][v_by_grp[j][k]])) # UVs
-            new_ib_block = bytearray(struct.pack("{}{}H".format(e, len(new_ib)), *new_ib)) # Triangles
-            if len(new_ib_block) % 4:
-                new_ib_block += b'\x00' * (4 - (len(new_ib_block) % 4))
-            sec_1_data.extend(struct.pack("{}2HI".format(e), len(vb[0]['Buffer']), len(new_ib), len(uvidx_data)))
-            uvidx_data.extend(uv_block)
-            sec_1_data.extend(struct.pack("{}I".format(e), len(uvidx_data)))
-            uvidx_data.extend(new_ib_block)
-            sec_1_data.extend(submesh_datablock)
-            sec_1_header.extend(struct.pack("{}{}".format(e, {4: "I", 8: "Q"}[addr_size]), len(submesh_datablock) + 0xC))
-        # Unweighted meshes
-        elif mesh_blocks_info[i]["flags"] & 0xF0 == 0x0:
-            uv_block = bytearray()
-            for j in range(len(vb[0]['Buffer'])):
-                uv_block.extend(struct.pack("{}3f".format(e), *vb[0]['Buffer'][j])) # Vertices
-                uv_block.extend(struct.pack("{}3f".format(e), *vb[1]['Buffer'][j])) # Normals
-                uv_block.extend(struct.pack("{}i".format(e), -1)) # Padding
-                for l in range(num_uvs):
-                    uv_block.extend(struct.pack("{}2f".format(e), *vb[2+l]['Buffer'][j])) # UVs
-            new_ib_block = bytearray(struct.pack("{}{}H".format(e, len(ib)), *ib)) # Triangles
-            if len(new_ib_block) % 4:
-                new_ib_block += b'\x00' * (4 - (len(new_ib_block) % 4))
-            sec_1_data.extend(struct.pack("{}2HI".format(e), len(vb[0]['Buffer']), len(ib), len(uvidx_data)))
-            uvidx_data.extend(uv_block)
-            sec_1_data.extend(struct.pack("{}I".format(e), len(uvidx_data)))
-            uvidx_data.extend(new_ib_block)
-            sec_1_data.extend(struct.pack("{}5I".format(e), 0, 0, 0, 0, 0))
-            sec_1_header.extend(struct.pack("{}{}".format(e, {4: "I", 8: "Q"}[addr_size]), 0x20))
-        # Unsupported mesh type, e.g. 0x70 mesh
-        else:
-            return False, False
+        sec_1_header.extend(ctx.pack('address', offset))
+        sec_1_data.extend(struct.pack("{}2HI".format(ctx.e), submesh['vertex_count'], submesh['index_count'], len(uvidx_data)))
+        uvidx_data.extend(submesh['uv_block'])
+        sec_1_data.extend(struct.pack("{}I".format(ctx.e), len(uvidx_data)))
+        uvidx_data.extend(submesh['ib_block'])
+        sec_1_data.extend(submesh['data_block'])
+        sec_1_header.extend(ctx.pack('address', len(submesh['data_block']) + 0xC))
     sec_1 = sec_1_header + sec_1_data
-    sec_2 = bytearray(struct.pack("{}{}I".format(e, len(bone_palette_ids)), *bone_palette_ids))
-    sec_3 = struct.pack("{}2I".format(e), len(mesh_blocks_info), len(bone_palette_ids))
+    sec_2 = bytearray(struct.pack("{}{}I".format(ctx.e, len(bone_palette_ids)), *bone_palette_ids))
+    sec_3 = struct.pack("{}2I".format(ctx.e), len(mesh_blocks_info), len(bone_palette_ids))
     # Build offset header
     block_lengths = [len(sec_0), len(sec_1), len(sec_2), len(sec_3)]
-    block_offsets = [sum(block_lengths[:i], (addr_size * 8)-((addr_size * 2) * i)) if block_lengths[i] > 0 else 0
+    block_offsets = [sum(block_lengths[:i], (ctx.addr_size * 8)-((ctx.addr_size * 2) * i)) if block_lengths[i] > 0 else 0
         for i in range(len(block_lengths))]
     block_counts = [len(mesh_blocks_info), len(mesh_blocks_info), len(bone_palette_ids), 1]
     block_header = bytearray()
-    block_header.extend(struct.pack("{}4I".format(e), unk0, unk1, 0, 0))
+    block_header.extend(ctx.pack('mesh_section_header', unk0, unk1, 0, 0))
     for i in range(4):
-        block_header.extend(struct.pack("{}2{}".format(e, {4: "I", 8: "Q"}[addr_size]), block_offsets[i], block_counts[i]))
+        block_header.extend(ctx.pack('pointer', block_offsets[i], block_counts[i]))
     section_6 = bytearray(block_header + sec_0 + sec_1 + sec_2 + sec_3)
-    if len(section_6) % addr_size:
-        section_6 += b'\x00' * (addr_size - (len(section_6) % addr_size))
+    if len(section_6) % ctx.addr_size:
+        section_6 += b'\x00' * (ctx.addr_size - (len(section_6) % ctx.addr_size))
     return(section_6, uvidx_data)
 
 #Materials
-def create_section_7 (material_struct, unk0 = 0, unk1 = 0, symphonia_mode = False):
+def create_section_7 (material_struct, ctx, unk0 = 0, unk1 = 0, symphonia_mode = False):
     all_tex = sorted(list(set([x for y in [z['textures'] for z in material_struct] for x in y])))
     tex_dict = {all_tex[i]:i for i in range(len(all_tex))}
     tex_counter = 0
@@ -313,139 +359,137 @@ def create_section_7 (material_struct, unk0 = 0, unk1 = 0, symphonia_mode = Fals
             set_3.append(i)
             set_4.extend([i for _ in range(len(material_struct[i]['textures']))])
     # Build section 0 (Material parameters?)
-    set_0_header_len = (addr_size * 4 + 0x18)  * len(material_struct)
+    set_0_header_len = (ctx.addr_size * 4 + 0x18)  * len(material_struct)
     set_0_header = bytearray()
     set_0_data = bytearray()
     for i in range(len(material_struct)):
-        set_0_header.extend(struct.pack("{}I10h".format(e), *set_0_base[i]))
+        set_0_header.extend(ctx.pack('material', *set_0_base[i]))
         offset = set_0_header_len - len(set_0_header) + len(set_0_data)
-        set_0_header.extend(struct.pack("{}2{}".format(e, {4: "I", 8: "Q"}[addr_size]), offset, len(material_struct[i]['parameters']['mat_params'])))
-        set_0_data.extend(struct.pack("{}{}I".format(e, len(material_struct[i]['parameters']['mat_params'])),
+        set_0_header.extend(ctx.pack('pointer', offset, len(material_struct[i]['parameters']['mat_params'])))
+        set_0_data.extend(struct.pack("{}{}I".format(ctx.e, len(material_struct[i]['parameters']['mat_params'])),
             *list(material_struct[i]['parameters']['mat_params'].values())))
         offset = set_0_header_len - len(set_0_header) + len(set_0_data)
-        set_0_header.extend(struct.pack("{}2{}".format(e, {4: "I", 8: "Q"}[addr_size]), offset, len(material_struct[i]['parameters']['shader_params'])))
+        set_0_header.extend(ctx.pack('pointer', offset, len(material_struct[i]['parameters']['shader_params'])))
         if len(material_struct[i]['parameters']['shader_params']) == 0x17:
-            set_0_data.extend(struct.pack("{}8I4f4If6I".format(e, len(material_struct[i]['parameters']['shader_params'])),
+            set_0_data.extend(struct.pack("{}8I4f4If6I".format(ctx.e, len(material_struct[i]['parameters']['shader_params'])),
                 *list(material_struct[i]['parameters']['shader_params'].values())))
         elif len(material_struct[i]['parameters']['shader_params']) == 0x11:
-            set_0_data.extend(struct.pack("{}8I4f4If".format(e, len(material_struct[i]['parameters']['shader_params'])),
+            set_0_data.extend(struct.pack("{}8I4f4If".format(ctx.e, len(material_struct[i]['parameters']['shader_params'])),
                 *list(material_struct[i]['parameters']['shader_params'].values())))
         else:
-            set_0_data.extend(struct.pack("{}{}I".format(e, len(material_struct[i]['parameters']['shader_params'])),
+            set_0_data.extend(struct.pack("{}{}I".format(ctx.e, len(material_struct[i]['parameters']['shader_params'])),
                 *list(material_struct[i]['parameters']['shader_params'].values())))
     set_0_block = set_0_header + set_0_data
     # Build section 1 (Texture Pointers)
     set_1_block = bytearray()
     for i in range(len(set_1)):
-        set_1_block.extend(struct.pack("{}3h".format(e), *set_1[i]))
-    if len(set_1_block) % addr_size:
-        set_1_block += b'\x00' * (addr_size - (len(set_1_block) % addr_size))
+        set_1_block.extend(ctx.pack('texture_assignment', *set_1[i]))
+    if len(set_1_block) % ctx.addr_size:
+        set_1_block += b'\x00' * (ctx.addr_size - (len(set_1_block) % ctx.addr_size))
     # Build section 2 (Material name, etc)
-    set_2_header_len = (addr_size * 5) * len(material_struct)
+    set_2_header_len = (ctx.addr_size * 5) * len(material_struct)
     set_2_header = bytearray()
     set_2_data = bytearray()
     for i in range(len(material_struct)):
         offset = set_2_header_len - len(set_2_header) + len(set_2_data)
-        set_2_header.extend(struct.pack("{}2{}".format(e, {4: "I", 8: "Q"}[addr_size]), offset, len(material_struct[i]['parameters']['set_2_unk_0'])))
-        set_2_data.extend(struct.pack("{}{}I".format(e, len(material_struct[i]['parameters']['set_2_unk_0'])),
+        set_2_header.extend(ctx.pack('pointer', offset, len(material_struct[i]['parameters']['set_2_unk_0'])))
+        set_2_data.extend(struct.pack("{}{}I".format(ctx.e, len(material_struct[i]['parameters']['set_2_unk_0'])),
             *material_struct[i]['parameters']['set_2_unk_0']))
         offset = set_2_header_len - len(set_2_header) + len(set_2_data)
-        set_2_header.extend(struct.pack("{}2{}".format(e, {4: "I", 8: "Q"}[addr_size]), offset,
+        set_2_header.extend(ctx.pack('pointer', offset,
             len(material_struct[i]['parameters']['set_2_unk_1'])))
-        set_2_data.extend(struct.pack("{}{}I".format(e, len(material_struct[i]['parameters']['set_2_unk_1'])),
+        set_2_data.extend(struct.pack("{}{}I".format(ctx.e, len(material_struct[i]['parameters']['set_2_unk_1'])),
             *material_struct[i]['parameters']['set_2_unk_1']))
         offset = set_2_header_len - len(set_2_header) + len(set_2_data)
-        set_2_header.extend(struct.pack("{}{}".format(e, {4: "I", 8: "Q"}[addr_size]), offset))
+        set_2_header.extend(ctx.pack('address', offset))
         set_2_data.extend(material_struct[i]['name'].encode()+b'\x00')
         if len(set_2_data) % 4:
             set_2_data += b'\x00' * (4 - (len(set_2_data) % 4))
     set_2_block = set_2_header + set_2_data
     # Build section 3
     set_3_block = bytearray()
-    set_3_block.extend(struct.pack("{}{}h".format(e, len(set_3)), *set_3))
-    while len(set_3_block) % addr_size > 0:
-        set_3_block.extend(struct.pack("{}h".format(e), 0))
+    set_3_block.extend(struct.pack("{}{}h".format(ctx.e, len(set_3)), *set_3))
+    while len(set_3_block) % ctx.addr_size > 0:
+        set_3_block.extend(struct.pack("{}h".format(ctx.e), 0))
     # Build section 4
     set_4_block = bytearray()
-    set_4_block.extend(struct.pack("{}{}h".format(e, len(set_4)), *set_4))
-    while len(set_4_block) % addr_size > 0:
-        set_4_block.extend(struct.pack("{}h".format(e), 0))
+    set_4_block.extend(struct.pack("{}{}h".format(ctx.e, len(set_4)), *set_4))
+    while len(set_4_block) % ctx.addr_size > 0:
+        set_4_block.extend(struct.pack("{}h".format(ctx.e), 0))
     # Build section 5
     set_5_block = set_4_block
     # Build section 6 (Textures)
-    set_6_header_len = (addr_size + {4: 4, 8: 16}[addr_size]) * len(all_tex)
+    set_6_header_len = (ctx.addr_size + {4: 4, 8: 16}[ctx.addr_size]) * len(all_tex)
     set_6_header = bytearray()
     set_6_data = bytearray()
     for i in range(len(all_tex)):
         offset = set_6_header_len - len(set_6_header) + len(set_6_data)
-        set_6_header.extend(struct.pack("{}{}".format(e, {4: "I", 8: "Q"}[addr_size]), offset))
+        set_6_header.extend(ctx.pack('address', offset))
         set_6_data.extend(all_tex[i].encode()+b'\x00')
         if len(set_6_data) % 2:
             set_6_data += b'\x00' * (2 - (len(set_6_data) % 2))
-        set_6_header.extend(struct.pack("{}2{}".format(e, {4: "H", 8: "Q"}[addr_size]), 12, 0)) # SHORTS here in 32-bit format
-    if len(set_6_data) % addr_size:
-        set_6_data += b'\x00' * (addr_size - (len(set_6_data) % addr_size))
+        set_6_header.extend(struct.pack("{}2{}".format(ctx.e, {4: "H", 8: "Q"}[ctx.addr_size]), 12, 0)) # SHORTS here in 32-bit format
+    if len(set_6_data) % ctx.addr_size:
+        set_6_data += b'\x00' * (ctx.addr_size - (len(set_6_data) % ctx.addr_size))
     set_6_block = set_6_header + set_6_data
     # Build offset header
     count_3, count_4, count_5 = len(set_3), len(set_4), len(set_4)
     header_counts = [count_3*4, count_3, count_4*5, count_4*3, count_4, count_4, count_4, count_4]
     block_lengths = [len(set_0_block), len(set_1_block), len(set_2_block),
         len(set_3_block), len(set_4_block), len(set_5_block), len(set_6_block)]
-    block_offsets = [sum(block_lengths[:i], (addr_size * 14)-((addr_size * 2) * i)) if block_lengths[i] > 0 else 0
+    block_offsets = [sum(block_lengths[:i], (ctx.addr_size * 14)-((ctx.addr_size * 2) * i)) if block_lengths[i] > 0 else 0
         for i in range(len(block_lengths))]
     block_counts = [len(material_struct), len(set_1), len(material_struct), count_3, count_4, count_5, len(all_tex)]
     block_header = bytearray()
-    block_header.extend(struct.pack("{}2I8H".format(e), unk0, unk1, *header_counts))
+    block_header.extend(ctx.pack('material_section_header', unk0, unk1, *header_counts))
     for i in range(7):
-        block_header.extend(struct.pack("{}2{}".format(e, {4: "I", 8: "Q"}[addr_size]), block_offsets[i], block_counts[i]))
+        block_header.extend(ctx.pack('pointer', block_offsets[i], block_counts[i]))
     # Return assembled block
     return(block_header + set_0_block + set_1_block + set_2_block + set_3_block
         + set_4_block + set_5_block + set_6_block)
 
 #Animation defaults?
-def create_section_11 (raw_sec11_struct):
+def create_section_11 (raw_sec11_struct, ctx):
     header_block = bytearray()
     data_block = bytearray()
-    header_size = (addr_size * 4)
-    data_block.extend(b'\x00' * (addr_size + 8)) # Some sort of padding
+    header_size = (ctx.addr_size * 4)
+    data_block.extend(b'\x00' * (ctx.addr_size + 8)) # Some sort of padding
     for i in range(2):
         count = len(raw_sec11_struct[i])
         if i == 0:
-            data = struct.pack("{}{}Q".format(e, len(raw_sec11_struct[i])), *raw_sec11_struct[i])
+            data = struct.pack("{}{}Q".format(ctx.e, len(raw_sec11_struct[i])), *raw_sec11_struct[i])
         else:
-            data = struct.pack("{}{}f".format(e, len(raw_sec11_struct[i])), *raw_sec11_struct[i])
+            data = struct.pack("{}{}f".format(ctx.e, len(raw_sec11_struct[i])), *raw_sec11_struct[i])
         if count > 0:
-            header_block.extend(struct.pack("{}{}".format(e, {4: "I", 8: "Q"}[addr_size]), len(data_block) + header_size - len(header_block)))
-            header_block.extend(struct.pack("{}{}".format(e, {4: "I", 8: "Q"}[addr_size]), count))
+            header_block.extend(ctx.pack('address', len(data_block) + header_size - len(header_block)))
+            header_block.extend(ctx.pack('address', count))
         else:
-            header_block.extend(struct.pack("{}2{}".format(e, {4: "I", 8: "Q"}[addr_size]), 0, 0))
+            header_block.extend(ctx.pack('pointer', 0, 0))
         data_block.extend(data)
-        if len(data_block) % addr_size:
-            data_block.extend(b'\x00' * (addr_size - (len(data_block) % addr_size)))
+        if len(data_block) % ctx.addr_size:
+            data_block.extend(b'\x00' * (ctx.addr_size - (len(data_block) % ctx.addr_size)))
     return(header_block + data_block)
 
-def process_tomdlb (tomdlb_file, swap_endian = False):
-    global addr_size, e
-    print("Processing {}...".format(tomdlb_file))
+# Reads everything that the import needs from the original model, in the order it is written back.
+# Returns False if the file is not a model.
+def read_original_tomdlb (tomdlb_file, swap_endian = False):
     with open(tomdlb_file, 'rb') as f:
         magic = f.read(4)
         if magic in [b'DPDF', b'FDPD']:
-            if magic == b'FDPD':
-                e = '>' # Write mode
-                set_endianness('>') # Read mode
-            unk_int, = struct.unpack("{}I".format(e), f.read(4))
-            set_address_size(8)
+            read_ctx = FormatContext({b'DPDF': '<', b'FDPD': '>'}[magic])
+            unk_int, = struct.unpack("{}I".format(read_ctx.e), f.read(4))
             if not unk_int == 0:
                 f.seek(4,0)
-                addr_size = 4 # Write mode
-                set_address_size(4) # Read mode
-            opening_dict = read_opening_dict (f)
-            dlp_file = opening_dict[0]
-            anmb_file = opening_dict[1]
+                read_ctx.addr_size = 4
+            # Write context, only differs from the read context when swapping endianness
+            ctx = read_ctx.swapped() if swap_endian == True else FormatContext(read_ctx.e, read_ctx.addr_size)
+            opening_dict = read_opening_dict (f, read_ctx)
+            original = {'read_ctx': read_ctx, 'ctx': ctx, 'dlp_file': opening_dict[0], 'anmb_file': opening_dict[1],
+                'dlp_path': os.path.join(os.path.dirname(tomdlb_file), opening_dict[0])}
             magic = f.read(4)
             if magic in [b'BLDM', b'MDLB']:
-                unk_int2, = struct.unpack("{}I".format(e), f.read(4))
-                toc = [read_offset(f) for _ in range(12)]
+                original['unk_int2'], = struct.unpack("{}I".format(read_ctx.e), f.read(4))
+                toc = [read_offset(f, read_ctx) for _ in range(12)]
                 data_blocks = []
                 for i in range(len(toc)):
                     f.seek(toc[i])
@@ -453,71 +497,186 @@ def process_tomdlb (tomdlb_file, swap_endian = False):
                         data_blocks.append(f.read())
                     else:
                         data_blocks.append(f.read(toc[i+1] - toc[i]))
-                skel_struct, raw_skel_data = read_section_0(f, toc[0])
-                physics_params = read_physics_data (tomdlb_file, data_blocks[4], raw_skel_data)
-                # Read material information (needed for both building mesh and material blocks)
-                material_struct = read_material_data (tomdlb_file, data_blocks[7])
-                phys_unk = struct.unpack("{}2I".format(e), data_blocks[4][0:8]) # Date stamp?
-                mesh_unk = struct.unpack("{}2I".format(e), data_blocks[6][0:8]) # Date stamp?
-                mat_unk = struct.unpack("{}2I8H".format(e), data_blocks[7][0:24]) # Same as above
-                symphonia_mode = True if sum(mat_unk[2:]) > 0 else False
+                original['data_blocks'] = data_blocks
+                skel_struct, original['raw_skel_data'] = read_section_0(f, toc[0], read_ctx)
+                original['phys_unk'] = struct.unpack("{}2I".format(read_ctx.e), data_blocks[4][0:8]) # Date stamp?
+                original['mesh_unk'] = struct.unpack("{}2I".format(read_ctx.e), data_blocks[6][0:8]) # Date stamp?
+                original['mat_unk'] = struct.unpack("{}2I8H".format(read_ctx.e), data_blocks[7][0:24]) # Same as above
+                original['symphonia_mode'] = True if sum(original['mat_unk'][2:]) > 0 else False
+                # Sections that are not rebuilt are byteswapped as-is
+                original['passthrough_blocks'] = list(data_blocks)
                 if swap_endian == True:
-                    # Changing e will change endianness for this script *only*; do not call set_endianness()!
-                    e = {'>': '<', '<': '>'}[e] # Write mode
-                    data_blocks[0] = create_section_0(raw_skel_data)
-                    data_blocks[5] = create_section_5(read_section_5 (f, toc[5]))
-                    data_blocks[11] = create_section_11(read_section_11 (f, toc[11]))
-                    for i in [1,2,3,8,9,10]:
-                        data_blocks[i] = write_generic_int_section(read_generic_int_section(f, toc[i], (toc[i+1]-toc[i])))
-                # Create new physics block
-                if symphonia_mode == False:
-                    data_blocks[4] = create_section_4(physics_params, phys_unk[0], phys_unk[1])
-                # Create new mesh block
-                data_blocks[6], dlp_block = create_section_6(tomdlb_file, data_blocks[6],
-                    dlp_file, material_struct, mesh_unk[0], mesh_unk[1])
-                if dlp_block == False: # Rebuild failed, due to unsupported mesh type
-                    print("Unsupported mesh detected, skipping {}...".format(tomdlb_file))
-                    return False
-                # Create new material block
-                data_blocks[7] = create_section_7(material_struct, mat_unk[0], mat_unk[1], symphonia_mode)
-                # Create new opening dictionary
-                all_tex = sorted(list(set([x+'.totexb_d' for y in [z['textures'] for z in material_struct] for x in y])))
-                new_opening_dict_strings = [dlp_file, anmb_file] + all_tex
-                new_opening_dict = write_string_dict(new_opening_dict_strings)[0]
-                # Create new internal file (BLDM block)
-                new_bldm_block, dict_offset = create_data_block (data_blocks, new_opening_dict, addr_size, 1, addr_size)
-                # Instead of overwriting backups, it will just tag a number onto the end
-                backup_suffix = ''
-                if os.path.exists(tomdlb_file + '.bak' + backup_suffix):
-                    backup_suffix = '1'
-                    if os.path.exists(tomdlb_file + '.bak' + backup_suffix):
-                        while os.path.exists(tomdlb_file + '.bak' + backup_suffix):
-                            backup_suffix = str(int(backup_suffix) + 1)
-                    shutil.copy2(tomdlb_file, tomdlb_file + '.bak' + backup_suffix)
-                else:
-                    shutil.copy2(tomdlb_file, tomdlb_file + '.bak')
-                with open(tomdlb_file, 'wb') as ff:
-                    ff.write({'<': b'DPDF', '>': b'FDPD'}[e])
-                    if addr_size == 8:
-                        ff.write(struct.pack("{}I".format(e), 0))
-                    ff.write(struct.pack("{}2{}".format(e, {4: "I", 8: "Q"}[addr_size]), dict_offset + (addr_size * 2 + 8),
-                        len(new_opening_dict_strings)))
-                    ff.write({'<': b'BLDM', '>': b'MDLB'}[e] + struct.pack("{}I".format(e), unk_int2))
-                    ff.write(new_bldm_block)
-                # Next write TOMDLP_P file
-                backup_suffix = ''
-                if os.path.exists(dlp_file + '.bak' + backup_suffix):
-                    backup_suffix = '1'
-                    if os.path.exists(dlp_file + '.bak' + backup_suffix):
-                        while os.path.exists(dlp_file + '.bak' + backup_suffix):
-                            backup_suffix = str(int(backup_suffix) + 1)
-                    shutil.copy2(dlp_file, dlp_file + '.bak' + backup_suffix)
-                else:
-                    shutil.copy2(dlp_file, dlp_file + '.bak')
-                with open(dlp_file, 'wb') as ff:
-                    ff.write(dlp_block)
+                    f.seek(0)
+                    try:
+                        swapped_dlb, _ = swap_tomdlb_endianness(f.read())
+                    except ValueError as e: # e.g. 0x70 meshes
+                        print(e)
+                        print("Unsupported mesh detected, skipping {}...".format(tomdlb_file))
+                        return False
+                    for i in [0,1,2,3,4,5,8,9,10,11]:
+                        original['passthrough_blocks'][i] = swapped_dlb[toc[i]:toc[i+1]] if i < len(toc) - 1 else swapped_dlb[toc[i]:]
+                return(original)
+    return False
+
+def write_with_backup (filename, data, make_backup = True):
+    # Instead of overwriting backups, it will just tag a number onto the end
+    if make_backup == True:
+        backup_suffix = ''
+        if os.path.exists(filename + '.bak' + backup_suffix):
+            backup_suffix = '1'
+            if os.path.exists(filename + '.bak' + backup_suffix):
+                while os.path.exists(filename + '.bak' + backup_suffix):
+                    backup_suffix = str(int(backup_suffix) + 1)
+            shutil.copy2(filename, filename + '.bak' + backup_suffix)
+        else:
+            shutil.copy2(filename, filename + '.bak')
+    with open(filename, 'wb') as ff:
+        ff.write(data)
+    return
+
+# Rebuilds the model from the original read by read_original_tomdlb() and the files in the model folder.
+# build_cache is a dictionary that keeps section and submesh builds between calls, so that only the parts whose
+# files have changed are rebuilt (see watch_tomdlbs()); it also makes sure that only the first call makes backups.
+def rebuild_tomdlb (tomdlb_file, original, interactive = True, build_cache = None, model_folder = ''):
+    model_folder = model_folder if model_folder != '' else tomdlb_file[:-9]
+    read_ctx, ctx, data_blocks = original['read_ctx'], original['ctx'], list(original['passthrough_blocks'])
+    if build_cache == None:
+        build_cache = {'first_build': True}
+    # Physics and material sections are only rebuilt if their JSON file has changed
+    json_stats = {x: (os.stat(x).st_size, os.stat(x).st_mtime_ns) if os.path.exists(x) else None
+        for x in [model_folder + "/physics_info.json", model_folder + "/material_info.json"]}
+    if not 'physics_key' in build_cache or build_cache['physics_key'] != json_stats[model_folder + "/physics_info.json"]:
+        physics_params = read_physics_data (tomdlb_file, original['data_blocks'][4], original['raw_skel_data'],
+            read_ctx, interactive, model_folder)
+        if original['symphonia_mode'] == False:
+            build_cache['section_4'] = create_section_4(physics_params, ctx, original['phys_unk'][0], original['phys_unk'][1])
+        else:
+            build_cache['section_4'] = data_blocks[4]
+        build_cache['physics_key'] = json_stats[model_folder + "/physics_info.json"]
+    # Read material information (needed for both building mesh and material blocks)
+    if not 'material_key' in build_cache or build_cache['material_key'] != json_stats[model_folder + "/material_info.json"]:
+        build_cache['material_struct'] = read_material_data (tomdlb_file, original['data_blocks'][7], read_ctx, interactive,
+            model_folder)
+        build_cache['section_7'] = create_section_7(build_cache['material_struct'], ctx, original['mat_unk'][0],
+            original['mat_unk'][1], original['symphonia_mode'])
+        build_cache['material_key'] = json_stats[model_folder + "/material_info.json"]
+    material_struct = build_cache['material_struct']
+    data_blocks[4], data_blocks[7] = build_cache['section_4'], build_cache['section_7']
+    if not 'original_mesh_data' in build_cache:
+        with io.BytesIO(original['data_blocks'][6]) as ff:
+            _, bone_palette_ids, orig_mesh_blocks_info = read_section_6(ff, 0, original['dlp_path'], read_ctx)
+        build_cache['original_mesh_data'] = (bone_palette_ids, orig_mesh_blocks_info)
+        build_cache['submeshes'] = {}
+    # Create new mesh block
+    data_blocks[6], dlp_block = create_section_6(tomdlb_file, original['data_blocks'][6],
+        original['dlp_path'], material_struct, read_ctx, ctx, original['mesh_unk'][0], original['mesh_unk'][1], interactive,
+        build_cache['original_mesh_data'], build_cache['submeshes'], model_folder)
+    if dlp_block == False: # Rebuild failed, due to unsupported mesh type
+        print("Unsupported mesh detected, skipping {}...".format(tomdlb_file))
+        return False
+    # Create new opening dictionary
+    all_tex = sorted(list(set([x+'.totexb_d' for y in [z['textures'] for z in material_struct] for x in y])))
+    new_opening_dict_strings = [original['dlp_file'], original['anmb_file']] + all_tex
+    new_opening_dict = write_string_dict(new_opening_dict_strings, ctx)[0]
+    # Create new internal file (BLDM block)
+    new_bldm_block, dict_offset = create_data_block (data_blocks, ctx, new_opening_dict, 1, ctx.addr_size)
+    new_dlb = bytearray({'<': b'DPDF', '>': b'FDPD'}[ctx.e])
+    if ctx.addr_size == 8:
+        new_dlb.extend(struct.pack("{}I".format(ctx.e), 0))
+    new_dlb.extend(ctx.pack('pointer', dict_offset + (ctx.addr_size * 2 + 8), len(new_opening_dict_strings)))
+    new_dlb.extend({'<': b'BLDM', '>': b'MDLB'}[ctx.e] + struct.pack("{}I".format(ctx.e), original['unk_int2']))
+    new_dlb.extend(new_bldm_block)
+    write_with_backup(tomdlb_file, new_dlb, build_cache['first_build'])
+    # Next write TOMDLP_P file
+    write_with_backup(original['dlp_path'], dlp_block, build_cache['first_build'])
+    build_cache['first_build'] = False
     return True
 
+# Returns the archive with the model folder and the name of the folder inside it, or ('', '').  archive_file is
+# an archive of several models (named relative to the current folder), otherwise {model}.zip / .tar is looked for.
+def find_model_archive (tomdlb_file, archive_file = ''):
+    if archive_file != '':
+        return(archive_file, os.path.relpath(tomdlb_file[:-9]).replace(os.sep, '/'))
+    for extension in ['.zip', '.tar']:
+        if os.path.exists(tomdlb_file[:-9] + extension):
+            return(tomdlb_file[:-9] + extension, os.path.basename(tomdlb_file[:-9]))
+    return('', '')
+
+# Copies the files of one model folder out of an archive into folder, returns the number of files
+def extract_model_folder (archive_file, member_folder, folder):
+    source = open_source(archive_file)
+    members = source.glob(member_folder + '/*')
+    for member in members:
+        with source.open(member) as f:
+            with open(os.path.join(folder, os.path.basename(member)), 'wb') as ff:
+                ff.write(f.read())
+    return(len(members))
+
+# The model folder is used if it exists, otherwise the model folder in archive_file or {model}.zip / .tar.
+def process_tomdlb (tomdlb_file, swap_endian = False, interactive = True, archive_file = ''):
+    print("Processing {}...".format(tomdlb_file))
+    original = read_original_tomdlb(tomdlb_file, swap_endian)
+    if original == False:
+        return True
+    archive_file, member_folder = ('', '') if os.path.isdir(tomdlb_file[:-9]) else find_model_archive(tomdlb_file, archive_file)
+    if archive_file == '':
+        return(rebuild_tomdlb(tomdlb_file, original, interactive))
+    with tempfile.TemporaryDirectory() as model_folder:
+        print("Reading {0} from {1}...".format(member_folder, archive_file))
+        if extract_model_folder(archive_file, member_folder, model_folder) == 0:
+            print("{0} not found in {1}!".format(member_folder, archive_file))
+        return(rebuild_tomdlb(tomdlb_file, original, interactive, model_folder = model_folder))
+
+# Files in the model folder that are read by a rebuild
+watched_extensions = ['.fmt', '.ib', '.vb', '.vb0', '.json', '.material', '.npz']
+
+def model_folder_state (tomdlb_file):
+    state = {}
+    for filename in glob.glob(os.path.join(glob.escape(tomdlb_file[:-9]), '*')):
+        if os.path.splitext(filename)[1].lower() in watched_extensions:
+            try:
+                stat = os.stat(filename)
+                state[filename] = (stat.st_size, stat.st_mtime_ns)
+            except FileNotFoundError: # Deleted while listing
+                pass
+    return(state)
+
+# Keeps the original models and the submesh builds in memory, and polls the model folders for changed files.
+# A model is rebuilt once its folder has not changed for settle_time seconds (so that a mesh export that writes
+# many files results in one rebuild), and only the submeshes and sections with changed files are built again.
+# Backups are only made by the first build.  Runs until interrupted with Ctrl+C.
+def watch_tomdlbs (tomdlb_files, swap_endian = False, poll_interval = 0.25, settle_time = 0.5):
+    models = {}
+    for tomdlb_file in tomdlb_files:
+        print("Processing {}...".format(tomdlb_file))
+        original = read_original_tomdlb(tomdlb_file, swap_endian)
+        if original == False:
+            print("{} is not a model, skipping...".format(tomdlb_file))
+            continue
+        models[tomdlb_file] = {'original': original, 'build_cache': {'first_build': True},
+            'seen_state': model_folder_state(tomdlb_file), 'built_state': {}, 'changed_time': 0.0}
+    print("Watching {} model folders for changes, press Ctrl+C to stop.".format(len(models)))
+    try:
+        while True:
+            for tomdlb_file in models:
+                model = models[tomdlb_file]
+                state = model_folder_state(tomdlb_file)
+                if state != model['seen_state']:
+                    model['seen_state'], model['changed_time'] = state, time.time()
+                elif state != model['built_state'] and time.time() - model['changed_time'] >= settle_time:
+                    start_time = time.perf_counter()
+                    try:
+                        if rebuild_tomdlb(tomdlb_file, model['original'], interactive = False,
+                                build_cache = model['build_cache']) == True:
+                            print("Rebuilt {0} in {1:.2f} seconds.".format(tomdlb_file, time.perf_counter() - start_time))
+                    except Exception as err:
+                        print("Rebuild of {0} failed!  {1}: {2}".format(tomdlb_file, type(err).__name__, err))
+                    model['built_state'] = state
+            time.sleep(poll_interval)
+    except KeyboardInterrupt:
+        print("Stopped watching.")
+    return
+
 if __name__ == "__main__":
     # Set current directory
     if getattr(sys, 'frozen', False):
@@ -531,11 +690,15 @@ if __name__ == "__main__":
         parser = argparse.ArgumentParser()
         parser.add_argument('tomdlb_filename', help="Name of tomdlb_d file to import into (required).")
         parser.add_argument('-s', '--swap_endian', help="Change endianness", action="store_true")
+        parser.add_argument('-w', '--watch', help="Keep running and rebuild whenever the model folder changes", action="store_true")
         args = parser.parse_args()
         if os.path.exists(args.tomdlb_filename) and args.tomdlb_filename[-9:].upper() == '.TOMDLB_D':
-            process_tomdlb(args.tomdlb_filename, swap_endian = args.swap_endian)
+            if args.watch == True:
+                watch_tomdlbs([args.tomdlb_filename], swap_endian = args.swap_endian)
+            else:
+                process_tomdlb(args.tomdlb_filename, swap_endian = args.swap_endian)
     else:
         tomdlb_files = glob.glob('*.TOMDLB_D')
-        tomdlb_files = [x for x in tomdlb_files if os.path.isdir(x[:-9])]
+        tomdlb_files = [x for x in tomdlb_files if os.path.isdir(x[:-9]) or find_model_archive(x)[0] != '']
         for i in range(len(tomdlb_files)):
             process_tomdlb(tomdlb_files[i])
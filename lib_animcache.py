@@ -0,0 +1,75 @@
+# A content addressed cache of decoded animation data, so that exporting an animation again (with another
+# skeleton, another output format, or other options) skips the DCT decoding, which is by far the slowest part.
+# Each animation is keyed by a hash of the animation file bytes and of the decoder (see decoder_version()), so an
+# edited file or an updated decoder never reuses stale data.
+#
+# The decoded entries of the data table of contents (animation_channel, see lib_channelstore.py) are packed into a
+# few flat float32 arrays and stored in one uncompressed .npz per animation; once read back, each channel is a view
+# of those arrays.  Only the entries that have actually been decoded are stored; entries decoded by a later export
+# are added to the same file.  The cache lives in a folder next to the animations (animation_cache_folder), and the
+# least recently used animations are dropped when the folder grows past animation_cache_max_size.
+#
+# GitHub eArmada8/berseria_model_tool
+
+try:
+    import hashlib, glob, io, os, numpy
+    from lib_exportcache import tool_version
+    from lib_channelstore import pack_channels, unpack_channels
+except ModuleNotFoundError as e:
+    print("Python module missing! {}".format(e.msg))
+    input("Press Enter to abort.")
+    raise
+
+# Increase to invalidate every cached animation
+animation_cache_version = 2
+animation_cache_folder = '_animation_cache'
+animation_cache_max_size = 256 * 1024 * 1024 # In bytes
+
+# Hash of the source code of the decoder (module_name), of this library and of the channel store
+def decoder_version (module_name):
+    return(tool_version((module_name, __name__, 'lib_channelstore')))
+
+# data is the bytes of the animation file
+def animation_cache_file (folder, data, module_name):
+    key = hashlib.sha256(str(animation_cache_version).encode())
+    key.update(decoder_version(module_name).encode())
+    key.update(data)
+    return(os.path.join(folder, animation_cache_folder, key.hexdigest() + '.npz'))
+
+# Returns the cached entries of an animation ({index in the data table of contents: animation_channel}), or {} if it
+# is not in the cache
+def read_cached_entries (cache_file):
+    import zipfile
+    try:
+        with open(cache_file, 'rb') as f:
+            arrays = numpy.load(io.BytesIO(f.read()))
+            entries = unpack_channels({x: arrays[x] for x in arrays.files})
+        os.utime(cache_file) # Most recently used
+    except (OSError, ValueError, KeyError, EOFError, zipfile.BadZipFile): # Missing, or cut short
+        return({})
+    return(entries)
+
+def write_cached_entries (cache_file, entries):
+    os.makedirs(os.path.dirname(cache_file), exist_ok = True)
+    temp_file = '{0}.{1}.tmp'.format(cache_file, os.getpid()) # Several processes can export the same animation
+    with open(temp_file, 'wb') as f:
+        numpy.savez(f, **pack_channels(entries))
+    os.replace(temp_file, cache_file)
+    evict_cached_animations(os.path.dirname(cache_file))
+    return
+
+# Drops the least recently used animations until the folder fits in max_size
+def evict_cached_animations (cache_folder, max_size = None):
+    if max_size == None:
+        max_size = animation_cache_max_size
+    # Other processes (berseria.py --jobs) may be writing and evicting in the same folder at the same time
+    try:
+        cache_files = [[x, os.stat(x)] for x in glob.glob(os.path.join(cache_folder, '*.npz'))]
+        lru_order = sorted(cache_files, key = lambda x: x[1].st_mtime_ns)
+        size = sum([x[1].st_size for x in cache_files])
+        while size > max_size and len(lru_order) > 1:
+            os.remove(lru_order[0][0])
+            size -= lru_order.pop(0)[1].st_size
+    except OSError:
+        pass
+    return
@@ -0,0 +1,195 @@
+# Builds a searchable SQLite catalog of a game dump, to answer questions such as "which models use this texture"
+# or "which scenes reference this model" without running the exporters.  Only the headers and tables of each file
+# are read: the linked file names at the top of models and scenes (.TOMDLB_D, .TOSNEB_D), the mesh table of
+# section 6 and the materials and texture names of section 7 of models, and the target table of animations
+# (.TOANMB, .TOANMSB).  No geometry or animation data is ever decoded.
+#
+# The catalog is refreshed incrementally: files whose size and modification time are unchanged since the last
+# scan are skipped, and files that no longer exist are dropped.  Paths are stored relative to the folder of the
+# database, with forward slashes, so a catalog can be moved along with the dump.
+#
+# Tables (see catalog_schema): files, links, meshes, materials, textures, anim_targets.
+#
+# GitHub eArmada8/berseria_model_tool
+
+try:
+    import sqlite3, struct, time, os
+    from lib_schema import *
+except ModuleNotFoundError as e:
+    print("Python module missing! {}".format(e.msg))
+    input("Press Enter to abort.")
+    raise
+
+# Increase when the tables or what is read into them change, to rebuild existing catalogs
+catalog_version = 1
+catalog_extensions = {'.TOMDLB_D': 'model', '.TOSNEB_D': 'scene', '.TOANMB': 'animation', '.TOANMSB': 'animation'}
+
+catalog_schema = '''
+CREATE TABLE files (path TEXT PRIMARY KEY, type TEXT, size INTEGER, mtime_ns INTEGER, error TEXT);
+CREATE TABLE links (path TEXT, position INTEGER, linked_file TEXT);
+CREATE TABLE meshes (path TEXT, mesh INTEGER, submesh INTEGER, node INTEGER, name TEXT, flags INTEGER,
+    material INTEGER, num_verts INTEGER, num_idx INTEGER);
+CREATE TABLE materials (path TEXT, material INTEGER, name TEXT);
+CREATE TABLE textures (path TEXT, material INTEGER, slot INTEGER, texture TEXT);
+CREATE TABLE anim_targets (path TEXT, channel INTEGER, type INTEGER, target INTEGER, vec_index INTEGER);
+CREATE INDEX links_path ON links (path);
+CREATE INDEX links_linked_file ON links (linked_file COLLATE NOCASE);
+CREATE INDEX meshes_path ON meshes (path);
+CREATE INDEX meshes_flags ON meshes (flags);
+CREATE INDEX materials_path ON materials (path);
+CREATE INDEX textures_path ON textures (path);
+CREATE INDEX textures_texture ON textures (texture COLLATE NOCASE);
+CREATE INDEX anim_targets_path ON anim_targets (path);
+CREATE INDEX anim_targets_target ON anim_targets (target);
+'''
+catalog_tables = ['links', 'meshes', 'materials', 'textures', 'anim_targets']
+
+def open_catalog (database):
+    db = sqlite3.connect(database)
+    if db.execute('PRAGMA user_version').fetchone()[0] != catalog_version:
+        for table in ['files'] + catalog_tables:
+            db.execute('DROP TABLE IF EXISTS {}'.format(table))
+        db.executescript(catalog_schema)
+        db.execute('PRAGMA user_version = {}'.format(catalog_version))
+        db.commit()
+    return(db)
+
+def read_dpdf_header (f):
+    magic = f.read(4)
+    if not magic in [b'DPDF', b'FDPD']:
+        return False
+    import berseria_export_model
+    ctx = FormatContext({b'DPDF': '<', b'FDPD': '>'}[magic])
+    unk_int, = struct.unpack("{}I".format(ctx.e), f.read(4))
+    if not unk_int == 0:
+        f.seek(4,0)
+        ctx.addr_size = 4 # Zestiria
+    return(ctx, berseria_export_model.read_opening_dict(f, ctx))
+
+# Each scan function returns the rows to add for one file, as {table: [row, ...]} without the path column
+def scan_model (filename):
+    import berseria_export_model
+    rows = {x: [] for x in catalog_tables}
+    with open(filename, 'rb') as f:
+        header = read_dpdf_header(f)
+        if header == False:
+            raise ValueError("not a DPDF file")
+        ctx, opening_dict = header
+        rows['links'] = [(i, opening_dict[i]) for i in range(len(opening_dict))]
+        magic = f.read(4)
+        if not magic in [b'BLDM', b'MDLB']:
+            raise ValueError("not a model")
+        f.seek(4,1)
+        toc = [berseria_export_model.read_offset(f, ctx) for _ in range(12)]
+        mesh_table, _ = berseria_export_model.read_mesh_table(f, toc[6], ctx)
+        rows['meshes'] = [(x['mesh'], x['submesh'], x['node'], x['name'], x['flags'], x['material'],
+            x['num_verts'], x['num_idx']) for x in mesh_table]
+        material_struct = berseria_export_model.read_section_7(f, toc[7], ctx)
+        rows['materials'] = [(i, material_struct[i]['name']) for i in range(len(material_struct))]
+        rows['textures'] = [(i, j, material_struct[i]['textures'][j])
+            for i in range(len(material_struct)) for j in range(len(material_struct[i]['textures']))]
+    return(rows)
+
+def scan_scene (filename):
+    rows = {x: [] for x in catalog_tables}
+    with open(filename, 'rb') as f:
+        header = read_dpdf_header(f)
+        if header == False:
+            raise ValueError("not a DPDF file")
+        rows['links'] = [(i, header[1][i]) for i in range(len(header[1]))]
+    return(rows)
+
+def scan_animation (filename):
+    import berseria_export_animation
+    rows = {x: [] for x in catalog_tables}
+    with open(filename, 'rb') as f:
+        tables = berseria_export_animation.read_tosamsb_tables(f, filename)
+        if tables == False:
+            raise ValueError("not in the expected animation format")
+        targets = tables[0]['decoded_target_table']
+        rows['anim_targets'] = [(i, targets[i]['type'], targets[i]['target'], targets[i]['vec_index'])
+            for i in range(len(targets))]
+    return(rows)
+
+catalog_scanners = {'model': scan_model, 'scene': scan_scene, 'animation': scan_animation}
+
+def find_catalog_files (folder):
+    found = {}
+    for root, dirs, files in os.walk(folder):
+        dirs[:] = [x for x in dirs if not x[0] in ['.', '_']] # Skips _export_cache and the like
+        for file in files:
+            extension = os.path.splitext(file)[1].upper()
+            if extension in catalog_extensions:
+                found[os.path.join(root, file)] = catalog_extensions[extension]
+    return(found)
+
+def delete_file_rows (db, path):
+    for table in ['files'] + catalog_tables:
+        db.execute('DELETE FROM {} WHERE path = ?'.format(table), (path,))
+    return
+
+# Scans folder (which must be inside the folder of the database) and brings the catalog up to date.
+# Returns {'scanned': n, 'unchanged': n, 'removed': n, 'failed': n, 'seconds': s}.
+def refresh_catalog (database, folder):
+    start_time = time.perf_counter()
+    base_folder = os.path.dirname(os.path.abspath(database))
+    db = open_catalog(database)
+    stats = {'scanned': 0, 'unchanged': 0, 'removed': 0, 'failed': 0}
+    found = {os.path.relpath(os.path.abspath(x), base_folder).replace(os.sep, '/'): y
+        for x, y in find_catalog_files(folder).items()}
+    prefix = os.path.relpath(os.path.abspath(folder), base_folder).replace(os.sep, '/')
+    known = {x[0]: x[1:] for x in db.execute('SELECT path, size, mtime_ns FROM files')}
+    with db:
+        for path in known:
+            if (prefix == '.' or path.startswith(prefix + '/')) and not path in found:
+                delete_file_rows(db, path)
+                stats['removed'] += 1
+        for path in sorted(found):
+            stat = os.stat(os.path.join(base_folder, path))
+            if known.get(path) == (stat.st_size, stat.st_mtime_ns):
+                stats['unchanged'] += 1
+                continue
+            delete_file_rows(db, path)
+            error = ''
+            try:
+                rows = catalog_scanners[found[path]](os.path.join(base_folder, path))
+            except Exception as e:
+                rows, error = {}, '{0}: {1}'.format(type(e).__name__, e)
+                stats['failed'] += 1
+            db.execute('INSERT INTO files VALUES (?, ?, ?, ?, ?)',
+                (path, found[path], stat.st_size, stat.st_mtime_ns, error))
+            for table in rows:
+                if len(rows[table]) > 0:
+                    db.executemany('INSERT INTO {0} VALUES ({1})'.format(table, ', '.join(['?'] * (len(rows[table][0]) + 1))),
+                        [(path,) + x for x in rows[table]])
+            stats['scanned'] += 1
+    db.close()
+    stats['seconds'] = round(time.perf_counter() - start_time, 3)
+    return(stats)
+
+# Ready made queries.  Names can use * as a wildcard and are not case sensitive.
+catalog_queries = {
+    'texture': ('SELECT DISTINCT t.path, m.name, t.texture FROM textures t LEFT JOIN materials m'
+        ' ON m.path = t.path AND m.material = t.material WHERE t.texture LIKE ? ORDER BY t.path', 'name'),
+    'mesh_flags': ('SELECT path, mesh, submesh, name, num_verts FROM meshes WHERE flags = ? ORDER BY path, mesh, submesh',
+        'int'),
+    # Mesh type only (upper nibble of the flags, the lower nibble is the number of UV maps)
+    'mesh_type': ('SELECT path, mesh, submesh, name, flags, num_verts FROM meshes WHERE flags & 0xF0 = ?'
+        ' ORDER BY path, mesh, submesh', 'int'),
+    'target': ('SELECT path, count(*) FROM anim_targets WHERE target = ? GROUP BY path ORDER BY path', 'int'),
+    'references': ('SELECT l.path, f.type, l.linked_file FROM links l JOIN files f ON f.path = l.path'
+        ' WHERE l.linked_file LIKE ? ORDER BY l.path', 'name'),
+    'errors': ('SELECT path, error FROM files WHERE error != ? ORDER BY path', 'name'),
+}
+
+def query_catalog (database, query, value = ''):
+    db = open_catalog(database)
+    if query in catalog_queries:
+        sql, value_type = catalog_queries[query]
+        parameters = (int(value, 0) if value_type == 'int' else value.replace('*', '%'),)
+    else: # Plain SQL
+        sql, parameters = query, ()
+    try:
+        return(db.execute(sql, parameters).fetchall())
+    finally:
+        db.close()
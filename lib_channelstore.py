@@ -0,0 +1,134 @@
+# The decoded animation data of a TOANMB / TOANMSB file, held in numpy arrays instead of lists of lists.  Each
+# entry of the data table of contents is an animation_channel, with its key times (keys, n) and its values (values,
+# n x vec_len) as contiguous float32 arrays, so that long animations take a fraction of the memory and the glTF
+# writer can work on whole channels at once.  Single vector entries (type 3) have no keys.
+#
+# The target table can also be looked at as a numpy structured array (target_view()), with the flag of each target
+# split into its type and target (bone) fields.
+#
+# The whole animation can be dumped into a single uncompressed .npz (write_animation_dump()) instead of JSON, which
+# is many times smaller and faster to write for long animations, and read back (read_animation_dump()) by
+# misc/berseria_import_toanmsb.py.  DCT compressed entries are stored decoded, and are rebuilt as plain linear
+# entries (see rebuild_entry()).
+#
+# GitHub eArmada8/berseria_model_tool
+
+try:
+    import json, io, numpy
+except ModuleNotFoundError as e:
+    print("Python module missing! {}".format(e.msg))
+    input("Press Enter to abort.")
+    raise
+
+# A target (layout 'target' of lib_schema.py), and the same with the flag also split into type, target and unknown
+# (see decode_target_flag() in berseria_export_animation.py)
+target_record_dtype = numpy.dtype([('flag', '<u8'), ('vec_index', '<u4'), ('unknown2', '<u4')])
+target_dtype = numpy.dtype({'names': ['flag', 'type', 'target', 'unknown', 'vec_index', 'unknown2'],
+    'formats': ['<u8', '<u4', '<u2', '<u2', '<u4', '<u4'], 'offsets': [0, 0, 4, 6, 8, 12], 'itemsize': 16})
+
+class animation_channel:
+    __slots__ = ('flag', 'unk_float', 'keys', 'values')
+
+    def __init__ (self, flag, values, keys = (), unk_float = 0.0):
+        self.flag = flag
+        self.unk_float = unk_float
+        self.keys = numpy.ascontiguousarray(keys, dtype = 'float32').reshape(-1)
+        self.values = numpy.ascontiguousarray(values, dtype = 'float32').reshape(-1, max(self.vec_len, 1))
+
+    def __repr__ (self):
+        return("animation_channel(flag = {0}, {1} x {2})".format(hex(self.flag), len(self.values), self.vec_len))
+
+    def __len__ (self):
+        return(len(self.values))
+
+    @property
+    def type_ (self):
+        return(self.flag & 0xF)
+
+    @property
+    def header_type (self):
+        return(self.flag >> 8 & 0xF)
+
+    @property
+    def vec_len (self):
+        return(self.flag >> 12 & 0xF)
+
+    # The entry as a dict of lists, as written to JSON by --dumpanidata
+    def entry (self):
+        if self.type_ == 3: # Single vector
+            return({'flag': self.flag, 'vec': self.values[0].tolist()})
+        header = self.keys.tolist()
+        if self.header_type != 1: # Only header type 1 has float key times
+            header = [int(x) for x in header]
+        return({'flag': self.flag, 'unk_float': self.unk_float, 'header': header, 'vecs': self.values.tolist()})
+
+    # The entry in the form that misc/berseria_import_toanmsb.py writes, with the values as floats.  DCT compressed
+    # entries (types 8 and 9) become linear entries (type 0) of their decoded values.
+    def rebuild_entry (self):
+        entry = self.entry()
+        entry['flag'] = self.flag & ~0x3F | (0 if self.type_ in [8,9] else self.type_)
+        return(entry)
+
+def channel_from_entry (entry):
+    if 'vec' in entry:
+        return(animation_channel(entry['flag'], [entry['vec']]))
+    return(animation_channel(entry['flag'], entry['vecs'], entry['header'], entry['unk_float']))
+
+# The target table (a list of (flag, vec_index, unknown)) as a structured array with the fields of target_dtype
+def target_view (target_table):
+    return(numpy.array([tuple(x) for x in target_table], dtype = target_record_dtype).view(target_dtype))
+
+# channels is {index in the data table of contents: animation_channel}.  Everything is packed into a few flat arrays:
+# index has a row of (index, flag, number of keys, number of vectors, vec_len) for every channel.
+def pack_channels (channels):
+    order = sorted(channels)
+    index = [[i, channels[i].flag, len(channels[i].keys), len(channels[i].values), channels[i].vec_len] for i in order]
+    empty = [numpy.zeros(0, dtype = 'float32')]
+    return({'index': numpy.array(index, dtype = 'int64').reshape(-1,5),
+        'unk_floats': numpy.array([channels[i].unk_float for i in order], dtype = 'float64'),
+        'keys': numpy.concatenate([channels[i].keys for i in order] + empty),
+        'values': numpy.concatenate([channels[i].values.reshape(-1) for i in order] + empty)})
+
+# The channels of pack_channels(), their arrays are views of the packed arrays
+def unpack_channels (arrays):
+    channels = {}
+    key_offset, value_offset = 0, 0
+    for row, unk_float in zip(arrays['index'].tolist(), arrays['unk_floats'].tolist()):
+        i, flag, num_keys, num_vecs, vec_len = row
+        channels[i] = animation_channel(flag, arrays['values'][value_offset:value_offset + num_vecs * vec_len],
+            arrays['keys'][key_offset:key_offset + num_keys], unk_float)
+        key_offset += num_keys
+        value_offset += num_vecs * vec_len
+    return(channels)
+
+# The tables of read_tosamsb() that are not channels, as JSON compatible values
+def animation_tables (ani_data):
+    return({x: ani_data[x] for x in ['file_type', 'header', 'header2', 'hash_table', 'target_table',
+        'decoded_target_table'] if x in ani_data})
+
+# The animation data (with data_stream a list of animation_channel) as the JSON of --dumpanidata
+def animation_data_json (ani_data):
+    data = animation_tables(ani_data)
+    data['data_stream'] = [x.entry() for x in ani_data['data_stream']]
+    return(json.dumps(data, indent = 4).encode())
+
+# Writes the animation data into f (a binary file) as an .npz, with the target table (layout 'target') and the
+# channels as arrays, and the other tables as JSON.  file_name is the name of the animation file, which
+# misc/berseria_import_toanmsb.py rebuilds.
+def write_animation_dump (f, ani_data, file_name = ''):
+    arrays = pack_channels({i: ani_data['data_stream'][i] for i in range(len(ani_data['data_stream']))})
+    tables = {x: y for x, y in animation_tables(ani_data).items() if not x in ['target_table', 'decoded_target_table']}
+    tables['file_name'] = file_name
+    arrays['tables'] = numpy.frombuffer(json.dumps(tables).encode(), dtype = 'uint8')
+    arrays['targets'] = numpy.array([tuple(x) for x in ani_data['target_table']], dtype = target_record_dtype)
+    numpy.savez(f, **arrays)
+    return
+
+# The animation data of write_animation_dump(), with data_stream a list of animation_channel
+def read_animation_dump (f):
+    arrays = numpy.load(io.BytesIO(f.read()))
+    data = json.loads(arrays['tables'].tobytes())
+    data['target_table'] = [list(x) for x in arrays['targets'].tolist()]
+    channels = unpack_channels({x: arrays[x] for x in ['index', 'unk_floats', 'keys', 'values']})
+    data['data_stream'] = [channels[i] for i in range(len(channels))]
+    return(data)
@@ -0,0 +1,284 @@
+# Endian conversion for TOMDLB_D / TOMDLP_P models, e.g. PS3 (big-endian) to PC (little-endian) and back.
+# The model is walked once to find every typed region (using the layouts in lib_schema.py), then each region
+# is byteswapped in place with numpy.  All offsets in these formats are relative to their own position and
+# the layout does not change, so pointer fields only need their byte order changed.
+#
+# Usage:  Run by itself without commandline arguments and it will convert every .TOMDLB_D file in the current
+# directory (and the .TOMDLP_P file it references) to the opposite endianness.  Backups are made.
+#
+# For command line options, run:
+# /path/to/python3 lib_endian.py --help
+#
+# Requires numpy, lib_schema.py and lib_filesource.py, put in the same directory
+#
+# GitHub eArmada8/berseria_model_tool
+
+try:
+    import io, shutil, glob, os, sys, numpy
+    from lib_schema import *
+    from lib_filesource import DirectorySource
+except ModuleNotFoundError as e:
+    print("Python module missing! {}".format(e.msg))
+    input("Press Enter to abort.")
+    raise
+
+def read_offset (f, e, addr_size):
+    start_offset = f.tell()
+    diff_offset, = read_record(f, 'address', e, addr_size)
+    return(start_offset + diff_offset)
+
+def read_string (f, start_offset):
+    current_loc = f.tell()
+    f.seek(start_offset)
+    null_term_string = f.read(1)
+    while null_term_string[-1] != 0:
+        null_term_string += f.read(1)
+    f.seek(current_loc)
+    return(null_term_string[:-1].decode())
+
+# Reads a table of (offset, count) pointers, adding the table itself to the region list
+def map_toc (f, count, e, addr_size, regions):
+    regions.append((f.tell(), 'pointer', count))
+    toc = []
+    for _ in range(count):
+        offset = read_offset(f, e, addr_size)
+        num_entries, = read_record(f, 'address', e, addr_size)
+        toc.append({'offset': offset, 'num_entries': num_entries})
+    return(toc)
+
+#Node Tree
+def map_section_0 (f, offset, e, addr_size):
+    regions = [(offset, 'skeleton_header', 1)]
+    f.seek(offset + get_struct('skeleton_header', e, addr_size).size)
+    toc = map_toc(f, 8, e, addr_size, regions)
+    regions.append((f.tell(), 'skeleton_unk_block', 1))
+    # id, true parent, tree info, name offsets, unknown matrices (2 per bone), abs matrices, inv matrices, parents
+    layouts = ['I', 'i', 'tree_info', 'address', 'matrix', 'matrix', 'matrix', 'h']
+    for i in range(len(toc)):
+        regions.append((toc[i]['offset'], layouts[i], toc[i]['num_entries'] * (2 if i == 4 else 1)))
+    return(regions)
+
+#Physics parameters, Symphonia uses a different layout which is treated as 32-bit values
+def map_section_4 (f, offset, length, e, addr_size):
+    f.seek(offset)
+    section_4_unk = read_record(f, 'physics_header', e, addr_size)
+    if addr_size == 8:
+        f.seek(4,1) # Padding
+    regions = [(offset, 'physics_header', 1)]
+    toc = map_toc(f, 1, e, addr_size, regions)
+    if (section_4_unk[2] == toc[0]['num_entries'] and toc[0]['offset'] +
+            get_struct('physics', e, addr_size).size * toc[0]['num_entries'] <= offset + length):
+        regions.append((toc[0]['offset'], 'physics', toc[0]['num_entries']))
+        return(regions)
+    else:
+        return([(offset, 'I', length // 4)])
+
+#Collision meshes
+def map_section_5 (f, offset, e, addr_size):
+    f.seek(offset)
+    regions = []
+    toc = map_toc(f, 2, e, addr_size, regions)
+    regions.append((toc[0]['offset'], 'collision', toc[0]['num_entries']))
+    regions.append((toc[1]['offset'], 'collision_triangle', toc[1]['num_entries']))
+    return(regions)
+
+#Meshes, vertex data is split between the TOMDLB_D (weighted meshes) and TOMDLP_P (UVs, indices, unweighted meshes)
+def map_section_6 (f, offset, e, addr_size):
+    f.seek(offset)
+    regions = [(offset, 'mesh_section_header', 1)]
+    dlp_regions = []
+    f.seek(offset + get_struct('mesh_section_header', e, addr_size).size)
+    toc = map_toc(f, 4, e, addr_size, regions)
+    regions.append((toc[0]['offset'], 'mesh_unk_block', toc[0]['num_entries']))
+    regions.append((toc[1]['offset'], 'mesh_entry', toc[1]['num_entries']))
+    regions.append((toc[2]['offset'], 'I', toc[2]['num_entries'])) # Bone palette
+    regions.append((toc[3]['offset'], 'I', toc[3]['num_entries'] * 2)) # Number of meshes, number of bones
+    entry_size = get_struct('mesh_entry', e, addr_size).size
+    for i in range(toc[1]['num_entries']):
+        f.seek(toc[1]['offset'] + (i * entry_size))
+        _, _, _, flags, _, _ = read_record(f, 'mesh', e, addr_size)
+        name = read_string(f, read_offset(f, e, addr_size))
+        data_offset = read_offset(f, e, addr_size)
+        data_block_size, = read_record(f, 'address', e, addr_size)
+        f.seek(data_offset)
+        num_verts, num_idx, offset_uvs, offset_idx = read_record(f, 'mesh_data_header', e, addr_size)
+        regions.append((data_offset, 'mesh_data_header', 1))
+        num_uvs = flags & 0xF
+        if flags & 0xF0 == 0x50:
+            num_v_per_wt_grp = list(read_record(f, 'weight_group_counts', e, addr_size))
+            if sum(num_v_per_wt_grp) == num_verts:
+                regions.append((data_offset + 12, 'weight_group_counts', 1))
+                num_vertices_array = [num_v_per_wt_grp]
+            else: # Some builds have arrays of arrays, might be a PS3 thing
+                f.seek(data_offset + 12)
+                count, = read_record(f, 'I', e, addr_size)
+                regions.append((data_offset + 12, 'I', 1))
+                regions.append((f.tell(), 'H', count * 4))
+                num_vertices_array = [list(x) for x in read_records(f, '4H', count, e, addr_size)]
+            # Position, normal, blend indices, then one weight per extra influence
+            for num_vertices in num_vertices_array:
+                for j in range(len(num_vertices)):
+                    layout = '6f4B{}f'.format(j) if j > 0 else '6f4B'
+                    regions.append((f.tell(), layout, num_vertices[j]))
+                    f.seek(get_struct(layout, e, addr_size).size * num_vertices[j], 1)
+            dlp_regions.append((offset_uvs, 'I', num_verts * (1 + 2 * num_uvs))) # Padding, UVs
+        elif flags & 0xF0 in [0x0, 0x40]:
+            regions.append((data_offset + 12, 'I', (data_block_size - 12) // 4))
+            dlp_regions.append((offset_uvs, 'I', num_verts * (7 + 2 * num_uvs))) # Position, normal, padding, UVs
+        elif flags & 0xF0 == 0xC0:
+            regions.append((data_offset + 12, 'I', (data_block_size - 12) // 4))
+            # Position, normal, tangent, binormal, color, UVs
+            dlp_regions.append((offset_uvs, '12f4B{}f'.format(2 * num_uvs) if num_uvs > 0 else '12f4B', num_verts))
+        else: # e.g. 0x70 meshes, which have trailing data of unknown layout
+            raise ValueError("Mesh {0} has unsupported flags {1}, unable to convert endianness!".format(name, hex(flags)))
+        dlp_regions.append((offset_idx, 'H', num_idx))
+    return(regions, dlp_regions)
+
+#Materials, all the shader parameters are 32-bit values
+def map_section_7 (f, offset, e, addr_size):
+    regions = [(offset, 'material_section_header', 1)]
+    f.seek(offset + get_struct('material_section_header', e, addr_size).size)
+    toc = map_toc(f, 7, e, addr_size, regions)
+    regions.append((toc[0]['offset'], 'material_entry', toc[0]['num_entries']))
+    entry_size = get_struct('material_entry', e, addr_size).size
+    for i in range(toc[0]['num_entries']):
+        f.seek(toc[0]['offset'] + (i * entry_size) + get_struct('material', e, addr_size).size)
+        for _ in range(2):
+            vals_offset = read_offset(f, e, addr_size)
+            num_vals, = read_record(f, 'address', e, addr_size)
+            regions.append((vals_offset, 'I', num_vals))
+    regions.append((toc[1]['offset'], 'texture_assignment', toc[1]['num_entries']))
+    regions.append((toc[2]['offset'], 'material_name_entry', toc[2]['num_entries']))
+    entry_size = get_struct('material_name_entry', e, addr_size).size
+    for i in range(toc[2]['num_entries']):
+        f.seek(toc[2]['offset'] + (i * entry_size))
+        for _ in range(2):
+            vals_offset = read_offset(f, e, addr_size)
+            num_vals, = read_record(f, 'address', e, addr_size)
+            regions.append((vals_offset, 'I', num_vals))
+    for i in [3,4,5]: # Symphonia only
+        regions.append((toc[i]['offset'], 'H', toc[i]['num_entries']))
+    regions.append((toc[6]['offset'], 'texture_entry', toc[6]['num_entries']))
+    return(regions)
+
+#Animation targets
+def map_section_11 (f, offset, e, addr_size):
+    f.seek(offset)
+    regions = []
+    toc = map_toc(f, 2, e, addr_size, regions)
+    regions.append((toc[0]['offset'], 'Q', toc[0]['num_entries']))
+    regions.append((toc[0]['offset'] + 8 * toc[0]['num_entries'], 'f', toc[1]['num_entries']))
+    return(regions)
+
+# Returns the regions to swap in the TOMDLB_D and in its TOMDLP_P, and the format of the source file
+def map_tomdlb (dlb_data):
+    with io.BytesIO(dlb_data) as f:
+        magic = f.read(4)
+        if not magic in [b'DPDF', b'FDPD']:
+            raise ValueError("Not a TOMDLB_D file!")
+        e = {b'DPDF': '<', b'FDPD': '>'}[magic]
+        regions = [(0, 'I', 1)] # Magic is reversed by the swap
+        unk_int, = read_record(f, 'I', e)
+        addr_size = 4 if unk_int else 8
+        if addr_size == 8:
+            regions.append((4, 'I', 1))
+        f.seek({4: 4, 8: 8}[addr_size])
+        toc = map_toc(f, 1, e, addr_size, regions)
+        return_to_offset = f.tell()
+        regions.append((toc[0]['offset'], 'address', toc[0]['num_entries'])) # Opening dictionary string offsets
+        f.seek(toc[0]['offset'])
+        dlp_file = read_string(f, read_offset(f, e, addr_size))
+        f.seek(return_to_offset)
+        regions.append((f.tell(), 'I', 2)) # BLDM magic, unknown
+        f.seek(8, 1)
+        regions.append((f.tell(), 'address', 12))
+        section_toc = [read_offset(f, e, addr_size) for _ in range(12)]
+        section_ends = section_toc[1:] + [len(dlb_data)]
+        regions.extend(map_section_0(f, section_toc[0], e, addr_size))
+        regions.extend(map_section_4(f, section_toc[4], section_ends[4] - section_toc[4], e, addr_size))
+        regions.extend(map_section_5(f, section_toc[5], e, addr_size))
+        section_6_regions, dlp_regions = map_section_6(f, section_toc[6], e, addr_size)
+        regions.extend(section_6_regions)
+        regions.extend(map_section_7(f, section_toc[7], e, addr_size))
+        regions.extend(map_section_11(f, section_toc[11], e, addr_size))
+        for i in [1,2,3,8,9,10]: # Unknown content, treated as 32-bit values
+            regions.append((section_toc[i], 'I', (section_ends[i] - section_toc[i]) // 4))
+    return({'e': e, 'addr_size': addr_size, 'dlp_file': dlp_file, 'toc': section_toc,
+        'dlb_regions': regions, 'dlp_regions': dlp_regions})
+
+# Byteswaps each region once (regions can be listed more than once, e.g. shared DLP buffers), in place
+def swap_regions (data, regions, e, addr_size):
+    regions = sorted(set([x for x in regions if x[2] > 0]))
+    end_offset = 0
+    for offset, layout, count in regions:
+        if offset < end_offset:
+            raise ValueError("Overlapping regions at offset {}, unable to convert endianness!".format(hex(offset)))
+        dtype = get_dtype(layout, e, addr_size)
+        numpy.frombuffer(data, dtype = dtype, count = count, offset = offset).byteswap(inplace = True)
+        end_offset = offset + dtype.itemsize * count
+    return(data)
+
+# Takes the bytes of a TOMDLB_D (and optionally its TOMDLP_P), returns converted bytearrays (dlp is None if not given)
+def swap_tomdlb_endianness (dlb_data, dlp_data = None):
+    tomdlb_map = map_tomdlb(dlb_data)
+    new_dlb = swap_regions(bytearray(dlb_data), tomdlb_map['dlb_regions'], tomdlb_map['e'], tomdlb_map['addr_size'])
+    new_dlp = None
+    if dlp_data is not None:
+        new_dlp = swap_regions(bytearray(dlp_data), tomdlb_map['dlp_regions'], tomdlb_map['e'], tomdlb_map['addr_size'])
+    return(new_dlb, new_dlp)
+
+def backup_file (filename):
+    # Instead of overwriting backups, it will just tag a number onto the end
+    backup_suffix = ''
+    if os.path.exists(filename + '.bak' + backup_suffix):
+        backup_suffix = '1'
+        if os.path.exists(filename + '.bak' + backup_suffix):
+            while os.path.exists(filename + '.bak' + backup_suffix):
+                backup_suffix = str(int(backup_suffix) + 1)
+        shutil.copy2(filename, filename + '.bak' + backup_suffix)
+    else:
+        shutil.copy2(filename, filename + '.bak')
+    return
+
+def convert_tomdlb (tomdlb_file):
+    print("Converting {}...".format(tomdlb_file))
+    with open(tomdlb_file, 'rb') as f:
+        dlb_data = f.read()
+    try:
+        tomdlb_map = map_tomdlb(dlb_data)
+        # TLTool uses uppercase extension, the file on disk may not
+        dlp_file = DirectorySource(os.path.dirname(tomdlb_file)).local_path(tomdlb_map['dlp_file'])
+        if dlp_file == '':
+            dlp_file = os.path.join(os.path.dirname(tomdlb_file), tomdlb_map['dlp_file'])
+        with open(dlp_file, 'rb') as f:
+            dlp_data = f.read()
+        new_dlb, new_dlp = swap_tomdlb_endianness(dlb_data, dlp_data)
+    except ValueError as e: # e.g. 0x70 meshes
+        print(e)
+        print("Unsupported mesh detected, skipping {}...".format(tomdlb_file))
+        return False
+    for filename, data in [(tomdlb_file, new_dlb), (dlp_file, new_dlp)]:
+        backup_file(filename)
+        with open(filename, 'wb') as f:
+            f.write(data)
+    print("{0} converted to {1}-endian.".format(tomdlb_file, {'<': 'big', '>': 'little'}[tomdlb_map['e']]))
+    return True
+
+if __name__ == "__main__":
+    # Set current directory
+    if getattr(sys, 'frozen', False):
+        os.chdir(os.path.dirname(sys.executable))
+    else:
+        os.chdir(os.path.abspath(os.path.dirname(__file__)))
+
+    if len(sys.argv) > 1:
+        import argparse
+        parser = argparse.ArgumentParser()
+        parser.add_argument('tomdlb_filename', help="Name of tomdlb_d file to convert (required).")
+        args = parser.parse_args()
+        if os.path.exists(args.tomdlb_filename) and args.tomdlb_filename[-9:].upper() == '.TOMDLB_D':
+            convert_tomdlb(args.tomdlb_filename)
+    else:
+        tomdlb_files = glob.glob('*.TOMDLB_D')
+        for i in range(len(tomdlb_files)):
+            convert_tomdlb(tomdlb_files[i])
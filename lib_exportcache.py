@@ -0,0 +1,225 @@
+# A content addressed cache for the model exporter, so that re-running the exporter on a folder only decodes
+# the models that changed.  Each export is keyed by a hash of the input file bytes, the exporter source code and
+# the export options.  The cache remembers the hash of every file that the export wrote (and of any other file
+# it read, such as an external skeleton), and keeps a copy of each written file.  When the key matches, the
+# outputs that are still intact are left alone and missing ones are copied back from the cache, without decoding
+# anything.  Outputs that have been edited are never replaced unless overwrite is set.
+#
+# The cache lives in a folder next to the models (export_cache_folder).  File copies are stored once per
+# content hash, and the least recently used exports are dropped when the copies exceed export_cache_max_size.
+# Several exporter processes (berseria.py --jobs) can share a cache folder: stores, restores and evictions hold a
+# lock file in the folder, and the total size of the copies is kept in the folder so that storing an export does
+# not have to read the whole cache.
+#
+# GitHub eArmada8/berseria_model_tool
+
+try:
+    import hashlib, functools, contextlib, collections, shutil, json, time, threading, glob, os, sys
+    if os.name == 'nt':
+        import msvcrt
+    else:
+        import fcntl
+except ModuleNotFoundError as e:
+    print("Python module missing! {}".format(e.msg))
+    input("Press Enter to abort.")
+    raise
+
+# Increase to invalidate every cached export
+export_cache_version = 1
+export_cache_folder = '_export_cache'
+export_cache_max_size = 1024 * 1024 * 1024 # In bytes
+# Fraction of export_cache_max_size that an eviction leaves, so that the exports after it do not evict again
+export_cache_evict_to = 0.75
+
+# Only one thread at a time writes into or evicts from a cache folder
+cache_lock = threading.Lock()
+
+# Only one thread of one process at a time writes into or evicts from the cache folder.  The lock file is locked
+# by the operating system, so it is released even if the process holding it is killed.
+@contextlib.contextmanager
+def locked_cache (cache_folder):
+    with cache_lock:
+        os.makedirs(cache_folder, exist_ok = True)
+        with open(os.path.join(cache_folder, 'lock'), 'a+b') as f:
+            if os.name == 'nt':
+                f.seek(0)
+                while True:
+                    try:
+                        msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+                        break
+                    except OSError: # Gives up after 10 seconds, try again
+                        pass
+            else:
+                fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                if os.name == 'nt':
+                    f.seek(0)
+                    msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+                else:
+                    fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+def hash_file (filename):
+    sha = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            sha.update(chunk)
+    return(sha.hexdigest())
+
+def file_stat (filename):
+    stat = os.stat(filename)
+    return([stat.st_size, stat.st_mtime_ns])
+
+# A file is unchanged if its hash is the same.  The hash is only recomputed if the size or time differ.
+def file_matches (filename, record):
+    if not os.path.isfile(filename):
+        return False
+    if file_stat(filename) == record[1:]:
+        return True
+    return(hash_file(filename) == record[0])
+
+# Hash of the source code of the given modules, so that changes to the tools invalidate the cache
+@functools.lru_cache(maxsize = 64)
+def tool_version (module_names):
+    sha = hashlib.sha256(str(export_cache_version).encode())
+    for module_name in module_names:
+        sha.update(module_name.encode())
+        try:
+            with open(sys.modules[module_name].__file__, 'rb') as f:
+                sha.update(f.read())
+        except (KeyError, AttributeError, TypeError, OSError):
+            pass # Frozen executables do not ship the source, export_cache_version is used on its own
+    return(sha.hexdigest())
+
+def make_cache_key (input_files, options, module_names):
+    sha = hashlib.sha256(tool_version(tuple(module_names)).encode())
+    sha.update(json.dumps(options).encode())
+    for input_file in input_files:
+        sha.update(os.path.basename(input_file).encode())
+        sha.update(hash_file(input_file).encode())
+    return(sha.hexdigest())
+
+def cache_paths (folder, cache_key = ''):
+    cache_folder = os.path.join(folder, export_cache_folder)
+    return(cache_folder, os.path.join(cache_folder, 'entries', cache_key + '.json'))
+
+def blob_path (cache_folder, sha):
+    return(os.path.join(cache_folder, 'files', sha[:2], sha))
+
+def read_entry (entry_file):
+    try:
+        with open(entry_file, 'rb') as f:
+            return(json.loads(f.read()))
+    except (OSError, ValueError):
+        return False
+
+def write_entry (entry_file, entry):
+    os.makedirs(os.path.dirname(entry_file), exist_ok = True)
+    with open(entry_file + '.tmp', 'wb') as f:
+        f.write(json.dumps(entry, indent=4).encode())
+    os.replace(entry_file + '.tmp', entry_file)
+    return
+
+# Total size of the stored copies, or None if it is not known (a cache from an older version, or a damaged one)
+def read_cache_size (cache_folder):
+    size = read_entry(os.path.join(cache_folder, 'size.json'))
+    return(size['size'] if isinstance(size, dict) and 'size' in size else None)
+
+def write_cache_size (cache_folder, size):
+    write_entry(os.path.join(cache_folder, 'size.json'), {'size': size})
+    return
+
+# Returns True if every output of the cached export is now in place (intact, or restored from the cache).
+# Returns False if there is no usable entry, or if an output has been edited and overwrite is not set.
+def restore_cached_export (cache_key, folder, overwrite = False):
+    cache_folder, entry_file = cache_paths(folder, cache_key)
+    entry = read_entry(entry_file)
+    if entry == False:
+        return False
+    for dependency in entry['dependencies']:
+        if not file_matches(dependency, entry['dependencies'][dependency]):
+            return False
+    restored = []
+    for output in entry['outputs']:
+        filename = os.path.join(folder, output)
+        if file_matches(filename, entry['outputs'][output]):
+            continue
+        if os.path.exists(filename) and overwrite == False:
+            return False
+        if not os.path.exists(blob_path(cache_folder, entry['outputs'][output][0])):
+            return False
+        restored.append(output)
+    with locked_cache(cache_folder):
+        # Another process may have evicted the export since it was read
+        if not all([os.path.exists(blob_path(cache_folder, entry['outputs'][x][0])) for x in restored]):
+            return False
+        for output in restored:
+            filename = os.path.join(folder, output)
+            if os.path.dirname(filename) != '':
+                os.makedirs(os.path.dirname(filename), exist_ok = True)
+            shutil.copyfile(blob_path(cache_folder, entry['outputs'][output][0]), filename)
+            entry['outputs'][output][1:] = file_stat(filename)
+            print("Restored {} from the export cache.".format(filename))
+        entry['last_used'] = time.time()
+        write_entry(entry_file, entry)
+    return True
+
+# written_files are the files the export wrote, dependencies any other files besides the inputs that it read
+def store_cached_export (cache_key, folder, written_files, dependencies = []):
+    cache_folder, entry_file = cache_paths(folder, cache_key)
+    entry = {'outputs': {}, 'dependencies': {}, 'last_used': time.time()}
+    for written_file in written_files:
+        entry['outputs'][os.path.relpath(written_file, folder)] = [hash_file(written_file)] + file_stat(written_file)
+    for dependency in dependencies:
+        entry['dependencies'][os.path.abspath(dependency)] = [hash_file(dependency)] + file_stat(dependency)
+    with locked_cache(cache_folder):
+        size = read_cache_size(cache_folder)
+        for written_file in written_files:
+            sha = entry['outputs'][os.path.relpath(written_file, folder)][0]
+            if not os.path.exists(blob_path(cache_folder, sha)):
+                os.makedirs(os.path.dirname(blob_path(cache_folder, sha)), exist_ok = True)
+                shutil.copyfile(written_file, blob_path(cache_folder, sha) + '.tmp')
+                os.replace(blob_path(cache_folder, sha) + '.tmp', blob_path(cache_folder, sha))
+                if size != None:
+                    size += os.path.getsize(blob_path(cache_folder, sha))
+        write_entry(entry_file, entry)
+        if size == None or size > export_cache_max_size:
+            evict_cached_exports(cache_folder)
+        else:
+            write_cache_size(cache_folder, size)
+    return
+
+# If the stored copies exceed max_size, drops the least recently used entries until they fit in
+# max_size * export_cache_evict_to.  Then deletes unused copies.  The cache folder must be locked (locked_cache()).
+def evict_cached_exports (cache_folder, max_size = None):
+    if max_size == None:
+        max_size = export_cache_max_size
+    entries = {x: read_entry(x) for x in glob.glob(os.path.join(cache_folder, 'entries', '*.json'))}
+    entries = {x: entries[x] for x in entries if entries[x] != False}
+    lru_order = sorted(entries, key = lambda x: entries[x]['last_used'])
+    entries = {x: set([y[0] for y in entries[x]['outputs'].values()]) for x in entries}
+    blobs = {os.path.basename(x): os.path.getsize(x) for x in glob.glob(os.path.join(cache_folder, 'files', '*', '*'))
+        if not x[-4:] == '.tmp'}
+    references = collections.Counter([sha for x in entries for sha in entries[x]])
+    size = sum([blobs[x] for x in references if x in blobs])
+    target_size = max_size * export_cache_evict_to if size > max_size else size
+    for entry_file in lru_order:
+        if size <= target_size:
+            break
+        try:
+            os.remove(entry_file)
+        except OSError:
+            continue
+        for sha in entries[entry_file]:
+            references[sha] -= 1
+            if references[sha] == 0:
+                size -= blobs.get(sha, 0)
+    for sha in blobs:
+        if references[sha] <= 0:
+            try:
+                os.remove(blob_path(cache_folder, sha))
+            except OSError:
+                pass
+    write_cache_size(cache_folder, size)
+    return
@@ -0,0 +1,136 @@
+# Lets the exporters write their output (raw buffers, JSON files and glTF) into a single .zip or .tar archive
+# instead of many small files, which is much faster on network drives.  A sink takes the same file names that
+# would otherwise be written to disk.
+#
+# Archive members are stored relative to the root folder of the sink, and the archive is written through one large
+# buffer, so that many small files become a few large writes.  The archive is built under a temporary name, synced
+# to disk once when the sink is closed, and only then renamed into place, so that an interrupted export never
+# leaves a half written archive behind.  If the export fails, abort() removes the temporary file instead.
+#
+# berseria_import_model.py reads the model folders back out of these archives (see lib_filesource.py).
+#
+# local_output is the plain file system, and is the default of every exporter.
+#
+# GitHub eArmada8/berseria_model_tool
+
+try:
+    import time, io, os
+except ModuleNotFoundError as e:
+    print("Python module missing! {}".format(e.msg))
+    input("Press Enter to abort.")
+    raise
+
+sink_buffer_size = 16 * 1024 * 1024 # In bytes
+archive_formats = {'zip': '.zip', 'tar': '.tar'}
+
+# Every sink has: open(name) (a writable binary file), write(name, data), exists(name), close() and abort(), and
+# local (True if the names are plain files)
+class DirectorySink:
+    local = True
+
+    def open (self, name):
+        if os.path.dirname(name) != '':
+            os.makedirs(os.path.dirname(name), exist_ok = True)
+        return(open(name, 'wb'))
+
+    def write (self, name, data):
+        with self.open(name) as f:
+            f.write(data)
+        return
+
+    def exists (self, name):
+        return(os.path.exists(name))
+
+    def close (self):
+        return
+
+    def abort (self):
+        return
+
+# A member is added to the archive when it is closed
+class ArchiveMember (io.BytesIO):
+    def __init__ (self, sink, name):
+        super().__init__()
+        self.sink = sink
+        self.name = name
+
+    def close (self):
+        if not self.closed:
+            self.sink.add(self.name, self.getvalue())
+        super().close()
+
+class ArchiveSink:
+    local = False
+
+    # archive_format is 'zip' or 'tar'.  Names are stored relative to root, '' for the current folder.
+    def __init__ (self, archive_file, archive_format = 'zip', root = ''):
+        self.archive_file = archive_file
+        self.archive_format = archive_format
+        self.root = root
+        self.names = set()
+        if os.path.dirname(archive_file) != '':
+            os.makedirs(os.path.dirname(archive_file), exist_ok = True)
+        self.f = open(archive_file + '.tmp', 'wb', buffering = sink_buffer_size)
+        if archive_format == 'zip':
+            import zipfile
+            self.archive = zipfile.ZipFile(self.f, 'w', zipfile.ZIP_DEFLATED, compresslevel = 1)
+        else:
+            import tarfile
+            self.archive = tarfile.open(fileobj = self.f, mode = 'w', format = tarfile.PAX_FORMAT)
+
+    def __repr__ (self):
+        return("ArchiveSink({!r})".format(self.archive_file))
+
+    def member_name (self, name):
+        return(os.path.relpath(name, self.root if self.root != '' else '.').replace(os.sep, '/'))
+
+    def open (self, name):
+        return(ArchiveMember(self, self.member_name(name)))
+
+    def write (self, name, data):
+        self.add(self.member_name(name), data)
+        return
+
+    def add (self, member_name, data):
+        if self.archive_format == 'zip':
+            import zipfile
+            info = zipfile.ZipInfo(member_name, time.localtime()[:6])
+            info.compress_type = zipfile.ZIP_DEFLATED
+            self.archive.writestr(info, data, compresslevel = 1)
+        else:
+            import tarfile
+            info = tarfile.TarInfo(member_name)
+            info.size, info.mtime = len(data), time.time()
+            self.archive.addfile(info, io.BytesIO(data))
+        self.names.add(member_name)
+        return
+
+    # Only what has been written to this sink is known, an existing archive is replaced as a whole
+    def exists (self, name):
+        return(self.member_name(name) in self.names)
+
+    def close (self):
+        self.archive.close()
+        self.f.flush()
+        os.fsync(self.f.fileno())
+        self.f.close()
+        os.replace(self.archive_file + '.tmp', self.archive_file)
+        return
+
+    def abort (self):
+        try:
+            self.archive.close()
+        except (OSError, ValueError):
+            pass
+        self.f.close()
+        os.remove(self.archive_file + '.tmp')
+        return
+
+local_output = DirectorySink()
+
+# A sink for an archive of this name, in the format of its extension (.zip, or .tar)
+def open_archive_sink (archive_file, root = ''):
+    for archive_format in archive_formats:
+        if archive_file.lower().endswith(archive_formats[archive_format]):
+            return(ArchiveSink(archive_file, archive_format, root))
+    raise ValueError("{} is not a .zip or .tar file!".format(archive_file))
@@ -0,0 +1,149 @@
+# Lets the exporters read their input straight from a folder, a .zip or a .tar bundle (.tar, .tar.gz, .tar.bz2,
+# .tar.xz), without extracting it first.  A source maps names, relative to the top of the bundle and using forward
+# slashes, to readable files.  Names are matched without regard to case, since the games and the tools that
+# unpack them do not agree on it (e.g. TLTool writes .TOMDLP_P names in upper case).
+#
+# The readers seek back and forth all over a file (every offset is relative), so each member is read into memory
+# in one go when opened.  Members are found directly from the index of the bundle, so only the files that are
+# actually used are ever read.  Compressed tarballs have no index, and are read from the start each time a member
+# is opened; use .zip or uncompressed .tar for large bundles.
+#
+# local_files is the plain file system, with names used as given, and is the default of every reader.
+#
+# GitHub eArmada8/berseria_model_tool
+
+try:
+    import fnmatch, threading, time, glob, io, os
+except ModuleNotFoundError as e:
+    print("Python module missing! {}".format(e.msg))
+    input("Press Enter to abort.")
+    raise
+
+bundle_extensions = ['.zip', '.tar', '.tar.gz', '.tgz', '.tar.bz2', '.tar.xz']
+
+# Every source has: resolve(name) (the name as stored, or '' if missing), exists(name), open(name) (binary, seekable),
+# glob(pattern), stat(name) ([size, mtime_ns]) and local_path(name) (a real file, or '' if the file is in a bundle)
+class DirectorySource:
+    def __init__ (self, folder = ''):
+        self.folder = folder
+
+    def __repr__ (self):
+        return("DirectorySource({!r})".format(self.folder))
+
+    def path (self, name):
+        return(os.path.join(self.folder, name) if self.folder != '' else name)
+
+    def resolve (self, name):
+        if os.path.isfile(self.path(name)):
+            return(name)
+        folder, basename = os.path.split(name)
+        try:
+            matches = [x for x in os.listdir(self.path(folder) if folder != '' else (self.folder or '.'))
+                if x.lower() == basename.lower()]
+        except OSError:
+            return('')
+        return(os.path.join(folder, matches[0]) if len(matches) > 0 else '')
+
+    def exists (self, name):
+        return(self.resolve(name) != '')
+
+    def open (self, name):
+        resolved = self.resolve(name)
+        if resolved == '':
+            raise FileNotFoundError("{} not found in {}".format(name, self.folder or 'the current folder'))
+        return(open(self.path(resolved), 'rb'))
+
+    def glob (self, pattern):
+        if self.folder == '':
+            return(sorted(glob.glob(pattern)))
+        return(sorted([os.path.relpath(x, self.folder) for x in glob.glob(os.path.join(self.folder, pattern))]))
+
+    def stat (self, name):
+        stat = os.stat(self.path(self.resolve(name)))
+        return([stat.st_size, stat.st_mtime_ns])
+
+    def local_path (self, name):
+        resolved = self.resolve(name)
+        return(self.path(resolved) if resolved != '' else '')
+
+# Common to .zip and .tar.  Subclasses fill self.members ({lower case name: (name, size, mtime_ns, member)}) in
+# read_index() and read a member in read_member().  The bundle is opened again after pickling (worker processes).
+class BundleSource:
+    def __init__ (self, bundle_file):
+        self.bundle_file = bundle_file
+        self.bundle = None
+        self.lock = threading.Lock()
+        self.members = {}
+        self.read_index()
+
+    def __repr__ (self):
+        return("{0}({1!r})".format(type(self).__name__, self.bundle_file))
+
+    def __getstate__ (self):
+        return({'bundle_file': self.bundle_file})
+
+    def __setstate__ (self, state):
+        self.__init__(state['bundle_file'])
+
+    def resolve (self, name):
+        name = os.path.normpath(name).replace(os.sep, '/')
+        return(self.members[name.lower()][0] if name.lower() in self.members else '')
+
+    def exists (self, name):
+        return(self.resolve(name) != '')
+
+    def open (self, name):
+        resolved = self.resolve(name)
+        if resolved == '':
+            raise FileNotFoundError("{} not found in {}".format(name, self.bundle_file))
+        with self.lock:
+            return(io.BytesIO(self.read_member(self.members[resolved.lower()][3])))
+
+    # * and ? do not match across folders, and case is ignored
+    def glob (self, pattern):
+        folder, basename = os.path.split(os.path.normpath(pattern).replace(os.sep, '/'))
+        return(sorted([x[0] for x in self.members.values() if os.path.dirname(x[0]).lower() == folder.lower()
+            and fnmatch.fnmatchcase(os.path.basename(x[0]).lower(), basename.lower())]))
+
+    def stat (self, name):
+        return(list(self.members[self.resolve(name).lower()][1:3]))
+
+    def local_path (self, name):
+        return('')
+
+class ZipSource (BundleSource):
+    def read_index (self):
+        import zipfile
+        self.bundle = zipfile.ZipFile(self.bundle_file)
+        for member in self.bundle.infolist():
+            if not member.is_dir():
+                mtime = int(time.mktime(member.date_time + (0, 0, -1)) * 1000000000)
+                self.members[member.filename.lower()] = (member.filename, member.file_size, mtime, member)
+
+    def read_member (self, member):
+        return(self.bundle.read(member))
+
+class TarSource (BundleSource):
+    def read_index (self):
+        import tarfile
+        self.bundle = tarfile.open(self.bundle_file, 'r:*')
+        for member in self.bundle.getmembers():
+            if member.isfile():
+                name = os.path.normpath(member.name).replace(os.sep, '/')
+                self.members[name.lower()] = (name, member.size, int(member.mtime * 1000000000), member)
+
+    def read_member (self, member):
+        with self.bundle.extractfile(member) as f:
+            return(f.read())
+
+local_files = DirectorySource('')
+
+# A folder, a .zip or a .tar bundle; anything else is an error
+def open_source (path):
+    if os.path.isdir(path):
+        return(DirectorySource(path))
+    if path.lower().endswith('.zip'):
+        return(ZipSource(path))
+    if any([path.lower().endswith(x) for x in bundle_extensions]):
+        return(TarSource(path))
+    raise ValueError("{} is not a folder or a .zip / .tar bundle!".format(path))
@@ -3,7 +3,7 @@
 #
 # GitHub eArmada8/gust_stuff
 
-import io, re, struct, json
+import io, re, struct, json, numpy
 
 # Currently only simple formats (8-, 16-, and 32-bit) are supported.  Floats must be 32-bit.
 # Attempting to read an unsupported format will return a raw bytes object.
@@ -172,7 +172,7 @@ def read_fmt(fmt_filename):
         fmt_struct['elements'] = elements
     return(fmt_struct)
 
-def write_fmt(fmt_struct, fmt_filename):
+def write_fmt_stream(fmt_struct, fmt_stream):
     output = bytearray()
     for key in fmt_struct:
         if key == "elements":
@@ -184,25 +184,38 @@ def write_fmt(fmt_struct, fmt_filename):
                         output.extend(("  " + key + ": " + fmt_struct["elements"][i][key] + "\r\n").encode())
         else:
             output.extend((key + ": " + fmt_struct[key] + "\r\n").encode())
+    fmt_stream.write(output)
+    return
+
+def write_fmt(fmt_struct, fmt_filename):
     with open(fmt_filename, "wb") as f:
-        f.write(output)
+        write_fmt_stream(fmt_struct, f)
     return
 
-def read_ib_stream(ib_stream, fmt_struct, e = '<'):
-    ib_data = []
+# Index buffers are decoded / encoded in bulk with numpy.  Only UINT formats are valid for index buffers.
+def get_ib_dtype(fmt_struct, e = '<'):
     # Cheating a bit here, since all index buffers I've seen are single numbers, but fmt doesn't have a stride for IB
-    ib_stride = int(int(re.findall("[0-9]+", fmt_struct["format"])[0])/8)
-    with io.BytesIO(ib_stream) as f:
-        length = f.seek(0,2)
-        f.seek(0)
-        vertex_num = 0
-        triangle = []
-        while f.tell() < length:
-            triangle.extend(unpack_dxgi_vector(f, ib_stride, fmt_struct["format"], e))
-            vertex_num += 1
-            if vertex_num % 3 == 0 or f.tell() == length:
-                ib_data.append(triangle)
-                triangle = []
+    ib_bits = int(re.findall("[0-9]+", fmt_struct["format"].split('DXGI_FORMAT_')[-1])[0])
+    return(numpy.dtype({8: 'u1', 16: 'u2', 32: 'u4'}[ib_bits]).newbyteorder(e))
+
+# Picks the narrowest index format that can hold every index.  0xFFFF is reserved (primitive restart / glTF).
+def get_ib_format(ib_data):
+    if type(ib_data) == numpy.ndarray:
+        max_index = int(ib_data.max()) if ib_data.size > 0 else 0
+    else:
+        max_index = max([x for y in ib_data for x in (y if type(y) == list else [y])], default = 0)
+    return("DXGI_FORMAT_R32_UINT" if max_index >= 0xFFFF else "DXGI_FORMAT_R16_UINT")
+
+# Returns an (N,3) array of triangles, trailing indices that do not make up a full triangle are discarded
+def read_ib_array(ib_stream, fmt_struct, e = '<'):
+    ib_array = numpy.frombuffer(ib_stream, dtype = get_ib_dtype(fmt_struct, e))
+    return(ib_array[:(len(ib_array) // 3) * 3].reshape(-1,3))
+
+def read_ib_stream(ib_stream, fmt_struct, e = '<'):
+    ib_array = numpy.frombuffer(ib_stream, dtype = get_ib_dtype(fmt_struct, e))
+    ib_data = ib_array[:(len(ib_array) // 3) * 3].reshape(-1,3).tolist()
+    if len(ib_array) % 3: # Keep the partial triangle at the end, like the original per-index reader
+        ib_data.append(ib_array[(len(ib_array) // 3) * 3:].tolist())
     return(ib_data)
 
 def read_ib(ib_filename, fmt_struct, e = '<'):
@@ -211,17 +224,13 @@ def read_ib(ib_filename, fmt_struct, e = '<'):
     return(read_ib_stream(ib_stream, fmt_struct, e))
 
 def write_ib_stream(ib_data, ib_stream, fmt_struct, e = '<'):
-    # See above about cheating
-    ib_stride = int(int(re.findall("[0-9]+", fmt_struct["format"])[0])/8)
-    if len(ib_data) > 0:
-        if type(ib_data[0]) == list: # Flatten list for legacy code
-            new_ib_data = [x for y in ib_data for x in y]
-        else:
-            new_ib_data = ib_data
+    if type(ib_data) == numpy.ndarray:
+        new_ib_data = ib_data.ravel()
+    elif len(ib_data) > 0 and type(ib_data[0]) == list: # Flatten list for legacy code
+        new_ib_data = [x for y in ib_data for x in y]
     else:
         new_ib_data = ib_data
-    for i in range(len(new_ib_data)):
-        pack_dxgi_vector(ib_stream, [new_ib_data[i]], ib_stride, fmt_struct["format"], e)
+    ib_stream.write(numpy.asarray(new_ib_data).astype(get_ib_dtype(fmt_struct, e)).tobytes())
     return
 
 def write_ib(ib_data, ib_filename, fmt_struct, e = '<'):
@@ -363,7 +372,7 @@ def write_vb(vb_data, vb_filename, fmt_struct, e = '<', interleave = True):
     return
 
 # The following two functions are purely for convenience
-def read_struct_from_json(filename, raise_on_fail = True):
+def read_struct_from_json(filename, raise_on_fail = True, interactive = True):
     with open(filename, 'r') as f:
         try:
             return(json.loads(f.read()))
@@ -371,7 +380,8 @@ def read_struct_from_json(filename, raise_on_fail = True):
             print("Decoding error when trying to read JSON file {0}!\r\n".format(filename))
             print("{0} at line {1} column {2} (character {3})\r\n".format(e.msg, e.lineno, e.colno, e.pos))
             if raise_on_fail == True:
-                input("Press Enter to abort.")
+                if interactive == True:
+                    input("Press Enter to abort.")
                 raise
             else:
                 return(False)
@@ -0,0 +1,85 @@
+# Keyframe reduction for exported animation curves.  DCT compressed channels are decoded to one key per frame,
+# and most of those keys can be rebuilt by interpolating between their neighbours.  reduce_keyframes() keeps only
+# the keys that are needed to stay within a tolerance of every original key, using the interpolation that glTF
+# uses for LINEAR samplers: lerp for translation and scale, and slerp for rotation.
+#
+# The curve is walked from the first key, and each kept key reaches as far ahead as it can: the segment length
+# is doubled while every original key inside it is still within the tolerance, then narrowed down by bisection.
+# Every segment is checked against all of the original keys it covers in one numpy operation, so the error
+# never adds up over removed keys.  The first and last keys are always kept.
+#
+# Tolerances are per glTF path: a distance for translation and scale, and an angle in radians for rotation.
+#
+# GitHub eArmada8/berseria_model_tool
+
+try:
+    import numpy
+except ModuleNotFoundError as e:
+    print("Python module missing! {}".format(e.msg))
+    input("Press Enter to abort.")
+    raise
+
+default_tolerances = {'translation': 0.0005, 'rotation': 0.0005, 'scale': 0.0005}
+
+# Shortest path slerp of quaternions q0 and q1 (n x 4, xyzw) at fractions t (n)
+def slerp (q0, q1, t):
+    dot = numpy.sum(q0 * q1, axis = 1)
+    q1 = numpy.where((dot < 0)[:,None], -q1, q1)
+    dot = numpy.clip(numpy.abs(dot), 0.0, 1.0)
+    theta = numpy.arccos(dot)
+    sin_theta = numpy.sin(theta)
+    small = sin_theta < 1e-6 # Nearly the same rotation, lerp is exact enough
+    safe_sin = numpy.where(small, 1.0, sin_theta)
+    w0 = numpy.where(small, 1.0 - t, numpy.sin((1.0 - t) * theta) / safe_sin)
+    w1 = numpy.where(small, t, numpy.sin(t * theta) / safe_sin)
+    return(w0[:,None] * q0 + w1[:,None] * q1)
+
+# Largest error of the keys between key a and key b when they are interpolated from a and b
+def segment_error (times, values, a, b, rotation = False):
+    if b - a < 2:
+        return(0.0)
+    span = times[b] - times[a]
+    t = (times[a+1:b] - times[a]) / span if span > 0 else numpy.zeros(b - a - 1)
+    original = values[a+1:b]
+    if rotation == True:
+        rebuilt = slerp(numpy.repeat(values[a:a+1], b - a - 1, axis = 0),
+            numpy.repeat(values[b:b+1], b - a - 1, axis = 0), t)
+        rebuilt /= numpy.linalg.norm(rebuilt, axis = 1)[:,None]
+        dot = numpy.abs(numpy.sum(rebuilt * original, axis = 1) / numpy.linalg.norm(original, axis = 1))
+        return(float(numpy.max(2.0 * numpy.arccos(numpy.clip(dot, 0.0, 1.0)))))
+    rebuilt = values[a] + t[:,None] * (values[b] - values[a])
+    return(float(numpy.max(numpy.linalg.norm(rebuilt - original, axis = 1))))
+
+# Returns the indices of the keys to keep (times is n, values n x components)
+def reduce_keyframes (times, values, tolerance, rotation = False):
+    times = numpy.asarray(times, dtype = 'float64')
+    values = numpy.asarray(values, dtype = 'float64')
+    if len(times) < 3:
+        return(numpy.arange(len(times)))
+    keep = [0]
+    a = 0
+    while a < len(times) - 1:
+        good, step = a + 1, 2
+        while a + step < len(times) and segment_error(times, values, a, a + step, rotation) <= tolerance:
+            good = a + step
+            step *= 2
+        bad = min(a + step, len(times))
+        while bad - good > 1:
+            middle = (good + bad) // 2
+            if segment_error(times, values, a, middle, rotation) <= tolerance:
+                good = middle
+            else:
+                bad = middle
+        keep.append(good)
+        a = good
+    return(numpy.array(keep))
+
+# Tolerances from the command line, "translation=0.001,rotation=0.0005"; paths that are not given use the defaults
+def parse_tolerances (text = ''):
+    tolerances = dict(default_tolerances)
+    for item in [x.strip() for x in text.split(',') if x.strip() != '']:
+        path, value = item.split('=')
+        if not path.strip() in default_tolerances:
+            raise ValueError("Unknown animation path {}, use translation, rotation or scale!".format(path.strip()))
+        tolerances[path.strip()] = float(value)
+    return(tolerances)
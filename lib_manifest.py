@@ -0,0 +1,297 @@
+# Runs a whole build described in a manifest file (JSON, or TOML with python 3.11 and newer) in one process.
+# Tasks can depend on other tasks.  The files of the tasks whose dependencies have finished are processed in
+# parallel on a shared thread pool, one work item per file.  Skeletons and parsed models are read once and shared
+# between tasks, and the time taken by each task is reported at the end.
+#
+# Manifest format.  Paths and glob patterns are relative to the folder of the manifest, and are expanded when
+# the task starts, so they can match files written by earlier tasks:
+# {
+#     "workers": 4,
+#     "tasks": [
+#         {"id": "models", "type": "export-model", "files": ["CHR_*.TOMDLB_D"], "options": {"combine": true}},
+#         {"id": "anims", "type": "export-animation", "files": ["*.TOANMB"], "after": ["models"],
+#             "options": {"skeleton": "CHR_full_skeleton.json"}},
+#         {"id": "textures", "type": "dds-to-totexp", "files": ["textures/*.dds"], "options": {"game": "berseria"}}
+#     ]
+# }
+#
+# Task types and their options.  Options that are not given use the defaults of the individual scripts:
+# export-model: overwrite, raw_buffers, binary_gltf, meshpack, combine, skeleton, force, jobs (processes that decode
+#     the models of a combined glTF), quantize
+# export-animation: overwrite, binary_gltf, dump_animation_data, dump_format ("json" or "npz"), skeleton, reduce
+#     (true for the default tolerances of lib_keyframes.py, or {"translation": 0.001, ...}), quantize
+# import-model: swap_endian
+# convert-endian: (none)
+# meshpack: unpack
+# dds-to-totexp: game ("berseria" or "zestiria")
+# totexp-to-dds: (none)
+#
+# If a task fails, the tasks that depend on it are skipped.  Nothing is ever asked at the console.
+#
+# GitHub eArmada8/berseria_model_tool
+
+try:
+    import json, glob, copy, time, threading, os, sys
+    from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+    # The texture tools live in their own folder
+    sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'texture_conversion'))
+except ModuleNotFoundError as e:
+    print("Python module missing! {}".format(e.msg))
+    input("Press Enter to abort.")
+    raise
+
+# Objects read from files, shared between tasks.  An entry is only reused while the file keeps the same size and
+# modification time, so a file that is rewritten by an earlier task is read again.  Each entry is loaded under its
+# own lock, so two tasks that need the same file at the same time only read it once.  Entries with a known number
+# of uses (expected_uses) are dropped after their last use, so that parsed models do not pile up in memory.
+class SharedCache:
+    def __init__ (self, expected_uses = {}):
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.expected_uses = expected_uses
+        self.hits, self.misses = 0, 0
+
+    def get (self, kind, filename, loader):
+        stat = os.stat(filename)
+        key = (kind, os.path.abspath(filename))
+        with self.lock:
+            if not (key in self.entries and self.entries[key]['stat'] == (stat.st_size, stat.st_mtime_ns)):
+                self.entries[key] = {'stat': (stat.st_size, stat.st_mtime_ns), 'lock': threading.Lock(),
+                    'loaded': False, 'value': None, 'uses': 0}
+            entry = self.entries[key]
+        with entry['lock']:
+            if entry['loaded'] == False:
+                entry['value'] = loader(filename)
+                entry['loaded'] = True
+                is_hit = False
+            else:
+                is_hit = True
+        with self.lock:
+            if is_hit == True:
+                self.hits += 1
+            else:
+                self.misses += 1
+            entry['uses'] += 1
+            if key in self.expected_uses and entry['uses'] >= self.expected_uses[key] and self.entries.get(key) is entry:
+                del(self.entries[key])
+        return(entry['value'])
+
+def load_manifest (manifest_file):
+    if manifest_file[-5:].lower() == '.toml':
+        import tomllib # Python 3.11 and newer
+        with open(manifest_file, 'rb') as f:
+            return(tomllib.load(f))
+    else:
+        with open(manifest_file, 'rb') as f:
+            return(json.loads(f.read()))
+
+# Returns the task ids in an order where every task comes after the tasks it depends on
+def sort_tasks (tasks):
+    ids = [x['id'] for x in tasks]
+    if len(set(ids)) < len(ids):
+        raise ValueError("Duplicate task ids in manifest: {}".format(sorted(set([x for x in ids if ids.count(x) > 1]))))
+    for task in tasks:
+        if not task.get('type') in task_types:
+            raise ValueError("Task {0} has unknown type {1}!".format(task['id'], task.get('type')))
+        for dependency in task.get('after', []):
+            if not dependency in ids:
+                raise ValueError("Task {0} depends on unknown task {1}!".format(task['id'], dependency))
+    order = []
+    remaining = {x['id']: set(x.get('after', [])) for x in tasks}
+    while len(remaining) > 0:
+        ready = [x for x in ids if x in remaining and len(remaining[x] - set(order)) == 0]
+        if len(ready) == 0:
+            raise ValueError("Tasks have circular dependencies: {}".format(sorted(remaining)))
+        for task_id in ready:
+            order.append(task_id)
+            del(remaining[task_id])
+    return(order)
+
+# Returns the matching files, and the patterns that did not match anything
+def expand_files (base_folder, patterns):
+    files, missing = [], []
+    for pattern in patterns:
+        matches = sorted(glob.glob(os.path.join(base_folder, pattern)))
+        if len(matches) > 0:
+            files.extend(matches)
+        else:
+            missing.append(pattern)
+    return(files, missing)
+
+def option_path (base_folder, options, name):
+    return(os.path.join(base_folder, options[name]) if options.get(name, '') != '' else '')
+
+# Each task type returns a list of stages, each a list of (name, function) work items.  The work items of a stage
+# run in parallel on the shared pool, and a stage starts once every work item of the previous one has finished.
+def plan_export_model (files, options, base_folder, cache):
+    import berseria_export_model
+    skeleton_file = option_path(base_folder, options, 'skeleton')
+    def export (dlb_file):
+        model = None # Models only read by this task are not cached
+        if cache.expected_uses.get((('model', skeleton_file), os.path.abspath(dlb_file)), 0) > 1:
+            # Only read if the export cache does not already have this export
+            model = lambda: copy.deepcopy(cache.get(('model', skeleton_file), dlb_file,
+                lambda x: berseria_export_model.read_tomdlb(x, skeleton_file, interactive = False)))
+        berseria_export_model.process_dlb(dlb_file, overwrite = options.get('overwrite', False),
+            write_raw_buffers = options.get('raw_buffers', True), write_binary_gltf = options.get('binary_gltf', True),
+            use_meshpack = options.get('meshpack', False), skeleton_file = skeleton_file, interactive = False,
+            separate_gltf = not options.get('combine', False), model = model, force = options.get('force', False),
+            quantize = options.get('quantize', False))
+    stages = [[(x, lambda x=x: export(x)) for x in files]]
+    if options.get('combine', False) == True:
+        stages.append([('combined glTF', lambda: berseria_export_model.process_dlbs_combined(files,
+            overwrite = options.get('overwrite', False), write_binary_gltf = options.get('binary_gltf', True),
+            skeleton_file = skeleton_file, interactive = False, force = options.get('force', False),
+            workers = options.get('jobs', 1), quantize = options.get('quantize', False)))])
+    return(stages)
+
+def plan_export_animation (files, options, base_folder, cache):
+    import berseria_export_animation
+    skeleton_file = option_path(base_folder, options, 'skeleton')
+    tolerances = None
+    if options.get('reduce', False) != False:
+        import lib_keyframes
+        tolerances = dict(lib_keyframes.default_tolerances)
+        if isinstance(options['reduce'], dict):
+            tolerances.update(options['reduce'])
+    def export (animbin_file):
+        if skeleton_file != '':
+            skel_struct = cache.get('skeleton', skeleton_file,
+                lambda x: berseria_export_animation.read_skeleton('', x, interactive = False))
+        else: # Keyed by folder, which changes modification time when a skeleton is added
+            skel_struct = cache.get('skeleton search', os.path.dirname(os.path.abspath(animbin_file)),
+                lambda x: berseria_export_animation.read_skeleton(x, '', interactive = False))
+        berseria_export_animation.process_tosamsb(animbin_file, overwrite = options.get('overwrite', False),
+            write_glb = options.get('binary_gltf', True), dump_extra_animation_data = options.get('dump_animation_data', False),
+            interactive = False, skel_struct = skel_struct, tolerances = tolerances,
+            quantize = options.get('quantize', False), dump_format = options.get('dump_format', 'json'))
+    return([[(x, lambda x=x: export(x)) for x in files]])
+
+def plan_import_model (files, options, base_folder, cache):
+    import berseria_import_model
+    def rebuild (tomdlb_file):
+        if berseria_import_model.process_tomdlb(tomdlb_file, swap_endian = options.get('swap_endian', False),
+                interactive = False) == False:
+            raise ValueError("{} was not rebuilt.".format(tomdlb_file))
+    return([[(x, lambda x=x: rebuild(x)) for x in files]])
+
+def plan_convert_endian (files, options, base_folder, cache):
+    import lib_endian
+    def convert (tomdlb_file):
+        if lib_endian.convert_tomdlb(tomdlb_file) == False:
+            raise ValueError("{} was not converted.".format(tomdlb_file))
+    return([[(x, lambda x=x: convert(x)) for x in files]])
+
+def plan_meshpack (files, options, base_folder, cache):
+    import lib_meshpack
+    function = lib_meshpack.meshpack_to_folder if options.get('unpack', False) == True else lib_meshpack.folder_to_meshpack
+    return([[(x, lambda x=x: function(x)) for x in files]])
+
+def plan_dds_to_totexp (files, options, base_folder, cache):
+    if options.get('game', 'berseria') == 'zestiria':
+        import dds_to_zestiria_totexp_p as texture_tool
+    else:
+        import dds_to_berseria_totexp_p as texture_tool
+    return([[(x, lambda x=x: texture_tool.dds_to_totexp_p(x)) for x in files]])
+
+def plan_totexp_to_dds (files, options, base_folder, cache):
+    import totexp_p_to_dds
+    return([[(x, lambda x=x: totexp_p_to_dds.totexp_p_to_dds(x)) for x in files]])
+
+task_types = {'export-model': plan_export_model, 'export-animation': plan_export_animation,
+    'import-model': plan_import_model, 'convert-endian': plan_convert_endian, 'meshpack': plan_meshpack,
+    'dds-to-totexp': plan_dds_to_totexp, 'totexp-to-dds': plan_totexp_to_dds}
+
+# Expands the files of a task and plans its work.  Returns the result of the task so far, and the stages of work
+# items (none if the task could not be planned).
+def plan_task (task, base_folder, cache):
+    result = {'id': task['id'], 'type': task['type'], 'status': 'ok', 'files': 0, 'failed_files': [], 'seconds': 0.0}
+    try:
+        files, missing = expand_files(base_folder, task.get('files', []))
+        for pattern in missing:
+            print("Task {0}: no files match {1}!".format(task['id'], pattern))
+            result['failed_files'].append(pattern)
+        stages = task_types[task['type']](files, task.get('options', {}), base_folder, cache)
+        result['files'] = len(files)
+    except Exception as err:
+        print("Task {0} failed!  {1}: {2}".format(task['id'], type(err).__name__, err))
+        result['failed_files'].append(task['id'])
+        stages = []
+    return(result, stages)
+
+# Returns False if the work item failed
+def run_work_item (task_id, name, function):
+    try:
+        function()
+    except Exception as err:
+        print("Task {0}: error processing {1}!  {2}: {3}".format(task_id, name, type(err).__name__, err))
+        return False
+    return True
+
+# Number of tasks that will read each model, so that the shared cache can drop a model after its last use
+def count_model_uses (tasks, base_folder):
+    uses = {}
+    for task in tasks:
+        if task['type'] == 'export-model':
+            skeleton_file = option_path(base_folder, task.get('options', {}), 'skeleton')
+            for dlb_file in expand_files(base_folder, task.get('files', []))[0]:
+                key = (('model', skeleton_file), os.path.abspath(dlb_file))
+                uses[key] = uses.get(key, 0) + 1
+    return(uses)
+
+def run_manifest (manifest_file, workers = 0):
+    manifest = load_manifest(manifest_file)
+    base_folder = os.path.dirname(manifest_file)
+    tasks = {x['id']: x for x in manifest['tasks']}
+    order = sort_tasks(manifest['tasks'])
+    if workers < 1:
+        workers = manifest.get('workers', os.cpu_count() or 1)
+    cache = SharedCache(count_model_uses(manifest['tasks'], base_folder))
+    # active holds the tasks that have started: their result so far, remaining stages and running work items
+    results, active, running = {}, {}, {}
+    pending = list(order)
+    start_time = time.perf_counter()
+    with ThreadPoolExecutor(max_workers = workers) as pool:
+        while len(pending) > 0 or len(active) > 0:
+            for task_id in list(pending):
+                dependencies = tasks[task_id].get('after', [])
+                if any([results[x]['status'] != 'ok' for x in dependencies if x in results]):
+                    results[task_id] = {'id': task_id, 'type': tasks[task_id]['type'], 'status': 'skipped',
+                        'files': 0, 'failed_files': [], 'seconds': 0.0}
+                    pending.remove(task_id)
+                elif all([x in results for x in dependencies]):
+                    task_start_time = time.perf_counter()
+                    result, stages = plan_task(tasks[task_id], base_folder, cache)
+                    active[task_id] = {'result': result, 'stages': stages, 'running': 0, 'start_time': task_start_time}
+                    pending.remove(task_id)
+            for task_id in list(active):
+                task = active[task_id]
+                while task['running'] == 0 and len(task['stages']) > 0:
+                    for name, function in task['stages'].pop(0):
+                        running[pool.submit(run_work_item, task_id, name, function)] = (task_id, name)
+                        task['running'] += 1
+                if task['running'] == 0:
+                    if len(task['result']['failed_files']) > 0:
+                        task['result']['status'] = 'failed'
+                    task['result']['seconds'] = round(time.perf_counter() - task['start_time'], 3)
+                    results[task_id] = task['result']
+                    del(active[task_id])
+            if len(running) > 0:
+                done, _ = wait(list(running), return_when = FIRST_COMPLETED)
+                for future in done:
+                    task_id, name = running.pop(future)
+                    if future.result() == False:
+                        active[task_id]['result']['failed_files'].append(name)
+                    active[task_id]['running'] -= 1
+    report = {'manifest': manifest_file, 'workers': workers, 'seconds': round(time.perf_counter() - start_time, 3),
+        'cache_hits': cache.hits, 'cache_misses': cache.misses, 'tasks': [results[x] for x in order]}
+    return(report)
+
+def print_report (report):
+    print("\n{0:<24} {1:<18} {2:>6} {3:>10}  {4}".format('Task', 'Type', 'Files', 'Seconds', 'Status'))
+    for task in report['tasks']:
+        print("{0:<24} {1:<18} {2:>6} {3:>10.3f}  {4}".format(task['id'], task['type'], task['files'],
+            task['seconds'], task['status']))
+    print("Total {0:.3f} seconds with {1} workers, {2} shared cache hits, {3} misses.".format(report['seconds'],
+        report['workers'], report['cache_hits'], report['cache_misses']))
+    return
@@ -0,0 +1,188 @@
+# A small library to store every submesh of a model (.fmt / .ib / .vb / .vgmap) in a single
+# uncompressed .npz container, which is memory mapped on read instead of being parsed element by element.
+#
+# Usage:  Run by itself without commandline arguments and it will pack every model folder in the
+# current directory that contains .fmt files into {folder}/meshes.npz.
+#
+# For command line options, run:
+# /path/to/python3 lib_meshpack.py --help
+#
+# Requires lib_fmtibvb.py, put in the same directory
+#
+# GitHub eArmada8/berseria_model_tool
+
+try:
+    import mmap, struct, json, re, glob, os, sys, numpy
+    from numpy.lib import format as npy_format
+    from lib_fmtibvb import *
+except ModuleNotFoundError as e:
+    print("Python module missing! {}".format(e.msg))
+    input("Press Enter to abort.")
+    raise
+
+meshpack_version = 1
+meshpack_filename = 'meshes.npz'
+
+# Normalized formats are stored decoded (as they are in the vb structure), everything else is stored as-is.
+def get_dtype_from_dxgi_format(dxgi_format):
+    dxgi_format = dxgi_format.split('DXGI_FORMAT_')[-1]
+    dxgi_format_split = dxgi_format.split('_')
+    numtype = dxgi_format_split[1] if len(dxgi_format_split) == 2 else 'UNSUPPORTED'
+    vec_format = re.findall("[0-9]+", dxgi_format_split[0])
+    vec_bits = int(vec_format[0]) if len(vec_format) > 0 else 0
+    if numtype == 'FLOAT' and vec_bits in [16, 32]:
+        return(numpy.dtype({16: '<f2', 32: '<f4'}[vec_bits]))
+    elif numtype == 'UINT' and vec_bits in [8, 16, 32]:
+        return(numpy.dtype({8: 'u1', 16: '<u2', 32: '<u4'}[vec_bits]))
+    elif numtype == 'SINT' and vec_bits in [8, 16, 32]:
+        return(numpy.dtype({8: 'i1', 16: '<i2', 32: '<i4'}[vec_bits]))
+    elif numtype in ['UNORM', 'SNORM']:
+        return(numpy.dtype('<f4'))
+    else:
+        return(False)
+
+# submeshes is a list of {'name': '00_MESHNAME', 'fmt': fmt, 'ib': ib, 'vb': vb, 'vgmap': vgmap}
+def write_meshpack_stream(submeshes, pack_stream):
+    index = {'version': meshpack_version, 'submeshes': []}
+    arrays = {}
+    for submesh in submeshes:
+        index['submeshes'].append({'name': submesh['name'], 'fmt': submesh['fmt'], 'vgmap': submesh['vgmap'],
+            'semantics': [[x['SemanticName'], x['SemanticIndex']] for x in submesh['fmt']['elements']]})
+        arrays['{}.ib'.format(submesh['name'])] = numpy.asarray(submesh['ib']).astype(get_ib_dtype(submesh['fmt'])).reshape(-1,3)
+        for j in range(len(submesh['fmt']['elements'])):
+            dtype = get_dtype_from_dxgi_format(submesh['fmt']['elements'][j]['Format'])
+            if dtype == False:
+                print("Unsupported format {0} in {1}, cannot add to mesh pack!".format(
+                    submesh['fmt']['elements'][j]['Format'], submesh['name']))
+                raise ValueError
+            arrays['{0}.vb{1}'.format(submesh['name'], j)] = numpy.array(submesh['vb'][j]['Buffer'], dtype = dtype)
+    arrays['meshpack_index'] = numpy.frombuffer(json.dumps(index).encode('utf-8'), dtype = 'u1')
+    # Written uncompressed so that every member can be mapped directly
+    numpy.savez(pack_stream, **arrays)
+    return
+
+def write_meshpack(submeshes, pack_filename):
+    with open(pack_filename, 'wb') as f:
+        write_meshpack_stream(submeshes, f)
+    return
+
+# The submeshes of a mesh pack ({submesh name: submesh}, see read_meshpack()) and the memory map they point into.
+# close(), or leaving a with block, unmaps the pack file as soon as none of its arrays are in use any more, so that
+# the file can be replaced (Windows locks mapped files).
+class mapped_meshpack (dict):
+    def __init__ (self, submeshes = {}, mm = None):
+        super().__init__(submeshes)
+        self.mm = mm
+
+    def close (self):
+        self.clear()
+        if self.mm != None:
+            try:
+                self.mm.close()
+            except BufferError: # Arrays of the pack are still in use, the map is closed once they are freed
+                pass
+            self.mm = None
+        return
+
+    def __enter__ (self):
+        return(self)
+
+    def __exit__ (self, *args):
+        self.close()
+        return
+
+# Returns a mapped_meshpack, {submesh name: {'fmt': fmt, 'ib': (N,3) array, 'vb': vb with arrays as buffers,
+# 'vgmap': vgmap}}.  Arrays are read-only views into a memory map of the pack file; nothing is copied until the
+# caller does so.
+def read_meshpack(pack_filename):
+    import zipfile
+    with open(pack_filename, 'rb') as f:
+        mm = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+    arrays = {}
+    with zipfile.ZipFile(pack_filename) as z:
+        for info in z.infolist():
+            if not info.compress_type == zipfile.ZIP_STORED:
+                print("{} is compressed and cannot be memory mapped!".format(pack_filename))
+                raise ValueError
+            # Local file header is 30 bytes, followed by the file name and extra field
+            name_len, extra_len = struct.unpack("<2H", mm[info.header_offset + 26:info.header_offset + 30])
+            mm.seek(info.header_offset + 30 + name_len + extra_len)
+            version = npy_format.read_magic(mm)
+            if version == (1, 0):
+                shape, fortran_order, dtype = npy_format.read_array_header_1_0(mm)
+            else:
+                shape, fortran_order, dtype = npy_format.read_array_header_2_0(mm)
+            count = int(numpy.prod(shape))
+            array = numpy.frombuffer(mm, dtype = dtype, count = count, offset = mm.tell())
+            arrays[info.filename[:-4]] = array.reshape(shape, order = 'F' if fortran_order else 'C')
+    index = json.loads(arrays['meshpack_index'].tobytes().decode('utf-8'))
+    submeshes = {}
+    for submesh in index['submeshes']:
+        vb = [{'SemanticName': submesh['semantics'][j][0], 'SemanticIndex': submesh['semantics'][j][1],
+            'Buffer': arrays['{0}.vb{1}'.format(submesh['name'], j)]} for j in range(len(submesh['semantics']))]
+        submeshes[submesh['name']] = {'fmt': submesh['fmt'], 'ib': arrays['{}.ib'.format(submesh['name'])],
+            'vb': vb, 'vgmap': submesh['vgmap']}
+    return(mapped_meshpack(submeshes, mm))
+
+# Converts a mapped submesh back into the list-based structures used by lib_fmtibvb
+def meshpack_submesh_to_lists(submesh):
+    vb = [{'SemanticName': x['SemanticName'], 'SemanticIndex': x['SemanticIndex'], 'Buffer': x['Buffer'].tolist()}
+        for x in submesh['vb']]
+    return(submesh['fmt'], submesh['ib'].tolist(), vb, submesh['vgmap'])
+
+def folder_to_meshpack(folder, pack_filename = ''):
+    if pack_filename == '':
+        pack_filename = os.path.join(folder, meshpack_filename)
+    submeshes = []
+    for fmt_filename in sorted(glob.glob(os.path.join(folder, '*.fmt'))):
+        name = os.path.basename(fmt_filename)[:-4]
+        fmt = read_fmt(fmt_filename)
+        ib = read_ib(fmt_filename[:-4] + '.ib', fmt)
+        vb = read_vb(fmt_filename[:-4] + '.vb', fmt)
+        if 'vb0 stride' in fmt: # Segmented buffers are merged into a single interleaved layout
+            fmt = {'stride': str(sum([get_stride_from_dxgi_format(x['Format']) for x in fmt['elements']])),
+                **{x:fmt[x] for x in fmt if not 'stride' in x}}
+            offset = 0
+            for element in fmt['elements']:
+                element['InputSlot'], element['AlignedByteOffset'] = '0', str(offset)
+                offset += get_stride_from_dxgi_format(element['Format'])
+        vgmap = read_struct_from_json(fmt_filename[:-4] + '.vgmap') if os.path.exists(fmt_filename[:-4] + '.vgmap') else {}
+        submeshes.append({'name': name, 'fmt': fmt, 'ib': ib, 'vb': vb, 'vgmap': vgmap})
+    write_meshpack(submeshes, pack_filename)
+    return(len(submeshes))
+
+def meshpack_to_folder(pack_filename, folder = ''):
+    if folder == '':
+        folder = os.path.dirname(os.path.abspath(pack_filename))
+    if not os.path.exists(folder):
+        os.mkdir(folder)
+    with read_meshpack(pack_filename) as submeshes:
+        for name in submeshes:
+            fmt, ib, vb, vgmap = meshpack_submesh_to_lists(submeshes[name])
+            write_fmt(fmt, '{0}/{1}.fmt'.format(folder, name))
+            write_ib(ib, '{0}/{1}.ib'.format(folder, name), fmt, '<')
+            write_vb(vb, '{0}/{1}.vb'.format(folder, name), fmt, '<')
+            open('{0}/{1}.vgmap'.format(folder, name), 'wb').write(json.dumps(vgmap,indent=4).encode())
+        return(len(submeshes))
+
+if __name__ == "__main__":
+    # Set current directory
+    if getattr(sys, 'frozen', False):
+        os.chdir(os.path.dirname(sys.executable))
+    else:
+        os.chdir(os.path.abspath(os.path.dirname(__file__)))
+
+    if len(sys.argv) > 1:
+        import argparse
+        parser = argparse.ArgumentParser()
+        parser.add_argument('-u', '--unpack', help="Unpack meshes.npz into .fmt/.ib/.vb/.vgmap files", action="store_true")
+        parser.add_argument('target', help="Model folder to pack, or .npz file to unpack.")
+        args = parser.parse_args()
+        if args.unpack == True and os.path.isfile(args.target):
+            print("Unpacked {0} submeshes from {1}.".format(meshpack_to_folder(args.target), args.target))
+        elif args.unpack == False and os.path.isdir(args.target):
+            print("Packed {0} submeshes from {1}.".format(folder_to_meshpack(args.target), args.target))
+    else:
+        folders = [x for x in glob.glob('*') if os.path.isdir(x) and len(glob.glob(os.path.join(x, '*.fmt'))) > 0]
+        for folder in folders:
+            print("Packed {0} submeshes from {1}.".format(folder_to_meshpack(folder), folder))
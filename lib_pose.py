@@ -0,0 +1,214 @@
+# Evaluates the pose of a skeleton at any time of an animation, without going through glTF.  pose_evaluator takes
+# the decoded animation data (read_tosamsb() of berseria_export_animation.py) and the skeleton (skel_struct), and
+# returns the world matrices of every bone for a batch of times at once, as a (times, bones, 4, 4) array.
+#
+# The channels that the glTF exporter would write (translation, rotation and scale of the bones of the skeleton)
+# are interpolated as their flag says: linear (types 0, 8 and 9: lerp, or slerp for rotations), step (type 2) or
+# constant (type 3).  Times before the first key or after the last key hold the first or last value.  All the
+# channels of one path are evaluated together: their keys are laid end to end in one array, so every (channel, time)
+# pair is found with a single searchsorted.  As in the glTF, the values are relative to the bind pose of each bone,
+# and bones without channels stay in their bind pose.  The local matrices are then multiplied down the hierarchy one
+# level at a time, all bones of a level and all times in one batched matmul.
+#
+# Matrices are column vector (glTF) matrices, with the translation in [:3,3]: a point p of the bone moves to
+# matrix @ [p, 1].  The matrices of skel_struct are stored the other way round (transposed).
+#
+# Evaluated frames are kept in a least recently used cache (cache_size frames, keyed by time), so previews, baking
+# and validation scripts that ask for the same frames again do not evaluate them twice.
+#
+# GitHub eArmada8/berseria_model_tool
+
+try:
+    import collections, numpy
+    from lib_keyframes import slerp
+except ModuleNotFoundError as e:
+    print("Python module missing! {}".format(e.msg))
+    input("Press Enter to abort.")
+    raise
+
+default_pose_cache_size = 1024 # In frames
+
+channel_paths = {0x20003: 'translation', 0x10014: 'rotation', 0x00003: 'scale'}
+
+# Hamilton product of quaternions (..., 4, xyzw)
+def quaternion_multiply (q0, q1):
+    x0, y0, z0, w0 = [q0[...,i] for i in range(4)]
+    x1, y1, z1, w1 = [q1[...,i] for i in range(4)]
+    return(numpy.stack([w0*x1 + x0*w1 + y0*z1 - z0*y1, w0*y1 - x0*z1 + y0*w1 + z0*x1,
+        w0*z1 + x0*y1 - y0*x1 + z0*w1, w0*w1 - x0*x1 - y0*y1 - z0*z1], axis = -1))
+
+# Column vector matrices (..., 4, 4) of translations (..., 3), rotations (..., 4, xyzw, normalized here) and scales
+def trs_to_matrices (translations, rotations, scales):
+    q = rotations / numpy.linalg.norm(rotations, axis = -1)[...,None]
+    x, y, z, w = [q[...,i] for i in range(4)]
+    matrices = numpy.zeros(translations.shape[:-1] + (4, 4))
+    matrices[...,0,0], matrices[...,0,1], matrices[...,0,2] = 1 - 2*(y*y + z*z), 2*(x*y - z*w), 2*(x*z + y*w)
+    matrices[...,1,0], matrices[...,1,1], matrices[...,1,2] = 2*(x*y + z*w), 1 - 2*(x*x + z*z), 2*(y*z - x*w)
+    matrices[...,2,0], matrices[...,2,1], matrices[...,2,2] = 2*(x*z - y*w), 2*(y*z + x*w), 1 - 2*(x*x + y*y)
+    matrices[...,:3,:3] *= scales[...,None,:]
+    matrices[...,:3,3] = translations
+    matrices[...,3,3] = 1.0
+    return(matrices)
+
+# All the channels of one path, with their keys (in seconds) laid end to end.  Each channel is shifted past the end
+# of the one before it, so that the keys are sorted as a whole.
+class path_channels:
+    def __init__ (self, bones, kinds, keys, values):
+        self.bones = numpy.array(bones, dtype = 'int64')
+        self.step = numpy.array([x == 'step' for x in kinds])
+        self.starts = numpy.cumsum([0] + [len(x) for x in keys])[:-1]
+        self.ends = self.starts + numpy.array([len(x) for x in keys]) - 1
+        self.first = numpy.array([x[0] for x in keys])
+        self.last = numpy.array([x[-1] for x in keys])
+        self.shifts = numpy.cumsum([0.0] + [x[-1] - x[0] + 1.0 for x in keys])[:-1] - self.first
+        self.keys = numpy.concatenate([keys[i] + self.shifts[i] for i in range(len(keys))])
+        self.values = numpy.concatenate(values)
+
+    # Values of every channel (channels, times, components), interpolated with interpolate(v0, v1, fractions)
+    def evaluate (self, times, interpolate):
+        local_times = numpy.clip(times[None,:], self.first[:,None], self.last[:,None])
+        shifted = local_times + self.shifts[:,None]
+        lower = numpy.clip(numpy.searchsorted(self.keys, shifted, side = 'right') - 1, self.starts[:,None],
+            self.ends[:,None])
+        upper = numpy.minimum(lower + 1, self.ends[:,None])
+        span = self.keys[upper] - self.keys[lower]
+        fractions = numpy.where(span > 0, (shifted - self.keys[lower]) / numpy.where(span > 0, span, 1.0), 0.0)
+        fractions[self.step] = 0.0
+        v0, v1 = self.values[lower.reshape(-1)], self.values[upper.reshape(-1)]
+        return(interpolate(v0, v1, fractions.reshape(-1)).reshape(lower.shape + (self.values.shape[1],)))
+
+def lerp (v0, v1, fractions):
+    return(v0 + fractions[:,None] * (v1 - v0))
+
+class pose_evaluator:
+    # ani_data is from read_tosamsb() (lazy or not), skel_struct the skeleton of the glTF exporter.  skeleton_nodes
+    # (make_skeleton_nodes() of berseria_export_animation.py) can be given if they have already been made.  fps is
+    # the number of frames per second of the key times (ani_fps of berseria_export_animation.py).
+    def __init__ (self, ani_data, skel_struct, skeleton_nodes = None, fps = 30, cache_size = None):
+        if skeleton_nodes == None:
+            import berseria_export_animation
+            skeleton_nodes = berseria_export_animation.make_skeleton_nodes(skel_struct)
+        self.bone_names = [x['name'] for x in skeleton_nodes]
+        self.fps = fps
+        self.cache_size = cache_size if cache_size != None else default_pose_cache_size
+        self.cache = collections.OrderedDict()
+        self.hits, self.misses = 0, 0
+        num_bones = len(skeleton_nodes)
+        self.bind_translations = numpy.array([x.get('translation', [0.0, 0.0, 0.0]) for x in skeleton_nodes])
+        self.bind_rotations = numpy.array([x.get('rotation', [0.0, 0.0, 0.0, 1.0]) for x in skeleton_nodes])
+        self.bind_scales = numpy.array([x.get('scale', [1.0, 1.0, 1.0]) for x in skeleton_nodes])
+        # Bones by depth in the hierarchy, so that each level only needs the level above it
+        parents = numpy.full(num_bones, -1)
+        for i in range(num_bones):
+            for child in skeleton_nodes[i].get('children', []):
+                parents[child] = i
+        depths = numpy.zeros(num_bones, dtype = 'int64')
+        for i in range(num_bones):
+            parent = parents[i]
+            while parent >= 0 and depths[i] < num_bones: # A broken hierarchy with loops stops eventually
+                depths[i] += 1
+                parent = parents[parent]
+        self.parents = parents
+        self.levels = [numpy.flatnonzero(depths == x) for x in range(depths.max() + 1 if num_bones > 0 else 0)]
+        # The same channels as make_animation_channels() of berseria_export_animation.py
+        node_dict = {skeleton_nodes[j]['name']:j for j in range(len(skeleton_nodes))}
+        bone_id_to_name = {x['ani_id']:x['name'] for x in skel_struct}
+        valid_bones = [x['ani_id'] for x in skel_struct if x['name'] in node_dict]
+        targets = ani_data['targets']
+        ani_list = numpy.flatnonzero(numpy.isin(targets['target'], valid_bones)
+            & numpy.isin(targets['type'], list(channel_paths))).tolist()
+        if hasattr(ani_data['data_stream'], 'prefetch'): # lazy_vector_stream
+            ani_data['data_stream'].prefetch(targets['vec_index'][ani_list].tolist())
+        channels = {x: {'bones': [], 'kinds': [], 'keys': [], 'values': []} for x in channel_paths.values()}
+        self.duration = 0.0
+        for i in ani_list:
+            vec_channel = ani_data['data_stream'][int(targets['vec_index'][i])]
+            if len(vec_channel.values) == 0:
+                continue
+            path = channels[channel_paths[int(targets['type'][i])]]
+            path['bones'].append(node_dict[bone_id_to_name[int(targets['target'][i])]])
+            if vec_channel.type_ == 3 or len(vec_channel.keys) != len(vec_channel.values): # Single vector
+                path['kinds'].append('constant')
+                path['keys'].append(numpy.zeros(1))
+                path['values'].append(vec_channel.values[0:1].astype('float64'))
+            else:
+                path['kinds'].append('step' if vec_channel.type_ == 2 else 'linear')
+                path['keys'].append(vec_channel.keys.astype('float64') / fps)
+                path['values'].append(vec_channel.values.astype('float64'))
+            self.duration = max(self.duration, path['keys'][-1][-1])
+        self.channels = {x: path_channels(**channels[x]) for x in channels if len(channels[x]['bones']) > 0}
+
+    # Times of every frame from 0 to the end of the animation, at fps (by default that of the animation)
+    def frame_times (self, fps = None):
+        fps = fps if fps != None else self.fps
+        return(numpy.arange(int(round(self.duration * fps)) + 1) / fps)
+
+    # Local translations (times, bones, 3), rotations (times, bones, 4, xyzw) and scales (times, bones, 3)
+    def local_trs (self, times):
+        times = numpy.asarray(times, dtype = 'float64').reshape(-1)
+        translations = numpy.repeat(self.bind_translations[None], len(times), axis = 0)
+        rotations = numpy.repeat(self.bind_rotations[None], len(times), axis = 0)
+        scales = numpy.repeat(self.bind_scales[None], len(times), axis = 0)
+        if 'translation' in self.channels:
+            c = self.channels['translation']
+            translations[:,c.bones] = self.bind_translations[c.bones] + c.evaluate(times, lerp).transpose(1,0,2)
+        if 'rotation' in self.channels:
+            c = self.channels['rotation']
+            rotations[:,c.bones] = quaternion_multiply(self.bind_rotations[c.bones],
+                c.evaluate(times, slerp).transpose(1,0,2))
+        if 'scale' in self.channels:
+            c = self.channels['scale']
+            scales[:,c.bones] = self.bind_scales[c.bones] * c.evaluate(times, lerp).transpose(1,0,2)
+        return(translations, rotations, scales)
+
+    # Local matrices of every bone (times, bones, 4, 4)
+    def local_matrices (self, times):
+        return(trs_to_matrices(*self.local_trs(times)))
+
+    # World matrices of every bone (times, bones, 4, 4), without the cache
+    def evaluate (self, times):
+        world = self.local_matrices(times)
+        for level in self.levels[1:]:
+            world[:,level] = world[:,self.parents[level]] @ world[:,level]
+        return(world)
+
+    # World matrices of every bone (times, bones, 4, 4), times in seconds
+    def world_matrices (self, times):
+        times = [float(x) for x in numpy.asarray(times, dtype = 'float64').reshape(-1)]
+        missing = sorted(set([x for x in times if not x in self.cache]))
+        self.hits += len(times) - len(missing)
+        self.misses += len(missing)
+        if len(missing) > 0:
+            for time, matrices in zip(missing, self.evaluate(missing)):
+                self.cache[time] = matrices
+        for time in times:
+            self.cache.move_to_end(time)
+        result = numpy.array([self.cache[x] for x in times]).reshape(len(times), len(self.bone_names), 4, 4)
+        while len(self.cache) > self.cache_size:
+            self.cache.popitem(last = False)
+        return(result)
+
+    # World matrices of the frames (numbers at fps, by default that of the animation)
+    def frame_matrices (self, frames, fps = None):
+        return(self.world_matrices(numpy.asarray(frames, dtype = 'float64') / (fps if fps != None else self.fps)))
+
+    def clear_cache (self):
+        self.cache.clear()
+        self.hits, self.misses = 0, 0
+        return
+
+# A pose_evaluator for an animation file, with the skeleton found as berseria_export_animation.py finds it (or
+# skel_struct, if it has already been read).  Only the channels of the skeleton are decoded.
+def read_pose_evaluator (animbin_file, skeleton_file = '', skel_struct = None, interactive = False, source = None,
+        cache_size = None):
+    import os, berseria_export_animation
+    source = source if source != None else berseria_export_animation.local_files
+    ani_data = berseria_export_animation.read_tosamsb(animbin_file, interactive, source, lazy = True)
+    if ani_data == None: # Empty file
+        return(None)
+    if skel_struct == None:
+        skel_struct = berseria_export_animation.read_skeleton(os.path.dirname(animbin_file), skeleton_file,
+            interactive, source)
+    evaluator = pose_evaluator(ani_data, skel_struct, fps = berseria_export_animation.ani_fps, cache_size = cache_size)
+    berseria_export_animation.save_decoded_animation(ani_data)
+    return(evaluator)
@@ -0,0 +1,41 @@
+# Console prompts shared by the tools.  The scripts are meant to be double-clicked, so by default they ask before
+# overwriting files, ask which skeleton to use when several match, and wait for Enter after an error.  Callers
+# that use the tools as a library (e.g. berseria.py) pass interactive = False instead, in which case nothing is
+# ever read from the console: existing files are skipped unless overwrite is set, ambiguous choices raise
+# ValueError, and errors are raised without waiting.
+#
+# GitHub eArmada8/berseria_model_tool
+
+def confirm_overwrite (name, overwrite = False, interactive = True):
+    if overwrite == True:
+        return True
+    if interactive == True:
+        return(str(input(name + " exists! Overwrite? (y/N) ")).lower()[0:1] == 'y')
+    print("{} exists, skipping...".format(name))
+    return False
+
+# Returns the chosen option, or '' if there are no options
+def choose_from_list (options, question, interactive = True):
+    if len(options) == 0:
+        return ''
+    elif len(options) == 1:
+        return options[0]
+    if interactive == False:
+        raise ValueError("Multiple matches found, please choose one of: {}".format(', '.join(options)))
+    print("Multiple matches found, please choose one.")
+    for i in range(len(options)):
+        print("{0}. {1}".format(i+1, options[i]))
+        if (i+1) % 25 == 0 and (i+1) < len(options):
+            input("More results, press Enter to continue...")
+    while True:
+        raw_input = input(question + " ")
+        if raw_input.isnumeric() and int(raw_input)-1 in range(len(options)):
+            return options[int(raw_input)-1]
+        else:
+            print("Invalid entry!")
+
+def pause_on_error (message, interactive = True, action = "abort"):
+    print(message)
+    if interactive == True:
+        input("Press Enter to {}.".format(action))
+    return
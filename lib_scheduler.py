@@ -0,0 +1,78 @@
+# Runs a batch of independent jobs (one per file) on a pool of worker processes, longest job first.  The length
+# of each job is estimated beforehand from the file headers only (estimate_dlb_cost() in berseria_export_model.py,
+# estimate_tosamsb_cost() in berseria_export_animation.py), in an arbitrary unit.  The jobs are queued from the
+# most to the least expensive, and each worker takes the next job from the queue as soon as it is free, so a single
+# huge model or cutscene is started first instead of being left to run alone at the end.
+#
+# After the run, the estimated and the actual time of every job is printed, with the estimates converted to
+# seconds using the average speed of the whole run, so that badly estimated files stand out.  The same numbers can
+# be appended to a JSON lines log file to check the cost model over many runs.
+#
+# GitHub eArmada8/berseria_model_tool
+
+try:
+    import traceback, json, time, os
+    from concurrent.futures import ProcessPoolExecutor, as_completed
+except ModuleNotFoundError as e:
+    print("Python module missing! {}".format(e.msg))
+    input("Press Enter to abort.")
+    raise
+
+# Runs in the worker process.  function must be picklable (a module level function, or functools.partial of one).
+def timed_call (function, args):
+    start_time = time.perf_counter()
+    try:
+        function(*args)
+        error = ''
+    except Exception:
+        error = traceback.format_exc()
+    return(time.perf_counter() - start_time, error)
+
+# Each job is a dictionary with 'name', 'function', 'args' and 'cost'.  workers 0 uses every CPU, and workers 1
+# runs the jobs in this process.  initializer(*initargs) is called once in every worker before its first job, to
+# hand data that all the jobs share (such as a skeleton) to the workers only once.  Returns the number of jobs
+# that failed.
+def run_longest_first (jobs, workers = 0, cost_log = '', label = '', initializer = None, initargs = ()):
+    if workers < 1:
+        workers = os.cpu_count() or 1
+    jobs = sorted(jobs, key = lambda x: x['cost'], reverse = True)
+    results = {}
+    start_time = time.perf_counter()
+    if workers == 1 or len(jobs) < 2:
+        if initializer != None:
+            initializer(*initargs)
+        for i in range(len(jobs)):
+            results[i] = timed_call(jobs[i]['function'], jobs[i]['args'])
+            if results[i][1] != '':
+                print("Error processing {}!\n{}".format(jobs[i]['name'], results[i][1]))
+    else:
+        with ProcessPoolExecutor(max_workers = workers, initializer = initializer, initargs = initargs) as pool:
+            futures = {pool.submit(timed_call, jobs[i]['function'], jobs[i]['args']): i for i in range(len(jobs))}
+            for future in as_completed(futures):
+                i = futures[future]
+                try:
+                    results[i] = future.result()
+                except Exception: # The worker process itself failed
+                    results[i] = (0.0, traceback.format_exc())
+                if results[i][1] != '':
+                    print("Error processing {}!\n{}".format(jobs[i]['name'], results[i][1]))
+    wall_time = time.perf_counter() - start_time
+    print_schedule_report(jobs, results, workers, wall_time)
+    if cost_log != '':
+        with open(cost_log, 'ab') as f:
+            for i in range(len(jobs)):
+                f.write((json.dumps({'label': label, 'file': jobs[i]['name'], 'cost': jobs[i]['cost'],
+                    'seconds': round(results[i][0], 4), 'failed': results[i][1] != '', 'workers': workers}) + '\n').encode())
+    return(len([x for x in results if results[x][1] != '']))
+
+def print_schedule_report (jobs, results, workers, wall_time):
+    total_cost = sum([x['cost'] for x in jobs])
+    total_time = sum([results[x][0] for x in results])
+    seconds_per_cost = total_time / total_cost if total_cost > 0 else 0.0
+    print("\n{0:<40} {1:>12} {2:>10} {3:>10}".format('File', 'Cost', 'Estimated', 'Actual'))
+    for i in range(len(jobs)):
+        print("{0:<40} {1:>12} {2:>10.3f} {3:>10.3f}{4}".format(jobs[i]['name'][-40:],
+            jobs[i]['cost'], jobs[i]['cost'] * seconds_per_cost, results[i][0], '  failed' if results[i][1] != '' else ''))
+    print("{0} jobs in {1:.3f} seconds on {2} workers ({3:.3f} seconds of work, longest job {4:.3f} seconds).".format(
+        len(jobs), wall_time, workers, total_time, max([results[x][0] for x in results] + [0.0])))
+    return
@@ -0,0 +1,100 @@
+# Binary record layouts shared by the readers and writers of the Tales of Berseria / Zestiria formats.
+# Each layout is compiled once per (endianness, address size) into a struct.Struct and a numpy dtype.
+#
+# In a layout, 'A' is an address-sized unsigned integer (I for 32-bit addressing, Q for 64-bit addressing)
+# and 'S' is the short variant used in a few tables (H for 32-bit addressing, Q for 64-bit addressing).
+#
+# GitHub eArmada8/berseria_model_tool
+
+import struct, functools, re
+
+schema = {
+    # Common
+    'address': 'A',
+    'pointer': '2A', # offset, count
+    # TOMDLB_D
+    'skeleton_header': '3I6H',
+    'skeleton_unk_block': '2A4Hfi6f',
+    'tree_info': '4h',
+    'matrix': '16f',
+    'physics_header': '2I2H',
+    'physics': '4h25f',
+    'collision': '2H6f2I',
+    'collision_triangle': '9f',
+    'mesh_section_header': '4I',
+    'mesh_unk_block': '4I',
+    'weight_group_counts': '4I',
+    'mesh': 'i4hi',
+    'mesh_entry': 'i4hi3A', # mesh, name offset, data offset, data block size
+    'mesh_data_header': '2H2I',
+    'material_section_header': '2I8H',
+    'material': 'I10h',
+    'material_entry': 'I10h4A', # material, params pointer, shader params pointer
+    'material_name_entry': '5A', # 2 pointers, name offset
+    'shader_params_0x11': '8I4f4If',
+    'shader_params_0x17': '8I4f4If6I',
+    'texture_assignment': '3h',
+    'texture_entry': 'A2S', # name offset, 2 values
+    # TOANMB / TOANMSB
+    'animation_header': 'I2f',
+    'animation_header2': '2Af',
+    'target': 'Q2I',
+    'dct_header': '2H4B',
+    'dct_s16': '4h',
+    # TOSNEB_D
+    'scene_header': 'fI',
+    'scene_section_0': '4i2A',
+    'scene_section_2': '3I72f3i',
+    'scene_section_2_b': 'I4B2I',
+    'scene_section_2_c': '4I', # 64-bit only
+    'scene_section_11': '2IA',
+    'scene_section_15': 'Q2I',
+}
+
+def resolve_layout (layout, addr_size = 8):
+    return(schema.get(layout, layout).replace('A', {4: 'I', 8: 'Q'}[addr_size]).replace('S', {4: 'H', 8: 'Q'}[addr_size]))
+
+@functools.lru_cache(maxsize = None)
+def get_struct (layout, e = '<', addr_size = 8):
+    return(struct.Struct(e + resolve_layout(layout, addr_size)))
+
+# Structured dtype with one field per format token (repeated tokens become sub-arrays), no alignment padding
+@functools.lru_cache(maxsize = None)
+def get_dtype (layout, e = '<', addr_size = 8):
+    import numpy # Imported on first use, so that tools which only use struct layouts do not need numpy
+    fields = []
+    for count, code in re.findall('([0-9]*)([a-zA-Z?])', resolve_layout(layout, addr_size)):
+        if code == 'x':
+            fields.append(('pad{}'.format(len(fields)), 'V{}'.format(int(count) if count else 1)))
+        elif count in ['', '1']:
+            fields.append(('f{}'.format(len(fields)), numpy.dtype(code).newbyteorder(e)))
+        else:
+            fields.append(('f{}'.format(len(fields)), numpy.dtype(code).newbyteorder(e), (int(count),)))
+    return(numpy.dtype(fields))
+
+def read_record (f, layout, e = '<', addr_size = 8):
+    s = get_struct(layout, e, addr_size)
+    return(s.unpack(f.read(s.size)))
+
+def read_records (f, layout, count, e = '<', addr_size = 8):
+    s = get_struct(layout, e, addr_size)
+    return(list(s.iter_unpack(f.read(s.size * count))))
+
+def pack_record (layout, e, addr_size, *values):
+    return(get_struct(layout, e, addr_size).pack(*values))
+
+# Endianness, address size and (for animations) file version of one file.  A new context is made for every file
+# that is opened and passed to each reader and writer, so that files of different formats can be processed at once.
+class FormatContext:
+    def __init__ (self, e = '<', addr_size = 8, file_version = 1):
+        self.e = e
+        self.addr_size = addr_size
+        self.file_version = file_version
+    def read (self, f, layout):
+        return(read_record(f, layout, self.e, self.addr_size))
+    def read_many (self, f, layout, count):
+        return(read_records(f, layout, count, self.e, self.addr_size))
+    def pack (self, layout, *values):
+        return(pack_record(layout, self.e, self.addr_size, *values))
+    def swapped (self):
+        return(FormatContext({'<': '>', '>': '<'}[self.e], self.addr_size, self.file_version))
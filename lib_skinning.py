@@ -0,0 +1,249 @@
+# Linear blend skinning on the CPU, to bake posed copies of a model (for QA snapshots, collision checks and other
+# tools that need the deformed geometry) without a GPU or Blender.  The bones are posed by lib_pose.py, and every
+# vertex of every submesh is skinned for a batch of frames at once, with the same data as the glTF of
+# berseria_export_model.py: the bone palette (vgmap), the inverse bind matrices of skel_struct, and the
+# BLENDINDICES / BLENDWEIGHTS of read_mesh().  Submeshes without weights of their own are skinned to the first bone
+# of the palette, as in the glTF.
+#
+# The blend indices and weights of all the submeshes are turned into one dense (vertices, palette) weight matrix,
+# so blending the joint matrices of a batch of frames is a single matrix product (BLAS), after which each blended
+# matrix is applied to its vertex.  Normals, tangents and binormals are turned by the blended matrix (as glTF
+# viewers do) and normalized again.
+#
+# Usage:  For command line options, run:
+# /path/to/python3 lib_skinning.py --help
+#
+# e.g. python3 lib_skinning.py -f 0,15,30 CHR_BODY.TOMDLB_D CHR_WALK.TOANMB writes CHR_BODY_CHR_WALK_0000.glb,
+# CHR_BODY_CHR_WALK_0015.glb and CHR_BODY_CHR_WALK_0030.glb, static meshes in the pose of those frames.
+#
+# Requires numpy, berseria_export_model.py, berseria_export_animation.py and lib_pose.py (and what they need),
+# put in the same directory
+#
+# GitHub eArmada8/berseria_model_tool
+
+try:
+    import json, os, sys, numpy
+    from lib_pose import read_pose_evaluator
+    from lib_filesource import local_files
+    from lib_filesink import local_output
+except ModuleNotFoundError as e:
+    print("Python module missing! {}".format(e.msg))
+    input("Press Enter to abort.")
+    raise
+
+# Number of frames skinned (and held in memory) at once by process_pose()
+pose_batch_size = 32
+# Size of the blended matrices of one block of frames in skin_vertices(), in bytes
+skinning_block_size = 64 * 1024 * 1024
+
+direction_semantics = ['NORMAL', 'TANGENT', 'BINORMAL']
+
+# Dense weight matrix (vertices, palette_size) of the blend indices and blend weights (vertices, influences).
+# Influences with an index outside the palette are dropped.
+def weight_matrix (blend_indices, blend_weights, palette_size):
+    blend_indices = numpy.asarray(blend_indices, dtype = 'int64')
+    blend_weights = numpy.asarray(blend_weights, dtype = 'float64')
+    valid = (blend_indices >= 0) & (blend_indices < palette_size)
+    slots = numpy.arange(len(blend_indices))[:,None] * palette_size + numpy.where(valid, blend_indices, 0)
+    weights = numpy.bincount(slots.reshape(-1), weights = numpy.where(valid, blend_weights, 0.0).reshape(-1),
+        minlength = len(blend_indices) * palette_size)
+    return(weights.reshape(len(blend_indices), palette_size).astype('float32'))
+
+# Joint matrices (frames, palette, 4, 4) of the world matrices of the bones (frames, bones, 4, 4, see lib_pose.py),
+# bones is the index of each palette entry in the bones and inverse_bind_matrices (palette, 4, 4) their column
+# vector inverse bind matrices
+def joint_matrices (world_matrices, bones, inverse_bind_matrices):
+    return(world_matrices[:,bones] @ inverse_bind_matrices[None])
+
+# Skinned positions (frames, vertices, 3) of positions (vertices, 3), and of every directions array (vertices, 3),
+# normalized.  weights is from weight_matrix().
+def skin_vertices (joint_matrices, weights, positions, directions = []):
+    num_frames, palette_size = joint_matrices.shape[:2]
+    num_verts = len(positions)
+    points = numpy.concatenate([numpy.asarray(positions, dtype = 'float32').reshape(-1,3),
+        numpy.ones((num_verts, 1), dtype = 'float32')], axis = 1)
+    directions = [numpy.asarray(x, dtype = 'float32').reshape(-1,3) for x in directions]
+    # The top three rows of every joint matrix, all frames side by side: (palette, frames * 12)
+    rows = numpy.ascontiguousarray(joint_matrices[:,:,:3,:].astype('float32').transpose(1,0,2,3)).reshape(
+        palette_size, num_frames * 12)
+    skinned_positions = numpy.empty((num_frames, num_verts, 3), dtype = 'float32')
+    skinned_directions = [numpy.empty((num_frames, num_verts, 3), dtype = 'float32') for _ in directions]
+    block = max(1, min(num_frames, skinning_block_size // max(num_verts * 48, 1)))
+    for start in range(0, num_frames, block):
+        end = min(start + block, num_frames)
+        blended = (weights @ rows[:,start * 12:end * 12]).reshape(num_verts, end - start, 3, 4)
+        skinned_positions[start:end] = numpy.einsum('vfab,vb->fva', blended, points)
+        for direction, skinned in zip(directions, skinned_directions):
+            skinned[start:end] = numpy.einsum('vfab,vb->fva', blended[...,:3], direction)
+    for skinned in skinned_directions:
+        lengths = numpy.linalg.norm(skinned, axis = -1, keepdims = True)
+        numpy.divide(skinned, lengths, out = skinned, where = lengths > 0)
+    return(skinned_positions, skinned_directions)
+
+# The bone palette of a model (read_tomdlb() of berseria_export_model.py) as the index in skel_struct of each palette
+# entry and their inverse bind matrices (palette, 4, 4), column vector.  Raises ValueError if a bone of the palette is
+# not in the skeleton (e.g. the external skeleton was not found).
+def model_palette (model):
+    skel_struct = model['skel_struct']
+    skel_index = {skel_struct[i]['id']:i for i in range(len(skel_struct))}
+    missing = [x for x in model['bone_palette_ids'] if not x in skel_index]
+    if len(missing) > 0:
+        raise ValueError("Bones {} of the bone palette are not in the skeleton!".format(
+            ', '.join(['bone_{}'.format(x) for x in missing])))
+    bones = numpy.array([skel_index[x] for x in model['bone_palette_ids']], dtype = 'int64')
+    inverse_bind_matrices = numpy.array([skel_struct[i]['inv_matrix'] for i in bones],
+        dtype = 'float64').reshape(-1,4,4).transpose(0,2,1)
+    return(bones, inverse_bind_matrices)
+
+# Skins every submesh of a model for every frame of world_matrices (frames, bones of skel_struct, 4, 4), e.g.
+# pose_evaluator.frame_matrices() with the skeleton of the model.  Returns a {semantic: (frames, vertices, 3)} dict for
+# each submesh, with POSITION and the direction semantics the submesh has.
+def skin_model (model, world_matrices):
+    meshes = model['meshes']
+    bones, inverse_bind_matrices = model_palette(model)
+    if len(bones) > 0:
+        joints = joint_matrices(world_matrices, bones, inverse_bind_matrices)
+    else: # Not skinned in the glTF either
+        joints = numpy.repeat(numpy.identity(4)[None,None], len(world_matrices), axis = 0)
+    palette_size = joints.shape[1]
+    # All the submeshes together, directions that only some submeshes have are left as zeros in the others
+    mesh_semantics = [[x['SemanticName'] for x in mesh['fmt']['elements']] for mesh in meshes]
+    present = [x for x in direction_semantics if any([x in y for y in mesh_semantics])]
+    positions, directions, indices, weights, counts = [], {x:[] for x in present}, [], [], []
+    for mesh, semantics in zip(meshes, mesh_semantics):
+        num_verts = len(mesh['vb'][semantics.index('POSITION')]['Buffer'])
+        counts.append(num_verts)
+        positions.append(numpy.array(mesh['vb'][semantics.index('POSITION')]['Buffer'],
+            dtype = 'float32').reshape(num_verts, -1)[:,:3])
+        for semantic in present:
+            if semantic in semantics:
+                directions[semantic].append(numpy.array(mesh['vb'][semantics.index(semantic)]['Buffer'],
+                    dtype = 'float32').reshape(num_verts, -1)[:,:3])
+            else:
+                directions[semantic].append(numpy.zeros((num_verts, 3), dtype = 'float32'))
+        if 'BLENDINDICES' in semantics and 'BLENDWEIGHTS' in semantics:
+            indices.append(numpy.array(mesh['vb'][semantics.index('BLENDINDICES')]['Buffer'],
+                dtype = 'int64').reshape(num_verts, -1))
+            weights.append(numpy.array(mesh['vb'][semantics.index('BLENDWEIGHTS')]['Buffer'],
+                dtype = 'float64').reshape(num_verts, -1))
+        else:
+            indices.append(numpy.zeros((num_verts, 1), dtype = 'int64'))
+            weights.append(numpy.ones((num_verts, 1), dtype = 'float64'))
+    influences = max([x.shape[1] for x in indices] + [1])
+    indices = numpy.concatenate([numpy.pad(x, ((0, 0), (0, influences - x.shape[1]))) for x in indices]
+        + [numpy.zeros((0, influences), dtype = 'int64')])
+    weights = numpy.concatenate([numpy.pad(x, ((0, 0), (0, influences - x.shape[1]))) for x in weights]
+        + [numpy.zeros((0, influences))])
+    empty = [numpy.zeros((0, 3), dtype = 'float32')]
+    skinned_positions, skinned_directions = skin_vertices(joints, weight_matrix(indices, weights, palette_size),
+        numpy.concatenate(positions + empty), [numpy.concatenate(directions[x] + empty) for x in present])
+    skinned = []
+    offsets = numpy.cumsum([0] + counts)
+    for i in range(len(meshes)):
+        skinned.append({'POSITION': skinned_positions[:,offsets[i]:offsets[i+1]]})
+        for semantic, values in zip(present, skinned_directions):
+            if semantic in mesh_semantics[i]:
+                skinned[i][semantic] = values[:,offsets[i]:offsets[i+1]]
+    return(skinned)
+
+# Copies of the submeshes of a model in the pose of one frame of skin_model() (frame is the index in its frames)
+def posed_meshes (meshes, skinned, frame):
+    posed = []
+    for i in range(len(meshes)):
+        semantics = [x['SemanticName'] for x in meshes[i]['fmt']['elements']]
+        vb = []
+        for j in range(len(semantics)):
+            if semantics[j] in skinned[i]:
+                buffer = numpy.array(meshes[i]['vb'][j]['Buffer'], dtype = 'float64').reshape(
+                    len(meshes[i]['vb'][j]['Buffer']), -1)
+                buffer[:,:3] = skinned[i][semantics[j]][frame]
+                vb.append({**meshes[i]['vb'][j], 'Buffer': buffer.tolist()})
+            else:
+                vb.append(meshes[i]['vb'][j])
+        posed.append({'fmt': meshes[i]['fmt'], 'vb': vb, 'ib': meshes[i]['ib']})
+    return(posed)
+
+# Writes one posed model (meshes from posed_meshes()) as a static glTF with base_name (no skeleton or skin), and if
+# write_raw_buffers is True, as fmt/ib/vb/vgmap files in the base_name folder, as berseria_export_model.py does
+def write_posed_model (base_name, model, meshes, overwrite = False, write_raw_buffers = False, write_binary_gltf = True,
+        interactive = True, sink = local_output):
+    import berseria_export_model
+    written = []
+    if write_raw_buffers == True:
+        if sink.exists(base_name) and (os.path.isdir(base_name)):
+            overwrite = berseria_export_model.confirm_overwrite(base_name + " folder", overwrite, interactive)
+        if (overwrite == True) or not sink.exists(base_name):
+            skel_struct = model['skel_struct']
+            skel_index = {skel_struct[i]['id']:i for i in range(len(skel_struct))}
+            vgmap = {skel_struct[skel_index[model['bone_palette_ids'][i]]]['name']:i
+                for i in range(len(model['bone_palette_ids']))}
+            for i in range(len(meshes)):
+                if len(meshes[i]['ib']) > 0:
+                    filename = '{0}/{1:02d}_{2}'.format(base_name, i, model['mesh_blocks_info'][i]['name'])
+                    with sink.open(filename + '.fmt') as f:
+                        berseria_export_model.write_fmt_stream(meshes[i]['fmt'], f)
+                    with sink.open(filename + '.ib') as f:
+                        berseria_export_model.write_ib_stream(meshes[i]['ib'], f, meshes[i]['fmt'], '<')
+                    with sink.open(filename + '.vb') as f:
+                        berseria_export_model.write_vb_stream(meshes[i]['vb'], f, meshes[i]['fmt'], '<')
+                    sink.write(filename + '.vgmap', json.dumps(vgmap, indent=4).encode())
+                    written.extend(['{0}.{1}'.format(filename, x) for x in ['fmt', 'ib', 'vb', 'vgmap']])
+    static_meshes = [{**x, 'fmt': {**x['fmt'], 'elements': [y for y in x['fmt']['elements']
+        if not y['SemanticName'] in ['BLENDWEIGHTS', 'BLENDINDICES']]},
+        'vb': [x['vb'][j] for j in range(len(x['vb'])) if not x['fmt']['elements'][j]['SemanticName']
+        in ['BLENDWEIGHTS', 'BLENDINDICES']]} for x in meshes]
+    mesh_blocks_info = [{**x, 'vgmap': 0} for x in model['mesh_blocks_info']]
+    written.extend(berseria_export_model.write_gltf(base_name, [], [{}], mesh_blocks_info, static_meshes,
+        model['material_struct'], overwrite = overwrite, write_binary_gltf = write_binary_gltf,
+        interactive = interactive, sink = sink))
+    return(written)
+
+# Bakes a model (dlb_file) in the pose of frames (frame numbers at 30 fps, or 'all') of an animation, one
+# {model}_{animation}_{frame}.glb per frame.  skeleton_file is the skeleton of the model, as for
+# berseria_export_model.py.  Frames are skinned pose_batch_size at a time.
+def process_pose (dlb_file, animbin_file, frames = [0], skeleton_file = '', write_raw_buffers = False,
+        write_binary_gltf = True, overwrite = False, interactive = True, source = local_files, sink = local_output):
+    import berseria_export_model
+    print("Posing {0} with {1}...".format(dlb_file, animbin_file))
+    model = berseria_export_model.read_tomdlb(dlb_file, skeleton_file, interactive, source)
+    if model == False:
+        return([])
+    evaluator = read_pose_evaluator(animbin_file, skel_struct = model['skel_struct'], interactive = interactive,
+        source = source)
+    if evaluator == None:
+        print("Skipping {} as it has no animation data...".format(animbin_file))
+        return([])
+    if frames == 'all':
+        frames = list(range(len(evaluator.frame_times())))
+    base_name = '{0}_{1}'.format(dlb_file.split('.TOMDLB_D')[0], os.path.basename(animbin_file).split('.')[0])
+    written = []
+    for start in range(0, len(frames), pose_batch_size):
+        batch = frames[start:start + pose_batch_size]
+        skinned = skin_model(model, evaluator.frame_matrices(batch))
+        for i in range(len(batch)):
+            written.extend(write_posed_model('{0}_{1:04d}'.format(base_name, batch[i]), model,
+                posed_meshes(model['meshes'], skinned, i), overwrite = overwrite, write_raw_buffers = write_raw_buffers,
+                write_binary_gltf = write_binary_gltf, interactive = interactive, sink = sink))
+    return(written)
+
+if __name__ == "__main__":
+    # Set current directory
+    if getattr(sys, 'frozen', False):
+        os.chdir(os.path.dirname(sys.executable))
+    else:
+        os.chdir(os.path.abspath(os.path.dirname(__file__)))
+
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-f', '--frames', help="Frames to pose, e.g. 0,15,30, or all (default 0)", default='0')
+    parser.add_argument('-k', '--skeleton', help="Skeleton TOMDLB_D file of the model, if it is not found on its own", default='')
+    parser.add_argument('-r', '--rawbuffers', help="Also write fmt/ib/vb/vgmap files of every posed frame", action="store_true")
+    parser.add_argument('-t', '--textformat', help="Write gltf instead of glb", action="store_false")
+    parser.add_argument('-o', '--overwrite', help="Overwrite existing files", action="store_true")
+    parser.add_argument('dlb_filename', help="Name of dlb file to pose.")
+    parser.add_argument('animbin_file', help="Name of binary animation file with the pose.")
+    args = parser.parse_args()
+    frames = 'all' if args.frames == 'all' else [int(x) for x in args.frames.split(',')]
+    if os.path.exists(args.dlb_filename) and args.dlb_filename[-5:] == 'DLB_D' and os.path.exists(args.animbin_file):
+        process_pose(args.dlb_filename, args.animbin_file, frames, skeleton_file = args.skeleton,
+            write_raw_buffers = args.rawbuffers, write_binary_gltf = args.textformat, overwrite = args.overwrite)
@@ -6,34 +6,23 @@
 # For command line options, run:
 # /path/to/python3 berseria_export_tosnebd.py --help
 #
+# Requires lib_schema.py from the main folder (one level up).
+#
 # GitHub eArmada8/berseria_model_tool
 
 try:
     import struct, json, glob, os, sys
+    # lib_schema.py lives in the main folder, one level up
+    sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    from lib_schema import *
 except ModuleNotFoundError as e:
     print("Python module missing! {}".format(e.msg))
     input("Press Enter to abort.")
     raise
 
-# Global variable, do not edit
-addr_size = 8
-e = '<'
-
-def set_address_size (size):
-    global addr_size
-    if size in [4,8]:
-        addr_size = size
-    return
-
-def set_endianness (endianness):
-    global e
-    if endianness in ['<', '>']:
-        e = endianness
-    return
-
-def read_offset (f):
+def read_offset (f, ctx):
     start_offset = f.tell()
-    diff_offset, = struct.unpack("{}{}".format(e, {4: "I", 8: "Q"}[addr_size]), f.read(addr_size))
+    diff_offset, = ctx.read(f, 'address')
     return(start_offset + diff_offset)
 
 def read_string (f, start_offset):
@@ -45,24 +34,24 @@ def read_string (f, start_offset):
     f.seek(current_loc)
     return(null_term_string[:-1].decode())
 
-def read_opening_dict (f):
-    dict_offset = read_offset(f)
-    dict_size, = struct.unpack("{}{}".format(e, {4: "I", 8: "Q"}[addr_size]), f.read(addr_size))
+def read_opening_dict (f, ctx):
+    dict_offset = read_offset(f, ctx)
+    dict_size, = ctx.read(f, 'address')
     opening_dict = []
     return_to_offset = f.tell()
     f.seek(dict_offset)
     for _ in range(dict_size):
-        opening_dict.append(read_string(f, read_offset(f)))
+        opening_dict.append(read_string(f, read_offset(f, ctx)))
     f.seek(return_to_offset)
     return(opening_dict)
 
-def read_section(f, i, toc_entry):
+def read_section(f, i, toc_entry, ctx):
     def read_str_array (f, offset, count):
         current_loc = f.tell()
         f.seek(offset)
         array = []
         for _ in range(count):
-            array.append(read_string(f, read_offset(f)))
+            array.append(read_string(f, read_offset(f, ctx)))
         f.seek(current_loc)
         return(array)
     def read_val_array (f, schema, sch_len, offset, count):
@@ -70,7 +59,7 @@ def read_section(f, i, toc_entry):
         f.seek(offset)
         array = []
         for _ in range(count):
-            array.append(struct.unpack("{}{}".format(e, schema), f.read(sch_len)))
+            array.append(struct.unpack("{}{}".format(ctx.e, schema), f.read(sch_len)))
         f.seek(current_loc)
         return(array)
     def read_str_val_array (f, offset, count):
@@ -78,23 +67,23 @@ def read_section(f, i, toc_entry):
         f.seek(offset)
         array = []
         for _ in range(count):
-            name_1 = read_string(f, read_offset(f))
+            name_1 = read_string(f, read_offset(f, ctx))
             tell_loc = f.tell()
-            offset_1 = read_offset(f)
-            val_type, = struct.unpack("{}{}".format(e,{4: "I", 8: "Q"}[addr_size]), f.read(addr_size))
-            val_1_1 = list(struct.unpack("{}2i".format(e), f.read(8)))
-            offset_2 = read_offset(f)
-            count_2, = struct.unpack("{}{}".format(e,{4: "I", 8: "Q"}[addr_size]), f.read(addr_size))
-            offset_3 = read_offset(f)
-            count_3, = struct.unpack("{}{}".format(e,{4: "I", 8: "Q"}[addr_size]), f.read(addr_size))
+            offset_1 = read_offset(f, ctx)
+            val_type, = ctx.read(f, 'address')
+            val_1_1 = list(struct.unpack("{}2i".format(ctx.e), f.read(8)))
+            offset_2 = read_offset(f, ctx)
+            count_2, = ctx.read(f, 'address')
+            offset_3 = read_offset(f, ctx)
+            count_3, = ctx.read(f, 'address')
             current_loc_1 = f.tell()
             f.seek(offset_1)
             if val_type == 0:
-                val_1_2, = struct.unpack("{}Q".format(e), f.read(8))
+                val_1_2, = struct.unpack("{}Q".format(ctx.e), f.read(8))
             elif val_type == 1:
-                val_1_2 = struct.unpack("{}16f".format(e), f.read(64))
+                val_1_2 = ctx.read(f, 'matrix')
             elif val_type == 2:
-                val_1_2 = read_string(f, read_offset(f))
+                val_1_2 = read_string(f, read_offset(f, ctx))
             else:
                 input("Unknown type at offset {}, referenced at {}!".format(hex(offset_1), hex(tell_loc)))
                 #raise
@@ -111,83 +100,83 @@ def read_section(f, i, toc_entry):
     data_list = []
     for _ in range(toc_entry['num_entries']):
         if i in [0,1,2,3,10,11,12,16]:
-            name = read_string(f, read_offset(f))
+            name = read_string(f, read_offset(f, ctx))
         if i == 0:
             # Final 8-16 bytes seem to always be 0, so dunno why the variable length
-            data = list(struct.unpack("{}4i2{}".format(e,{4: "I", 8: "Q"}[addr_size]), f.read(addr_size * 2 + 16)))
+            data = list(ctx.read(f, 'scene_section_0'))
             data_list.append({'name': name, 'values': data})
         elif i == 1:
-            string_1 = read_string(f, read_offset(f))
-            data = list(struct.unpack("{}2I".format(e), f.read(8)))
-            offset = read_offset(f)
-            count, = struct.unpack("{}{}".format(e,{4: "I", 8: "Q"}[addr_size]), f.read(addr_size)) # just a guess, sample file has 1
+            string_1 = read_string(f, read_offset(f, ctx))
+            data = list(struct.unpack("{}2I".format(ctx.e), f.read(8)))
+            offset = read_offset(f, ctx)
+            count, = ctx.read(f, 'address') # just a guess, sample file has 1
             array = read_str_val_array(f, offset, count)
             data_list.append({'name': name, 'string_1': string_1, 'values': [data, array]})
         elif i == 2:
-            val_1 = list(struct.unpack("{}3I72f3i".format(e), f.read(0x138)))
-            offset = read_offset(f)
-            count, = struct.unpack("{}{}".format(e,{4: "I", 8: "Q"}[addr_size]), f.read(addr_size))
-            val_2 = list(struct.unpack("{}I4B2I".format(e), f.read(16)))
+            val_1 = list(ctx.read(f, 'scene_section_2'))
+            offset = read_offset(f, ctx)
+            count, = ctx.read(f, 'address')
+            val_2 = list(ctx.read(f, 'scene_section_2_b'))
             val_3 = []
-            if addr_size == 8:
-                val_3 = list(struct.unpack("{}4I".format(e), f.read(16)))
+            if ctx.addr_size == 8:
+                val_3 = list(ctx.read(f, 'scene_section_2_c'))
             array = read_val_array (f, "3I", 12, offset, count)
             data_list.append({'name': name, 'values': [val_1, array, val_2, val_3]})
         elif i == 3:
-            offset_1 = read_offset(f)
-            count_1, = struct.unpack("{}{}".format(e,{4: "I", 8: "Q"}[addr_size]), f.read(addr_size))
-            data = list(struct.unpack("{}2I".format(e), f.read(8)))
-            offset_2 = read_offset(f)
-            count_2, = struct.unpack("{}{}".format(e,{4: "I", 8: "Q"}[addr_size]), f.read(addr_size))
+            offset_1 = read_offset(f, ctx)
+            count_1, = ctx.read(f, 'address')
+            data = list(struct.unpack("{}2I".format(ctx.e), f.read(8)))
+            offset_2 = read_offset(f, ctx)
+            count_2, = ctx.read(f, 'address')
             array_1 = read_str_array (f, offset_1, count_1)
             array_2 = read_str_val_array(f, offset_2, count_2)
             data_list.append({'name': name, 'values': [data, array_1, array_2]})
         elif i == 7:
-            data_list.append(list(struct.unpack("{}2H".format(e), f.read(4))))
+            data_list.append(list(struct.unpack("{}2H".format(ctx.e), f.read(4))))
         elif i == 8:
-            data_list.append(read_string(f, read_offset(f)))
+            data_list.append(read_string(f, read_offset(f, ctx)))
         elif i == 10:
-            val1, = struct.unpack("{}{}".format(e,{4: "I", 8: "Q"}[addr_size]), f.read(addr_size))
-            offset = read_offset(f)
-            count, = struct.unpack("{}{}".format(e,{4: "I", 8: "Q"}[addr_size]), f.read(addr_size)) # just a guess, sample file has 1
-            val2 = list(struct.unpack("{}2{}".format(e,{4: "I", 8: "Q"}[addr_size]), f.read(addr_size * 2)))
+            val1, = ctx.read(f, 'address')
+            offset = read_offset(f, ctx)
+            count, = ctx.read(f, 'address') # just a guess, sample file has 1
+            val2 = list(ctx.read(f, 'pointer'))
             array = read_val_array (f, "I", 4, offset, count)
             data_list.append({'name': name, 'values': [val1, array, val2]})
         elif i == 11:
-            val_1 = list(struct.unpack("{}2I{}".format(e,{4: "I", 8: "Q"}[addr_size]), f.read(addr_size + 8)))
-            offset = read_offset(f)
-            count, = struct.unpack("{}{}".format(e,{4: "I", 8: "Q"}[addr_size]), f.read(addr_size))
+            val_1 = list(ctx.read(f, 'scene_section_11'))
+            offset = read_offset(f, ctx)
+            count, = ctx.read(f, 'address')
             # for 64-bit, this might be u32+padding, I can't tell since 64-bit BE doesn't exist
-            val_2, = struct.unpack("{}{}".format(e,{4: "I", 8: "Q"}[addr_size]), f.read(addr_size))
+            val_2, = ctx.read(f, 'address')
             array = read_str_val_array(f, offset, count)
             data_list.append({'name': name, 'values': [val_1, array, val_2]})
         elif i == 12:
-            data = list(struct.unpack("{}2I".format(e), f.read(8)))
-            offset = read_offset(f)
-            count, = struct.unpack("{}{}".format(e,{4: "I", 8: "Q"}[addr_size]), f.read(addr_size))
+            data = list(struct.unpack("{}2I".format(ctx.e), f.read(8)))
+            offset = read_offset(f, ctx)
+            count, = ctx.read(f, 'address')
             array = read_str_val_array(f, offset, count)
             data_list.append({'name': name, 'values': [data, array]})
         elif i == 13:
-            data_list.append(list(struct.unpack("{}2H".format(e), f.read(4))))
+            data_list.append(list(struct.unpack("{}2H".format(ctx.e), f.read(4))))
         elif i == 14:
             # I've only seen count 1, so I don't know if the schema is all the offsets first then all the data,
             # or if the offsets and data are together... or if it's not possible to have more than one
-            offset = read_offset(f)
-            count, = struct.unpack("{}{}".format(e,{4: "I", 8: "Q"}[addr_size]), f.read(addr_size))
+            offset = read_offset(f, ctx)
+            count, = ctx.read(f, 'address')
             array = read_val_array (f, "I", 4, offset, count)
             data_list.append({'values': array})
             # addr_size 4 has extra padding at the end
         elif i == 15:
-            data_list.append(list(struct.unpack("{}Q2I".format(e), f.read(16))))
+            data_list.append(list(ctx.read(f, 'scene_section_15')))
         elif i == 16:
-            vals = list(struct.unpack("{}2H".format(e), f.read(4)))
+            vals = list(struct.unpack("{}2H".format(ctx.e), f.read(4)))
             data_list.append({'name': name, 'values': vals})
-            if addr_size == 8:
+            if ctx.addr_size == 8:
                 f.seek(4,1) # Padding
         elif i == 17:
-            data_list.extend(list(struct.unpack("{}Q".format(e), f.read(8))))
+            data_list.extend(list(struct.unpack("{}Q".format(ctx.e), f.read(8))))
         elif i == 18:
-            data_list.extend(list(struct.unpack("{}f".format(e), f.read(4))))
+            data_list.extend(list(struct.unpack("{}f".format(ctx.e), f.read(4))))
             # addr_size 4 has extra padding at the end - or maybe end of file is padded to 8 bytes
     return(data_list)
 
@@ -195,23 +184,22 @@ def read_tosnebd (scene_file):
     with open(scene_file, 'rb') as f:
         magic = f.read(4)
         if magic in [b'DPDF', b'FDPD']:
-            if magic == b'FDPD':
-                set_endianness('>')
-            unk_int, = struct.unpack("{}I".format(e), f.read(4))
+            ctx = FormatContext({b'DPDF': '<', b'FDPD': '>'}[magic])
+            unk_int, = struct.unpack("{}I".format(ctx.e), f.read(4))
             if not unk_int == 0:
                 f.seek(4,0)
-                set_address_size(4) # Zestiria
+                ctx.addr_size = 4 # Zestiria
             data = {}
-            data['file_type'] = {'address_size': addr_size, 'endianness': e}
-            data['opening_dict'] = read_opening_dict (f)
-            data['unk0'] = struct.unpack("{}fI".format(e), f.read(8))
+            data['file_type'] = {'address_size': ctx.addr_size, 'endianness': ctx.e}
+            data['opening_dict'] = read_opening_dict (f, ctx)
+            data['unk0'] = ctx.read(f, 'scene_header')
             toc = []
             for _ in range(20):
-                offset = read_offset(f)
-                num_entries, = struct.unpack("{}{}".format(e,{4: "I", 8: "Q"}[addr_size]), f.read(addr_size))
+                offset = read_offset(f, ctx)
+                num_entries, = ctx.read(f, 'address')
                 toc.append({'offset': offset, 'num_entries': num_entries})
             for i in [0,1,2,3,7,8,10,11,12,13,14,15,16,17,18]:
-                data['section_{0}'.format(i)] = read_section(f, i, toc[i])
+                data['section_{0}'.format(i)] = read_section(f, i, toc[i], ctx)
             with open(scene_file + '.json', 'wb') as ff:
                 ff.write(json.dumps(data, indent=4).encode('utf-8'))
 
@@ -0,0 +1,212 @@
+# Stress check for the per-file FormatContext: parses models and animations of every format (little and big endian,
+# 4-byte and 8-byte addresses) from many threads at once, and checks that every result is the same as that of a
+# serial run.  Before FormatContext, the endianness and address size were module globals, and parsing files of
+# different formats at the same time mixed them up.
+#
+# The files are small synthetic models (skeleton, physics, collision, weighted and unweighted meshes, materials)
+# and animations (plain and DCT compressed channels), built in a temporary folder with the writers of
+# berseria_import_model.py and misc/berseria_import_toanmsb.py.  Each is parsed with read_tomdlb() and
+# read_tosamsb(), and read by the importer (read_original_tomdlb(), with and without swapping endianness).
+#
+# Usage:  /path/to/python3 tests/stress_format_context.py [--threads 16] [--rounds 8]
+# Exits with an AssertionError if any result differs.
+#
+# Requires numpy and the pyffi_tstrip module (as the tools do)
+#
+# GitHub eArmada8/berseria_model_tool
+
+try:
+    import contextlib, concurrent.futures, tempfile, hashlib, random, struct, json, io, os, sys
+    repo_folder = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    sys.path.extend([repo_folder, os.path.join(repo_folder, 'misc')])
+    import numpy
+    import berseria_export_model, berseria_export_animation, berseria_import_model
+    from lib_schema import FormatContext
+    from lib_channelstore import animation_channel
+    from lib_fmtibvb import write_fmt, write_ib, write_vb, write_struct_to_json
+    from berseria_import_toanmsb import create_toanmsb
+except ModuleNotFoundError as e:
+    print("Python module missing! {}".format(e.msg))
+    input("Press Enter to abort.")
+    raise
+
+formats = [('<', 8), ('>', 8), ('<', 4), ('>', 4)]
+bone_names = ['ROOT', 'SPINE', 'NECK', 'HEAD', 'ARM_L', 'ARM_R']
+bone_parents = [-1, 0, 1, 2, 1, 1]
+
+def translation_matrix (x, y, z):
+    return([1.0, 0.0, 0.0, 0.0, 0.0, 1.0, 0.0, 0.0, 0.0, 0.0, 1.0, 0.0, x, y, z, 1.0])
+
+# A submesh as a grid of num_verts vertices, with blend weights if weighted
+def make_submesh (num_uvs, grid, weighted, palette_size, rnd):
+    num_verts = grid * grid
+    ib = []
+    for y in range(grid - 1):
+        for x in range(grid - 1):
+            a = y * grid + x
+            ib.extend([[a, a + 1, a + grid], [a + 1, a + grid + 1, a + grid]])
+    vb = [{'Buffer': [[float(i % grid), float(i // grid), rnd.random()] for i in range(num_verts)]},
+        {'Buffer': [[0.0, 0.0, 1.0] for _ in range(num_verts)]}]
+    vb.extend([{'Buffer': [[rnd.random(), rnd.random()] for _ in range(num_verts)]} for _ in range(num_uvs)])
+    if weighted:
+        counts = [(i % 4) + 1 for i in range(num_verts)]
+        vb.append({'Buffer': [[1.0 / x] * x + [0.0] * (4 - x) for x in counts]})
+        vb.append({'Buffer': [[(i + j) % palette_size for j in range(4)] for i in range(num_verts)]})
+    else:
+        vb.append({'Buffer': [[1.0, 0.0, 0.0, 0.0] for _ in range(num_verts)]})
+        vb.append({'Buffer': [[0, 0, 0, 0] for _ in range(num_verts)]})
+    return(berseria_export_model.make_fmt(num_uvs), ib, vb)
+
+# Writes {name}.TOMDLB_D and {name}.TOMDLP_P in folder, in the format of ctx
+def make_model (folder, name, ctx, seed):
+    rnd = random.Random(seed)
+    bone_ids = [0x10000 + i for i in range(len(bone_names))]
+    raw_skel = [(1, 2, 3, 0, 0, 0, 0, 0, 0), [0, 0, 1, 2, 3, 4, 1.0, 5, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0], bone_ids,
+        [bone_ids[x] if x >= 0 else -1 for x in bone_parents], [[i, 0, bone_parents[i], 0] for i in range(len(bone_ids))],
+        bone_names, [[translation_matrix(0, 0, 0)] * 2 for _ in bone_ids],
+        [translation_matrix(0, float(i), 0) for i in range(len(bone_ids))],
+        [translation_matrix(0, -float(i), 0) for i in range(len(bone_ids))], bone_parents]
+    physics = [dict(zip(['flag', 'target_node', 'group', 'unk_correction'] + ['p{:02d}'.format(i) for i in range(25)],
+        [0, 1, 0, 0] + [rnd.random() for _ in range(25)]))]
+    materials = [{'name': 'MAT{0}_{1}'.format(i, name), 'textures': ['TEX_{}'.format(i)],
+        'parameters': {'mat_info': dict(zip(['material_id', 'mat_variation_flags', 'mat_alpha_flags', 'num_uv',
+            'ani_mat_id', 'tex0', 'shader', 'render_type', 'unk0', 'unk1', 'unk2'], [i, 0, 64 * i, 1, 0, 0, 0, 0, 0, 0, 0])),
+        'mat_params': {'unk{:02d}'.format(j): j for j in range(11)}, 'shader_params': {'unk{:02d}'.format(j): j for j in range(5)},
+        'set_2_unk_0': [1, 2], 'set_2_unk_1': [3]}} for i in range(2)]
+    # The meshes are built by the importer from a model folder
+    model_folder = os.path.join(folder, name)
+    os.makedirs(model_folder)
+    mesh_info = []
+    for i, (mesh_name, flags, grid) in enumerate([('BODY_A', 0x51, 12), ('BODY_B', 0x52, 7), ('PROP', 0x01, 5)]):
+        fmt, ib, vb = make_submesh(flags & 0xF, grid, flags & 0xF0 == 0x50, len(bone_ids), rnd)
+        mesh_file = os.path.join(model_folder, '{0:02d}_{1}'.format(i, mesh_name))
+        write_fmt(fmt, mesh_file + '.fmt')
+        write_ib(ib, mesh_file + '.ib', fmt)
+        write_vb(vb, mesh_file + '.vb', fmt)
+        mesh_info.append({'name': mesh_name, 'mesh': i, 'submesh': 0, 'node': -1, 'flags': flags,
+            'material': materials[i % 2]['name'], 'unknown': 0})
+    write_struct_to_json(mesh_info, os.path.join(model_folder, 'mesh_info'))
+    dlp_file = os.path.join(folder, name + '.TOMDLP_P')
+    section_6, dlp_block = berseria_import_model.create_section_6(os.path.join(folder, name + '.TOMDLB_D'), None,
+        dlp_file, materials, ctx, ctx, 9, 10, interactive = False, original_mesh_data = (bone_ids, []),
+        model_folder = model_folder)
+    blocks = [berseria_import_model.create_section_0(raw_skel, ctx)]
+    blocks.extend([bytearray(struct.pack("{}4I".format(ctx.e), i, i + 1, i + 2, i + 3)) for i in [1, 2, 3]])
+    blocks.append(berseria_import_model.create_section_4(physics, ctx, 7, 8))
+    blocks.append(berseria_import_model.create_section_5([[[0, 1, 0.0, 0.0, 0.0, 1.0, 1.0, 1.0, 0, 1]], [[0.0] * 9]], ctx))
+    blocks.append(section_6)
+    blocks.append(berseria_import_model.create_section_7(materials, ctx, 11, 12))
+    blocks.extend([bytearray(struct.pack("{}4I".format(ctx.e), i, i + 1, i + 2, i + 3)) for i in [8, 9, 10]])
+    blocks.append(berseria_import_model.create_section_11([[0x0001000000020003], [1.0, 2.0, 3.0]], ctx))
+    strings = [name + '.TOMDLP_P', name + '.TOANMB', 'TEX_0.totexb_d', 'TEX_1.totexb_d']
+    opening_dict = berseria_import_model.write_string_dict(strings, ctx)[0]
+    bldm_block, dict_offset = berseria_import_model.create_data_block(blocks, ctx, opening_dict, 1, ctx.addr_size)
+    dlb = bytearray({'<': b'DPDF', '>': b'FDPD'}[ctx.e])
+    if ctx.addr_size == 8:
+        dlb.extend(struct.pack("{}I".format(ctx.e), 0))
+    dlb.extend(ctx.pack('pointer', dict_offset + (ctx.addr_size * 2 + 8), len(strings)))
+    dlb.extend({'<': b'BLDM', '>': b'MDLB'}[ctx.e] + struct.pack("{}I".format(ctx.e), 5))
+    dlb.extend(bldm_block)
+    with open(os.path.join(folder, name + '.TOMDLB_D'), 'wb') as f:
+        f.write(dlb)
+    with open(dlp_file, 'wb') as f:
+        f.write(dlp_block)
+    return(os.path.join(folder, name + '.TOMDLB_D'))
+
+# Writes {name}.TOANMB in folder, in the format of ctx, with a linear translation, a DCT compressed rotation
+# (segmented if longer than one segment) and a single scale for every bone
+def make_animation (folder, name, ctx, num_frames, seed):
+    rnd = random.Random(seed)
+    targets, stream = [], []
+    for bone in range(len(bone_names)):
+        keys = list(range(0, num_frames, 3))
+        targets.append([(bone << 32) | 0x20003, len(stream), 0])
+        stream.append({'flag': 0x3100, 'unk_float': 0.0, 'header': keys,
+            'vecs': [[rnd.random(), rnd.random(), rnd.random()] for _ in keys]})
+        segments = (num_frames - 1) // 33 + 1
+        type_ = 9 if segments > 1 else 8
+        rotation = {'flag': type_ | (1 << 4) | (1 << 8) | (4 << 12), 'unk_float': 0.0, 'header': list(range(num_frames)),
+            'unk_float2': 0.05, 'dct_toc': [0] + [24 * i for i in range(1, segments)],
+            'float_table': [0, 0, 0, 32767] * (segments + 1),
+            'dct_segments': [[{'base_vals': [0x8000, 0x4000, 0x80, 0x11, 0x24, 0x11],
+                's16': [[1000 * (c + 1), -500, rnd.randint(-300, 300), 100]], 's8': [[10, -10, 5, 3]],
+                's4': [[0x1a, 0x78, 0x65, 0x17]]} for c in range(4)] for _ in range(segments)]}
+        targets.append([(bone << 32) | 0x10014, len(stream), 0])
+        stream.append(rotation)
+        targets.append([(bone << 32) | 0x00003, len(stream), 0])
+        stream.append({'flag': 0x3003, 'vec': [1.0, 1.0, 1.0]})
+    anim_data = {'header': [1, 30.0, float(num_frames), 0], 'header2': [0, 0, 1.0], 'target_table': targets,
+        'hash_table': list(range(len(targets))), 'data_stream': stream}
+    with open(os.path.join(folder, name + '.TOANMB'), 'wb') as f:
+        f.write(create_toanmsb(anim_data, ctx))
+    return(os.path.join(folder, name + '.TOANMB'))
+
+# Plain values (for comparison) of a parse result
+def plain (value):
+    if isinstance(value, dict):
+        return({str(x): plain(y) for x, y in value.items()})
+    if isinstance(value, (list, tuple)) or type(value).__name__ == 'lazy_vector_stream':
+        return([plain(x) for x in value])
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return(hashlib.sha1(value).hexdigest())
+    if isinstance(value, numpy.ndarray):
+        return(plain(value.tolist()))
+    if isinstance(value, FormatContext):
+        return([value.e, value.addr_size, value.file_version])
+    if isinstance(value, animation_channel):
+        return(value.entry())
+    if isinstance(value, (numpy.integer, numpy.floating)):
+        return(value.item())
+    return(value)
+
+def fingerprint (value):
+    return(hashlib.sha1(json.dumps(plain(value), sort_keys = True).encode()).hexdigest())
+
+def parse (task):
+    kind, filename = task
+    if kind == 'read_tomdlb':
+        result = berseria_export_model.read_tomdlb(filename, interactive = False)
+    elif kind == 'read_tosamsb':
+        result = berseria_export_animation.read_tosamsb(filename, interactive = False, decode_workers = 1)
+    elif kind == 'read_original_tomdlb':
+        result = berseria_import_model.read_original_tomdlb(filename)
+    elif kind == 'read_original_tomdlb_swapped':
+        result = berseria_import_model.read_original_tomdlb(filename, swap_endian = True)
+    assert not result in [None, False], "{0} could not read {1}".format(kind, filename)
+    return(fingerprint(result))
+
+def stress_format_context (threads = 16, rounds = 8):
+    with tempfile.TemporaryDirectory() as folder:
+        tasks = []
+        # The builders and readers print progress.  stdout is redirected once for all the threads, redirecting it
+        # in each thread would race.
+        with contextlib.redirect_stdout(io.StringIO()):
+            for i, (e, addr_size) in enumerate(formats):
+                ctx = FormatContext(e, addr_size)
+                name = 'CHR_{0}{1}'.format({'<': 'LE', '>': 'BE'}[e], addr_size * 8)
+                dlb_file = make_model(folder, name, ctx, i)
+                tasks.extend([(x, dlb_file) for x in ['read_tomdlb', 'read_original_tomdlb', 'read_original_tomdlb_swapped']])
+                tasks.append(('read_tosamsb', make_animation(folder, name, ctx, [40, 100][i % 2], i)))
+            serial = {x: parse(x) for x in tasks}
+            parallel_tasks = tasks * rounds
+            random.Random(0).shuffle(parallel_tasks)
+            with concurrent.futures.ThreadPoolExecutor(max_workers = threads) as executor:
+                results = list(executor.map(parse, parallel_tasks))
+        # The files of different formats must not all give the same result, or a mixed up context would go unnoticed
+        for kind in ['read_tomdlb', 'read_tosamsb']:
+            assert len(set([serial[x] for x in tasks if x[0] == kind])) == len(formats), \
+                "{} gives the same result for files of different formats".format(kind)
+        mismatches = [x for x, y in zip(parallel_tasks, results) if y != serial[x]]
+        assert len(mismatches) == 0, "{0} of {1} parses differ from the serial run, e.g. {2}".format(
+            len(mismatches), len(parallel_tasks), mismatches[0])
+    print("{0} parses of {1} files ({2} formats) on {3} threads match the serial run.".format(len(parallel_tasks),
+        len(set([x[1] for x in tasks])), len(formats), threads))
+    return
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-t', '--threads', help="Number of threads", type=int, default=16)
+    parser.add_argument('-r', '--rounds', help="Number of times each file is parsed", type=int, default=8)
+    args = parser.parse_args()
+    stress_format_context(args.threads, args.rounds)
@@ -7,6 +7,15 @@
 
 import struct, glob, os, sys
 
+def totexp_p_to_dds (tex_file):
+    with open(tex_file, 'rb') as f:
+        size, = struct.unpack("<I", f.read(4))
+        img_dat = f.read()
+        assert size == len(img_dat)
+    with open(tex_file.split('.TOTEXP_P')[0]+'.dds', 'wb') as f:
+        f.write(img_dat)
+    return
+
 if __name__ == "__main__":
     # Set current directory
     if getattr(sys, 'frozen', False):
@@ -16,9 +25,4 @@ if __name__ == "__main__":
 
     tex_files = glob.glob('*.TOTEXP_P')
     for tex_file in tex_files:
-        with open(tex_file, 'rb') as f:
-            size, = struct.unpack("<I", f.read(4))
-            img_dat = f.read()
-            assert size == len(img_dat)
-        with open(tex_file.split('.TOTEXP_P')[0]+'.dds', 'wb') as f:
-            f.write(img_dat)
\ No newline at end of file
+        totexp_p_to_dds(tex_file)